@@ -0,0 +1,342 @@
+"""
+Benchmarks of the hot paths: sphere mesh generation, particle appends, picking,
+framebuffer readback and full ParticleWidget frames.
+
+Runs headless on a CPU-only Linux machine through Mesa's software rasterizer
+(llvmpipe, over EGL or OSMesa), so numbers from different commits on the same
+machine are comparable. Results are written as JSON:
+
+    python benchmarks/run_benchmarks.py -o before.json
+    git checkout other-branch
+    python benchmarks/run_benchmarks.py -o after.json --compare before.json
+
+--compare prints the change of the median (or --metric min, steadier on a busy
+machine) of every benchmark and exits with status 1 if any got slower than
+--threshold. --quick runs smaller sizes and
+fewer repeats, --filter only the benchmarks whose name contains the string.
+"""
+import os
+import sys
+
+# Before anything imports OpenGL: Mesa's software rasterizer, whatever GPU the machine has
+os.environ.setdefault("LIBGL_ALWAYS_SOFTWARE", "1")
+os.environ.setdefault("GALLIUM_DRIVER", "llvmpipe")
+
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCHEMA = 1
+
+# Benchmark groups in run order, filled by @benchmark
+GROUPS = {}
+
+def benchmark(group):
+    def register(function):
+        GROUPS[group] = function
+        return function
+    return register
+
+class Runner:
+    """Times the cases of every group and collects their results."""
+
+    def __init__(self, quick=False, name_filter=None, repeat=None, verbose=True):
+        self.quick = quick
+        self.name_filter = name_filter
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = []
+
+    def wanted(self, name):
+        return self.name_filter is None or self.name_filter in name
+
+    def run(self, group, name, function, params, repeat=10, warmup=1, setup=None, finish=None):
+        """
+        Runs `function` `warmup` times, then times `repeat` runs; `setup` runs
+        untimed before each of them, `finish` (e.g. glFinish) inside the timing.
+        """
+        name = f"{group}.{name}"
+        if not self.wanted(name):
+            return
+        repeat = self.repeat or (max(3, repeat // 3) if self.quick else repeat)
+        for _ in range(warmup):
+            if setup is not None:
+                setup()
+            function()
+
+        times = []
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            function()
+            if finish is not None:
+                finish()
+            times.append(time.perf_counter() - start)
+
+        result = {
+            "name": name,
+            "group": group,
+            "params": params,
+            "repeat": repeat,
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.fmean(times),
+            "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+            "max": max(times),
+        }
+        self.results.append(result)
+        if self.verbose:
+            print(f"{name:<48} median {result['median'] * 1000:10.3f} ms  min {result['min'] * 1000:10.3f} ms",
+                  flush=True)
+
+def particles(count, seed=0):
+    """The same random cloud for a given count on every run."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    positions = rng.normal(scale=count ** (1 / 3), size=(count, 3)).astype(np.float32)
+    colors = rng.random((count, 3), dtype=np.float32)
+    return positions, colors
+
+def particle_widget(width, height, count, **kwargs):
+    from ipy_opengl_utils.particle_widget import ParticleWidget
+    widget = ParticleWidget(width, height, **kwargs)
+    if count:
+        positions, colors = particles(count)
+        widget.add_particles(positions, colors, update_cam=True)
+        widget.radius = 3.0 * count ** (1 / 3)
+        widget.camera.orbit(widget.center, radius=widget.radius, pitch=widget.pitch, yaw=widget.yaw)
+    return widget
+
+def gl_finish():
+    from OpenGL.GL import glFinish
+    glFinish()
+
+@benchmark("mesh")
+def bench_mesh(runner):
+    from ipy_opengl_utils.mesh_utils import generate_sphere_mesh, _sphere_mesh
+
+    for stacks in (8, 16, 32, 64, 128, 256):
+        # cleared before every run, or only the cache lookup would be timed
+        runner.run("mesh", f"generate_sphere_mesh[{stacks}x{stacks}]",
+                   lambda: generate_sphere_mesh(1.0, stacks, stacks), {"stacks": stacks, "slices": stacks},
+                   repeat=20, setup=_sphere_mesh.cache_clear)
+    runner.run("mesh", "generate_sphere_mesh[cached]", lambda: generate_sphere_mesh(1.0, 16, 16),
+               {"stacks": 16, "slices": 16}, repeat=100)
+
+@benchmark("add_particles")
+def bench_add_particles(runner):
+    sizes = (10_000, 100_000) if runner.quick else (10_000, 100_000, 1_000_000)
+    for total in sizes:
+        for batch in (1_000, 100_000):
+            if batch > total:
+                continue
+            positions, colors = particles(total)
+            for reserve in (False, True):
+                state = {}
+
+                def setup():
+                    if "widget" in state:
+                        state["widget"].close()
+                    state["widget"] = particle_widget(64, 64, 0)
+
+                def grow():
+                    widget = state["widget"]
+                    if reserve:
+                        widget.reserve_particles(total)
+                    for start in range(0, total, batch):
+                        widget.add_particles(positions[start:start + batch], colors[start:start + batch])
+                    widget.sync_instances()
+
+                name = f"grow[n={total},batch={batch}{',reserve' if reserve else ''}]"
+                runner.run("add_particles", name, grow, {"particles": total, "batch": batch, "reserve": reserve},
+                           repeat=5 if total < 1_000_000 else 3, setup=setup, finish=gl_finish)
+                if "widget" in state:
+                    state["widget"].close()
+
+@benchmark("pick")
+def bench_pick(runner):
+    import numpy as np
+    sizes = (1_000, 10_000, 100_000) if runner.quick else (1_000, 10_000, 100_000, 1_000_000)
+    cursor = np.random.default_rng(1).uniform(0.25, 0.75, size=(16, 2))
+
+    for count in sizes:
+        # gpu picking ray tests every particle on the CPU and draws only those under the cursor
+        modes = (("cpu", {}), ("cpu_grid", {"spatial_index": True}),
+                 ("gpu", {"pick_mode": "gpu", "render_mode": "impostor"}))
+        for mode, options in modes:
+            if not runner.wanted(f"pick.{mode}[n={count}]"):
+                continue
+            widget = particle_widget(400, 400, count, **options)
+            if mode == "cpu_grid":
+                # measure the grid even below the count where picks switch over to it
+                widget.SPATIAL_INDEX_MIN_PARTICLES = 0
+            widget.render_to_array()
+            points = cursor * (widget.width, widget.height)
+            state = {"i": 0}
+
+            # the pick itself: _pick_particle would also redraw whenever the selection changes
+            pick_at = widget._pick_particle_gpu if mode == "gpu" else widget._pick_particle_cpu
+
+            def pick():
+                x, y = points[state["i"] % len(points)]
+                state["i"] += 1
+                pick_at(x, y)
+
+            runner.run("pick", f"{mode}[n={count}]", pick, {"particles": count, "mode": mode},
+                       repeat=32, warmup=2)
+            widget.close()
+
+@benchmark("readback")
+def bench_readback(runner):
+    from ipy_opengl_utils.opengl_utils import (buffer_setup, delete_framebuffer, framebuffer_to_array,
+                                               framebuffer_to_image, FramebufferReader)
+
+    resolutions = ((640, 480), (1280, 720), (1920, 1080))
+    for width, height in resolutions:
+        fbo = buffer_setup(width, height)
+        reader = FramebufferReader(width, height)
+        params = {"width": width, "height": height}
+        runner.run("readback", f"framebuffer_to_array[{width}x{height}]",
+                   lambda: framebuffer_to_array(fbo, width, height), params, repeat=20)
+        runner.run("readback", f"framebuffer_to_array[{width}x{height},pbo]",
+                   lambda: framebuffer_to_array(fbo, width, height, reader), params, repeat=20)
+        runner.run("readback", f"framebuffer_to_image[{width}x{height}]",
+                   lambda: framebuffer_to_image(fbo, width, height, reader), params, repeat=10)
+        reader.delete()
+        delete_framebuffer(fbo)
+
+@benchmark("frame")
+def bench_frame(runner):
+    sizes = (1_000, 100_000) if runner.quick else (1_000, 100_000, 1_000_000)
+    resolutions = ((400, 400), (1280, 720))
+    for count in sizes:
+        for render_mode in ("mesh", "impostor"):
+            if count >= 1_000_000 and render_mode == "mesh":
+                # ~1.5G vertices per frame, minutes per run on a CPU rasterizer
+                continue
+            for width, height in resolutions:
+                name = f"draw[n={count},{render_mode},{width}x{height}]"
+                if not runner.wanted(f"frame.{name}"):
+                    continue
+                widget = particle_widget(width, height, count, render_mode=render_mode)
+                state = {"yaw": widget.yaw}
+
+                def frame():
+                    # orbit a little every frame so the delta encoder has changed tiles to send
+                    state["yaw"] += 1.0
+                    widget.camera.orbit(widget.center, radius=widget.radius, pitch=widget.pitch, yaw=state["yaw"])
+                    widget.draw()
+
+                runner.run("frame", name, frame, {"particles": count, "render_mode": render_mode, "width": width,
+                                                  "height": height}, repeat=10 if count < 1_000_000 else 3)
+                widget.close()
+
+def git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def environment():
+    import numpy as np
+    import OpenGL
+    from OpenGL.GL import glGetString, GL_VENDOR, GL_RENDERER, GL_VERSION
+    from ipy_opengl_utils.gl_context import context_stats
+
+    commit, dirty = git_revision()
+    contexts = context_stats()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pyopengl": OpenGL.__version__,
+        "machine": platform.machine(),
+        "system": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "lp_num_threads": os.environ.get("LP_NUM_THREADS"),
+        "gl_backend": contexts["contexts"][0]["backend"] if contexts["contexts"] else None,
+        "gl_vendor": glGetString(GL_VENDOR).decode(),
+        "gl_renderer": glGetString(GL_RENDERER).decode(),
+        "gl_version": glGetString(GL_VERSION).decode(),
+    }
+
+def compare(results, env, baseline, threshold, metric="median"):
+    """Prints the change of `metric` of every benchmark against `baseline`; returns the names that regressed."""
+    before = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    print(f"\n{'benchmark':<48}{'before ms':>12}{'after ms':>12}{'change':>9}")
+    for result in results:
+        old = before.get(result["name"])
+        if old is None:
+            continue
+        change = result[metric] / old[metric] - 1.0
+        flag = ""
+        if change > threshold:
+            regressions.append(result["name"])
+            flag = "  slower"
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{result['name']:<48}{old[metric] * 1000:12.3f}{result[metric] * 1000:12.3f}{change:+9.1%}{flag}")
+    if baseline.get("environment", {}).get("gl_renderer") != env["gl_renderer"]:
+        print("\nwarning: the baseline was measured on another renderer")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown counted as a regression (default 0.1)")
+    parser.add_argument("--metric", choices=("median", "min"), default="median", help="statistic compared")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this string")
+    parser.add_argument("--groups", nargs="+", choices=list(GROUPS), help="benchmark groups to run (default all)")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and fewer repeats")
+    parser.add_argument("--repeat", type=int, help="timed runs per benchmark, overriding the defaults")
+    parser.add_argument("--threads", type=int, help="llvmpipe rasterizer threads (LP_NUM_THREADS)")
+    args = parser.parse_args(argv)
+
+    if args.threads is not None:
+        os.environ["LP_NUM_THREADS"] = str(args.threads)
+
+    # one context for the whole run, shared by every widget
+    import ipy_opengl_utils.base_opengl_widget as base_opengl_widget
+    from ipy_opengl_utils.gl_context import create_context
+    base_opengl_widget.IP_GL_INIT = create_context()
+
+    env = environment()
+    print(f"{env['gl_renderer']} ({env['gl_backend']}), commit {env['commit']}{' (dirty)' if env['dirty'] else ''}\n",
+          flush=True)
+
+    runner = Runner(quick=args.quick, name_filter=args.filter, repeat=args.repeat)
+    for group, function in GROUPS.items():
+        if args.groups is None or group in args.groups:
+            function(runner)
+
+    report = {"schema": SCHEMA, "environment": env, "quick": args.quick, "results": runner.results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(runner.results, env, baseline, args.threshold, args.metric):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,9 @@
 # This file initializes the package and can be used to define what is exported when the package is imported.
 
+# Choose the PyOpenGL platform (native, EGL or OSMesa) before any submodule imports OpenGL
+from ipy_opengl_utils.gl_context import select_platform
+select_platform()
+
 __all__ = [
     "base_opengl_widget",
     "particle_widget",
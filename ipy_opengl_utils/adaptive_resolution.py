@@ -0,0 +1,55 @@
+class ResolutionController:
+    """
+    Picks the render scale of interactive frames (drags, zooms) from how long they
+    take. `scales` runs from full resolution down, e.g. (1.0, 0.5, 0.25).
+
+    Frame times are smoothed per frame; once the average exceeds `frame_budget` the
+    next coarser scale is used. Going back to a finer scale happens when the
+    average, scaled by the pixel ratio, predicts a frame well within the budget
+    (`upgrade_margin`), which keeps the choice from oscillating. The chosen scale is
+    kept between interactions, so the next drag starts where the last one settled.
+    """
+
+    def __init__(self, scales=(1.0, 0.5, 0.25), frame_budget=1 / 30, upgrade_margin=0.6, smoothing=0.5):
+        self.scales = tuple(sorted(scales, reverse=True))
+        self.frame_budget = frame_budget
+        self.upgrade_margin = upgrade_margin
+        self.smoothing = smoothing
+
+        self.level = 0
+        self.average = None
+        self.changes = 0
+
+    @property
+    def scale(self):
+        return self.scales[self.level]
+
+    def update(self, frame_time):
+        """Records the duration of an interactive frame at the current scale; returns the scale for the next one."""
+        if self.average is None:
+            self.average = frame_time
+        else:
+            self.average = self.smoothing * self.average + (1 - self.smoothing) * frame_time
+
+        if self.average > self.frame_budget and self.level < len(self.scales) - 1:
+            self._set_level(self.level + 1)
+        elif self.level > 0:
+            # not every cost grows with the pixel count, so this overestimates: fine for upgrading
+            finer = self.scales[self.level - 1]
+            predicted = self.average * (finer / self.scale) ** 2
+            if predicted < self.frame_budget * self.upgrade_margin:
+                self._set_level(self.level - 1)
+        return self.scale
+
+    def _set_level(self, level):
+        self.level = level
+        # the history of the old scale says little about the new one
+        self.average = None
+        self.changes += 1
+
+    def reset(self):
+        self.level = 0
+        self.average = None
+
+    def stats(self):
+        return {"scale": self.scale, "average_frame_time": self.average or 0.0, "changes": self.changes}
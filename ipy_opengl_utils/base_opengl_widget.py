@@ -1,12 +1,27 @@
 from ipywidgets import DOMWidget
 from ipywidgets import Image as IPyImage
-from traitlets import Unicode, Int, Bytes, observe
+from traitlets import Unicode, Int, Bytes, Bool, Dict, observe
 from OpenGL.GL import *
+import sys
+import time
+import contextlib
+import logging
 import numpy as np
 from PIL import Image
 from IPython.display import display
-from ipycanvas import Canvas
-from ipy_opengl_utils.opengl_utils import open_hidden_window, buffer_setup, framebuffer_to_image, framebuffer_to_array
+from ipycanvas import Canvas, hold_canvas
+from ipy_opengl_utils.opengl_utils import (buffer_setup, multisample_buffer_setup, delete_framebuffer,
+                                           framebuffer_depth, FramebufferReader)
+from ipy_opengl_utils.gl_context import create_context, context_stats
+from ipy_opengl_utils.frame_encoders import get_encoder, encode_pool
+from ipy_opengl_utils.frame_diff import TileDiffer
+from ipy_opengl_utils.redraw_scheduler import RedrawScheduler, running_loop
+from ipy_opengl_utils.gl_state import gl_state
+from ipy_opengl_utils.gpu_resources import gpu_resources, owns_gl_objects
+from ipy_opengl_utils.profiling import FrameProfiler
+from ipy_opengl_utils.adaptive_resolution import ResolutionController
+
+logger = logging.getLogger(__name__)
 
 IP_GL_INIT = None
 
@@ -22,61 +37,467 @@ class BaseOpenglWidget(DOMWidget):
     # Widget properties as traitlets to sync with frontend
     width = Int(400).tag(sync=True)
     height = Int(400).tag(sync=True)
-    value = Bytes(b'').tag(sync=True)  # Holds PNG image data
+    value = Bytes(b'').tag(sync=True)  # Holds the encoded frame (PNG by default)
+
+    # Encode every frame into `value`; off by default, since only the canvas is shown.
+    # encoded_frame() still produces the bytes on demand
+    encode_value = Bool(False)
+
+    # Per-stage frame timings (see get_stats()["profile"]), published to the frontend
+    # at most once per second while `publish_profile` is set
+    frame_profile = Dict().tag(sync=True)
+    publish_profile = Bool(False)
+    # Draws the p50/p95 of each stage over the top left corner of the canvas
+    profile_overlay = Bool(False)
+
+    def __init__(self, width=400, height=400, readback_latency=1, encoder="png", encoder_options=None,
+                 delta_frames=True, tile_size=64, target_fps=60, gpu_timing=False, adaptive_resolution=True,
+                 interaction_scales=(1.0, 0.5, 0.25), refine_samples=0, **kwargs):
+        self.reader = None
+        self.fbo = None
+        self.gl = None
+        self.gl_ready = False
+        self.render_state = {
+            "capabilities": {GL_DEPTH_TEST: True, GL_CULL_FACE: True, GL_BLEND: True, GL_SCISSOR_TEST: False},
+            "cull_face": (GL_BACK,),
+            "front_face": (GL_CCW,),
+            "blend_func": (GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA),
+        }
+        self.readback_latency = readback_latency
+
+        # Framebuffer the frame is drawn into and its size, see render_target
+        self.draw_fbo = None
+        self.render_scale = 1.0
+        self.render_samples = 0
+        self.render_width = width
+        self.render_height = height
+        self._scaled_targets = {}  # scale -> (fbo, reader, width, height)
+        self._multisample_target = None  # (fbo, samples)
+        self._scaled_canvas = None
+
+        # While the user drags or zooms (see mark_interaction), frames render at a scale
+        # picked from their duration and the canvas upscales them; once idle, one full
+        # resolution frame, multisampled with refine_samples, replaces them
+        self.adaptive_resolution = adaptive_resolution
+        self.resolution = ResolutionController(interaction_scales, frame_budget=1 / target_fps)
+        self.refine_samples = refine_samples
+        self.interacting = False
+        self._refined = True
+
+        # CPU time of every stage of the frame, plus GPU time from timer queries with gpu_timing
+        self.profiler = FrameProfiler(gpu=gpu_timing)
+        self._profile_published = 0.0
+
+        # Sends only the tiles that changed since the previous frame to the canvas
+        self.frame_differ = TileDiffer(tile_size) if delta_frames else None
+
+        # Redraws requested from event handlers are coalesced and rendered on the event loop
+        self.scheduler = RedrawScheduler(self.render_frame, frame_budget=1 / target_fps, on_idle=self._on_idle)
+
+        # Latest frame and the state of its asynchronous encoding
+        self._frame = None
+        self._frame_id = 0
+        self._encoded = (0, b'')
+        self._encode_inflight = False
+        self._encode_next = None
+        self.set_encoder(encoder, **(encoder_options or {}))
 
-    def __init__(self, width=400, height=400, **kwargs):
         super().__init__(**kwargs)
         self.width = width
         self.height = height
 
-        self.image_widget = IPyImage(format='png', width=self.width, height=self.height, description='OpenGL Output')
+        self.image_widget = IPyImage(format=self.encoder.format if self.encoder.format != 'raw' else 'png',
+                                     width=self.width, height=self.height, description='OpenGL Output')
         self.canvas = Canvas(width=width, height=height)
 
+        # Nothing touches GL yet: the context, the framebuffer and the first frame are
+        # created when the widget is first displayed or drawn, see ensure_gl
+
+    def ensure_gl(self):
+        """
+        Creates the widget's GL resources on first use: the shared context if there
+        is none yet, the framebuffer (GL_setup) and whatever init_gl builds.
+        """
+        if self.gl_ready:
+            return
         self.GL_setup()
-        self.update_image()
+        self.gl_ready = True
+        self.init_gl()
 
+    def init_gl(self):
+        """GL resources of a subclass (programs, meshes...), built once by ensure_gl."""
+        pass
+
+    @owns_gl_objects
     def GL_setup(self):
         global IP_GL_INIT
         if not IP_GL_INIT:
-            IP_GL_INIT = open_hidden_window()
+            # GLFW with a display, otherwise EGL or OSMesa; see gl_context
+            IP_GL_INIT = create_context()
         
-        self.fbo = buffer_setup(self.width, self.height)
+        self.gl = gl_state()
+        self.profiler.owner = self.resource_owner
+        # called again on every resize: free the framebuffers of the old size first
+        self._delete_render_targets()
+        if self.fbo is not None:
+            delete_framebuffer(self.fbo)
+        self.fbo = buffer_setup(self.width, self.height, self._fbo_attachments())
+
+        # PBO ring used for every readback of this widget
+        if self.reader is None:
+            self.reader = FramebufferReader(self.width, self.height, buffers=3, latency=self.readback_latency,
+                                            profiler=self.profiler)
+        else:
+            self.reader.resize(self.width, self.height)
 
-        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        # Widgets share one context, so each keeps its own render state and applies
+        # it before drawing; the state cache skips whatever is already set
+        self._use_render_target(1.0, 0)
+        self.bind_render_state()
 
-        glViewport(0, 0, self.width, self.height)
+    def bind_render_state(self):
+        """Binds the framebuffer the widget draws into and applies its render state."""
+        self.gl.bind_framebuffer(self.draw_fbo)
+        self.gl.apply(self.render_state)
 
-        glEnable(GL_DEPTH_TEST)
-        glEnable(GL_CULL_FACE)
-        glCullFace(GL_BACK)
+    @contextlib.contextmanager
+    def render_target(self, scale=1.0, samples=0):
+        """
+        Draws inside the block go to a framebuffer `scale` times the widget size
+        (render_width x render_height), or to a full size one with `samples`
+        samples per pixel; read_frame reads them back.
+        """
+        self.ensure_gl()
+        previous = (self.render_scale, self.render_samples)
+        self._use_render_target(scale, samples)
+        try:
+            yield
+        finally:
+            self._use_render_target(*previous)
 
-        glEnable(GL_BLEND)
-        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+    def _use_render_target(self, scale, samples):
+        if scale != 1.0:
+            fbo, _, width, height = self._scaled_target(scale)
+            samples = 0
+        elif samples:
+            fbo, width, height = self._multisampled_fbo(samples), self.width, self.height
+        else:
+            fbo, width, height = self.fbo, self.width, self.height
+        self.draw_fbo = fbo
+        self.render_scale = scale
+        self.render_samples = samples
+        self.render_width = width
+        self.render_height = height
+        self.render_state["viewport"] = (0, 0, width, height)
 
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    @owns_gl_objects
+    def _scaled_target(self, scale):
+        target = self._scaled_targets.get(scale)
+        if target is None:
+            width = max(1, round(self.width * scale))
+            height = max(1, round(self.height * scale))
+            target = (buffer_setup(width, height), FramebufferReader(width, height, buffers=1, profiler=self.profiler),
+                      width, height)
+            self._scaled_targets[scale] = target
+        return target
+
+    @owns_gl_objects
+    def _multisampled_fbo(self, samples):
+        if self._multisample_target is None or self._multisample_target[1] != samples:
+            if self._multisample_target is not None:
+                delete_framebuffer(self._multisample_target[0])
+            self._multisample_target = (multisample_buffer_setup(self.width, self.height, samples), samples)
+        return self._multisample_target[0]
+
+    def _delete_render_targets(self):
+        for fbo, reader, _, _ in self._scaled_targets.values():
+            reader.delete()
+            delete_framebuffer(fbo)
+        self._scaled_targets = {}
+        if self._multisample_target is not None:
+            delete_framebuffer(self._multisample_target[0])
+            self._multisample_target = None
+
+    def read_frame(self, now=False):
+        """
+        Reads back the frame drawn into the current render target, resolving
+        multisampling first. Full resolution frames go through the readback
+        pipeline (see FramebufferReader.read) unless `now`.
+        """
+        if self.render_scale != 1.0:
+            fbo, reader, _, _ = self._scaled_targets[self.render_scale]
+            return reader.read_now(fbo)
+        if self.render_samples:
+            self.gl.blit_framebuffer(self.draw_fbo, self.fbo, self.width, self.height)
+            return self.reader.read_now(self.fbo)
+        return self.reader.read_now(self.fbo) if now else self.reader.read(self.fbo)
+
+    def frame_depth(self):
+        """
+        Depth of the frame being drawn as a (render_height, render_width) float32
+        array, bottom row first; the render target stays bound.
+        """
+        fbo = self.draw_fbo
+        if self.render_samples:
+            # multisampled depth can't be read directly, resolve it into the widget's framebuffer
+            self.gl.blit_framebuffer(self.draw_fbo, self.fbo, self.width, self.height, GL_DEPTH_BUFFER_BIT)
+            fbo = self.fbo
+        depth = framebuffer_depth(fbo, self.render_width, self.render_height)
+        self.gl.bind_framebuffer(self.draw_fbo)
+        return depth
     
+    def _fbo_attachments(self):
+        # Extra color attachments for the widget's framebuffer, see opengl_utils.buffer_setup
+        return ()
+
+    def set_encoder(self, encoder="png", **options):
+        """
+        Selects how frames are encoded into `value`: "raw" (RGBA bytes), "png"
+        (compress_level), "jpeg"/"webp" (quality), or a FrameEncoder instance.
+        """
+        self.encoder = get_encoder(encoder, **options)
+        self._encoded = (0, b'')
+
     def update_image(self):
-        buffer = framebuffer_to_image(self.fbo, self.width, self.height)
-        array = framebuffer_to_array(self.fbo, self.width, self.height)
-        self.value = buffer.getvalue()
+        # A single readback feeds both the canvas and the encoder
+        self.ensure_gl()
+        self._present_frame(self.read_frame(now=True))
+
+    def _present_frame(self, frame):
+        if frame.shape[:2] != (self.height, self.width):
+            self._present_scaled(frame)
+            return
+        self._frame = frame
+        self._frame_id += 1
+
+        profiler = self.profiler
+        with profiler.stage("frame_diff"):
+            rects = self.frame_differ.diff(frame) if self.frame_differ is not None else None
         try:
-            self.canvas.clear()
-            self.canvas.put_image_data(array, 0, 0)
+            with profiler.stage("canvas"):
+                if rects is None:
+                    self.canvas.put_image_data(frame, 0, 0)
+                elif rects:
+                    # one comm message for all changed tiles
+                    with hold_canvas(self.canvas):
+                        for x, y, patch in rects:
+                            self.canvas.put_image_data(patch, x, y)
+                if self.profile_overlay:
+                    self._draw_profile_overlay()
         except AttributeError:
             pass
 
+        if self.encode_value:
+            self._submit_encode(frame, self._frame_id)
+
+    def _present_scaled(self, frame):
+        # A reduced resolution interactive frame: drawn into a small canvas that the
+        # visible one scales up. It isn't encoded, and the next full frame is sent whole
+        if self.frame_differ is not None:
+            self.frame_differ.reset()
+        height, width = frame.shape[:2]
+        try:
+            with self.profiler.stage("canvas"):
+                if self._scaled_canvas is None:
+                    self._scaled_canvas = Canvas(width=width, height=height)
+                elif (self._scaled_canvas.width, self._scaled_canvas.height) != (width, height):
+                    self._scaled_canvas.width = width
+                    self._scaled_canvas.height = height
+                with hold_canvas(self.canvas):
+                    self._scaled_canvas.put_image_data(frame, 0, 0)
+                    self.canvas.draw_image(self._scaled_canvas, 0, 0, self.width, self.height)
+                    if self.profile_overlay:
+                        self._draw_profile_overlay()
+        except AttributeError:
+            pass
+
+    def _submit_encode(self, frame, frame_id):
+        if self._encode_inflight:
+            # Coalesce: only the newest frame waiting behind the running encode is kept
+            self._encode_next = (frame, frame_id)
+            return
+        self._encode_inflight = True
+
+        loop = running_loop()
+        future = encode_pool().submit(self._encode, frame)
+
+        def done(future):
+            try:
+                data = future.result()
+            except Exception as error:
+                callback, args = self._encode_failed, (frame_id, error)
+            else:
+                callback, args = self._apply_encoded, (frame_id, data)
+            if loop is not None and loop.is_running():
+                loop.call_soon_threadsafe(callback, *args)
+            else:
+                callback(*args)
+
+        future.add_done_callback(done)
+
+    def _encode(self, frame):
+        # runs in the encoder pool, so it shows up on that thread's track of a trace
+        start = time.perf_counter()
+        data = self.encoder.encode(frame)
+        self.profiler.record("encode", start, time.perf_counter())
+        return data
+
+    def _apply_encoded(self, frame_id, data):
+        self._encode_inflight = False
+        if frame_id > self._encoded[0]:
+            self._encoded = (frame_id, data)
+            self.value = data
+        self._submit_next_encode()
+
+    def _encode_failed(self, frame_id, error):
+        # `value` keeps the last good frame; the next one gets its own chance
+        logger.error("Encoding frame %d failed", frame_id, exc_info=error)
+        self._encode_inflight = False
+        self._submit_next_encode()
+
+    def _submit_next_encode(self):
+        if self._encode_next is not None:
+            frame, next_id = self._encode_next
+            self._encode_next = None
+            self._submit_encode(frame, next_id)
+
+    def encoded_frame(self):
+        """Encoded bytes of the latest frame, encoding it now if it was skipped."""
+        if self._frame is None:
+            return b''
+        if self._encoded[0] != self._frame_id:
+            self._encoded = (self._frame_id, self.encoder.encode(self._frame))
+        return self._encoded[1]
+
+    def render_frame(self):
+        """Draws and presents one frame; called by the redraw scheduler."""
+        # reduced resolution needs the idle callback of the event loop to be refined
+        adapting = self.interacting and self.adaptive_resolution and running_loop() is not None
+        scale = self.resolution.scale if adapting else 1.0
+        samples = 0 if adapting else self.refine_samples
+        start = time.perf_counter()
+        with self.profiler.frame(), self.render_target(scale, samples):
+            self._draw_frame()
+        if adapting:
+            self.resolution.update(time.perf_counter() - start)
+        self._refined = not adapting or (scale == 1.0 and not self.refine_samples)
+        if running_loop() is None and self.reader is not None and self.reader.pending:
+            # no idle callback will follow to show the frame still in flight
+            self._present_frame(self.reader.flush())
+        self._publish_profile()
+
+    def _draw_frame(self):
+        self.draw()
+        self.update_image()
+
+    def mark_interaction(self):
+        """Flags the coming frames as interactive (drag, zoom...) until the widget goes idle."""
+        self.interacting = True
+
+    def request_draw(self):
+        """Asks for a redraw of the latest state, coalesced with other pending requests."""
+        if not self.gl_ready:
+            # never shown: the first display renders the latest state anyway
+            return
+        self.scheduler.invalidate()
+
+    def _on_idle(self):
+        self.interacting = False
+        # Frames still in the readback pipeline would otherwise never be shown
+        if self.reader is not None and self.reader.pending:
+            self._present_frame(self.reader.flush())
+
+        if not self._refined and self.gl_ready and self.fbo is not None:
+            # one full quality frame replaces the interactive ones
+            with self.profiler.frame(), self.render_target(1.0, self.refine_samples):
+                self._draw_frame()
+            self._refined = True
+
+    def _publish_profile(self):
+        if self.publish_profile and time.monotonic() - self._profile_published >= 1.0:
+            self._profile_published = time.monotonic()
+            self.frame_profile = self.profiler.stats()
+
+    def _draw_profile_overlay(self):
+        stats = self.profiler.stats()
+        lines = [f"{name:<13}{s['p50']:7.2f}{s['p95']:7.2f} ms" for name, s in stats["cpu"].items()]
+        lines += [f"gpu {name:<9}{s['p50']:7.2f}{s['p95']:7.2f} ms" for name, s in stats.get("gpu", {}).items()]
+        lines.insert(0, f"{'stage':<13}{'p50':>7}{'p95':>7}")
+
+        canvas = self.canvas
+        with hold_canvas(canvas):
+            canvas.fill_style = "rgba(0, 0, 0, 0.7)"
+            canvas.fill_rect(0, 0, 220, 14 * len(lines) + 6)
+            canvas.fill_style = "white"
+            canvas.font = "11px monospace"
+            for i, line in enumerate(lines):
+                canvas.fill_text(line, 4, 14 * (i + 1))
+
+    @observe('profile_overlay')
+    def _on_profile_overlay(self, change):
+        # the tiles under a removed overlay only change if the whole frame is resent
+        if self.frame_differ is not None:
+            self.frame_differ.reset()
+        self.request_draw()
+
+    def trace(self, path):
+        """
+        Context manager writing every frame rendered inside it to `path` as Chrome
+        trace JSON: `with widget.trace("frames.json"): ...`
+        """
+        return self.profiler.trace(path)
+
+    def get_stats(self):
+        """Counters of the frame pipeline, grouped by stage."""
+        stats = {"scheduler": self.scheduler.stats(), "context": context_stats(), "profile": self.profiler.stats()}
+        if self.adaptive_resolution:
+            stats["resolution"] = self.resolution.stats()
+        if self.gl_ready:
+            stats["gl_state"] = self.gl.stats()
+            stats["gpu_memory"] = gpu_resources().stats(self.resource_owner)
+        if self.frame_differ is not None:
+            stats["frame_diff"] = self.frame_differ.stats()
+        return stats
+
     def draw(self, clear_color=(1,1,1,1)):
-        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
-        glClearColor(*clear_color)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        self.ensure_gl()
+        with self.profiler.stage("clear", gpu=True):
+            self.bind_render_state()
+            self.gl.clear_color(*clear_color)
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+    def close(self):
+        """Frees the widget's GL objects, then closes the widget."""
+        self.release_gl_objects()
+        super().close()
+
+    def release_gl_objects(self):
+        """
+        Deletes every GL object the widget still owns; it can't draw afterwards.
+        Called by close(), which ipywidgets also calls when the widget is collected.
+        """
+        if self.__dict__.get("fbo") is None or sys.is_finalizing():
+            return
+        self.scheduler.cancel()
+        self.profiler.delete()
+        gpu_resources().release_owner(self.resource_owner)
+        self.fbo = None
+        self.reader = None
+        self.draw_fbo = None
+        self._scaled_targets = {}
+        self._multisample_target = None
 
     @observe('width', 'height')
     def _on_size_change(self, change):
-        # React to width/height changes
-        self.GL_setup()
-        self.update_image()
+        # React to width/height changes; before the first draw there is nothing to resize
+        if self.gl_ready:
+            self.GL_setup()
+            self.update_image()
 
     def _ipython_display_(self):
-        self.draw()
-        self.update_image()
+        # the first display is what creates the GL resources
+        self.render_frame()
+        if self.reader.pending:
+            # with a readback latency the frame is still in flight
+            self._present_frame(self.reader.flush())
         display(self.canvas)
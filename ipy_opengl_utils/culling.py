@@ -0,0 +1,115 @@
+import numpy as np
+from ipy_opengl_utils.spatial_index import ClusterGrid
+from ipy_opengl_utils.math_utils import frustum_planes, aabb_frustum_test, spheres_in_frustum, view_projection
+
+def build_depth_pyramid(depth):
+    """
+    Hierarchical max-depth pyramid of a (height, width) depth image: every level
+    halves the resolution and keeps the farthest depth of each 2x2 block.
+    """
+    levels = [depth]
+    while max(levels[-1].shape) > 1:
+        d = levels[-1]
+        h, w = d.shape
+        # pad with the far plane so borders never make anything look occluded
+        d = np.pad(d, ((0, h % 2), (0, w % 2)), constant_values=1.0)
+        levels.append(d.reshape(d.shape[0] // 2, 2, d.shape[1] // 2, 2).max(axis=(1, 3)))
+    return levels
+
+class ParticleCuller:
+    """
+    View-frustum and optional occlusion culling of particle instances over a
+    ClusterGrid, which is rebuilt whenever the particle data changes.
+
+    Frustum culling classifies cluster boxes against the camera frustum; particles
+    of clusters straddling a plane are tested individually. Occlusion culling is
+    two-phase: clusters that were visible last frame are drawn first, the depth
+    buffer they produced is reduced to a max-depth pyramid, and the remaining
+    clusters are only drawn if their box is not entirely behind it. Everything
+    tested is re-classified, so the visible set follows the camera.
+    """
+
+    def __init__(self, particles_per_cell=64, occlusion=False):
+        self.grid = ClusterGrid(particles_per_cell)
+        self.occlusion = occlusion
+        self._grid_key = None
+
+        # clusters found visible in the last occlusion-culled frame
+        self.visible_cells = None
+
+        self.stats = {
+            "particles": 0,
+            "visible_instances": 0,
+            "cells": 0,
+            "frustum_cells": 0,
+            "occluded_cells": 0,
+        }
+
+    def update(self, positions, radius, key):
+        """Rebuilds the cluster grid when `key` (e.g. the data version) changes."""
+        if key != self._grid_key:
+            self.grid.build(positions, radius)
+            self._grid_key = key
+            self.visible_cells = None
+        self.stats["particles"] = len(positions)
+        self.stats["cells"] = len(self.grid)
+
+    def frustum_cells(self, camera):
+        """Returns (planes, classification) with -1/0/1 for outside/straddling/inside per cluster."""
+        planes = frustum_planes(camera)
+        classes = aabb_frustum_test(planes, self.grid.box_min, self.grid.box_max)
+        self.stats["frustum_cells"] = int(np.count_nonzero(classes >= 0))
+        return planes, classes
+
+    def particles(self, cells, classes, planes, positions, radius):
+        """Particle indices of the selected clusters that lie in the frustum."""
+        inside = self.grid.particles(cells & (classes == 1))
+        straddling = self.grid.particles(cells & (classes == 0))
+        if len(straddling):
+            r = radius if np.isscalar(radius) else np.asarray(radius)[straddling]
+            straddling = straddling[spheres_in_frustum(planes, positions[straddling], r)]
+        return np.concatenate((inside, straddling))
+
+    def occluded(self, cells, depth_pyramid, camera, viewport):
+        """
+        Boolean mask over `cells` (index array) of the clusters whose box lies
+        entirely behind the depth pyramid. Conservative: boxes crossing the near
+        plane or the viewport edges are never reported as occluded.
+        """
+        width, height = viewport
+        box_min, box_max = self.grid.box_min[cells], self.grid.box_max[cells]
+
+        # the 8 corners of every box, projected
+        select = np.array([[i & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)], dtype=bool)
+        corners = np.where(select[None], box_max[:, None, :], box_min[:, None, :])
+        clip = np.concatenate((corners, np.ones(corners.shape[:2] + (1,))), axis=-1) @ view_projection(camera).T
+
+        w = clip[..., 3]
+        in_front = np.all(w > 1e-6, axis=1)
+        ndc = clip[..., :3] / np.where(w > 1e-6, w, 1.0)[..., None]
+
+        x0 = np.floor((ndc[..., 0].min(axis=1) * 0.5 + 0.5) * width)
+        x1 = np.floor((ndc[..., 0].max(axis=1) * 0.5 + 0.5) * width)
+        y0 = np.floor((ndc[..., 1].min(axis=1) * 0.5 + 0.5) * height)
+        y1 = np.floor((ndc[..., 1].max(axis=1) * 0.5 + 0.5) * height)
+        nearest = ndc[..., 2].min(axis=1) * 0.5 + 0.5
+
+        testable = in_front & (x0 >= 0) & (y0 >= 0) & (x1 < width) & (y1 < height)
+        x0, x1, y0, y1 = (np.clip(a, 0, None).astype(np.int64) for a in (x0, x1, y0, y1))
+
+        # pick the level where the rectangle spans at most 2x2 texels
+        size = np.maximum(np.maximum(x1 - x0, y1 - y0), 1)
+        levels = np.minimum(np.ceil(np.log2(size)).astype(np.int64), len(depth_pyramid) - 1)
+
+        farthest = np.ones(len(cells), dtype=np.float32)
+        for level in np.unique(levels[testable]):
+            sel = testable & (levels == level)
+            d = depth_pyramid[level]
+            h, w_ = d.shape
+            lx0 = np.minimum(x0[sel] >> level, w_ - 1)
+            lx1 = np.minimum(x1[sel] >> level, w_ - 1)
+            ly0 = np.minimum(y0[sel] >> level, h - 1)
+            ly1 = np.minimum(y1[sel] >> level, h - 1)
+            farthest[sel] = np.maximum.reduce([d[ly0, lx0], d[ly0, lx1], d[ly1, lx0], d[ly1, lx1]])
+
+        return testable & (nearest > farthest)
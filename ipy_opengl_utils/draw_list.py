@@ -0,0 +1,69 @@
+from OpenGL.GL import *
+import numpy as np
+from ipy_opengl_utils.instance_buffer import InstanceBuffer
+
+class InstanceDrawList:
+    """
+    Compacted, reordered copy of the instance attributes used when only some of the
+    particles are drawn, or when they are drawn in several batches (one per LOD mesh).
+
+    `build` gathers the selected particles so that each group is contiguous and
+    uploads them along with their original indices, which the vertex shader passes
+    on in place of gl_InstanceID so selection and ID picking keep working. A build
+    with the same `key` as the previous one is skipped.
+    """
+
+    def __init__(self, position_components=3, color_components=3, color_dtype=np.float32, color_normalized=False):
+        # same layout as the source buffers; rebuilt wholesale, so always re-specify
+        # instead of sub-range updates
+        self.positions = InstanceBuffer(position_components, np.float32, orphan_threshold=0.0, usage=GL_STREAM_DRAW)
+        self.colors = InstanceBuffer(color_components, color_dtype, orphan_threshold=0.0, usage=GL_STREAM_DRAW,
+                                     normalized=color_normalized)
+        self.ids = InstanceBuffer(1, np.int32, orphan_threshold=0.0, usage=GL_STREAM_DRAW)
+
+        self.groups = []
+        self._key = None
+        self.builds = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def invalidate(self):
+        self._key = None
+
+    def is_current(self, key):
+        return key is not None and key == self._key
+
+    def build(self, order, groups, positions, colors, key=None):
+        """
+        `order` lists the particle indices to draw, `groups` is a list of
+        (group, start, count) ranges into it, e.g. one per LOD level.
+        """
+        self._key = key
+        self.groups = groups
+        self.positions.set_data(positions[order])
+        self.colors.set_data(colors[order])
+        self.ids.set_data(order.astype(np.int32))
+        self.builds += 1
+        return self.positions.sync() + self.colors.sync() + self.ids.sync()
+
+    def bind(self, vao, first=0, locations=(1, 2, 3)):
+        """Points the instance attributes of `vao` at the draw list, starting at `first`."""
+        for buffer, location in zip((self.positions, self.colors, self.ids), locations):
+            buffer.bind_attribute(vao, location, divisor=1, first=first)
+
+    def delete(self):
+        for buffer in (self.positions, self.colors, self.ids):
+            buffer.delete()
+
+def group_by_level(levels, count):
+    """
+    Stable sort of instance indices by level in [0, count).
+    Returns (order, groups) in the format expected by InstanceDrawList.build.
+    """
+    # NumPy radix-sorts small integer types when asked for a stable sort
+    order = np.argsort(levels.astype(np.uint8), kind='stable')
+    sizes = np.bincount(levels, minlength=count)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    groups = [(level, int(start), int(size)) for level, (start, size) in enumerate(zip(starts, sizes)) if size]
+    return order, groups
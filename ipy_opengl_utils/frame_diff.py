@@ -0,0 +1,77 @@
+import numpy as np
+
+class TileDiffer:
+    """
+    Splits frames into square tiles and reports which ones changed since the
+    previous frame, so only those need to be sent to the canvas.
+
+    `diff` returns a list of (x, y, patch) rectangles, where horizontally adjacent
+    changed tiles are merged into one patch, or None when the whole frame should
+    be sent instead: on the first frame, after a size change, or once more than
+    `full_frame_threshold` of the tiles changed.
+    """
+
+    def __init__(self, tile_size=64, full_frame_threshold=0.5):
+        self.tile_size = tile_size
+        self.full_frame_threshold = full_frame_threshold
+        self.previous = None
+
+        self.frames = 0
+        self.full_frames = 0
+        self.tiles_sent = 0
+        self.bytes_sent = 0
+
+    def reset(self):
+        """Forgets the previous frame, forcing the next one to be sent in full."""
+        self.previous = None
+
+    def changed_tiles(self, frame, previous):
+        """Boolean (tile_rows, tile_cols) mask of the tiles that differ between two frames."""
+        t = self.tile_size
+        height, width, channels = frame.shape
+        rows, cols = -(-height // t), -(-width // t)
+
+        # compare as flat byte rows; reducing over a length-3 channel axis is far slower
+        changed = np.zeros((rows * t, cols * t * channels), dtype=bool)
+        np.not_equal(frame.reshape(height, -1), previous.reshape(height, -1), out=changed[:height, :width * channels])
+        return changed.reshape(rows, t, cols, t * channels).any(axis=(1, 3))
+
+    def diff(self, frame):
+        self.frames += 1
+        previous, self.previous = self.previous, frame
+
+        if previous is None or previous.shape != frame.shape:
+            return self._full(frame)
+
+        tiles = self.changed_tiles(frame, previous)
+        if tiles.mean() > self.full_frame_threshold:
+            return self._full(frame)
+
+        t = self.tile_size
+        height, width = frame.shape[:2]
+        rects = []
+        for row in np.flatnonzero(tiles.any(axis=1)):
+            # runs of consecutive changed tiles within the row
+            line = np.concatenate(([False], tiles[row], [False]))
+            edges = np.flatnonzero(line[1:] != line[:-1])
+            for start, stop in zip(edges[::2], edges[1::2]):
+                x0, x1 = start * t, min(stop * t, width)
+                y0, y1 = row * t, min((row + 1) * t, height)
+                patch = frame[y0:y1, x0:x1]
+                rects.append((int(x0), int(y0), patch))
+                self.tiles_sent += int(stop - start)
+                self.bytes_sent += patch.nbytes
+        return rects
+
+    def _full(self, frame):
+        self.full_frames += 1
+        self.bytes_sent += frame.nbytes
+        return None
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "full_frames": self.full_frames,
+            "tiles_sent": self.tiles_sent,
+            "bytes_sent": self.bytes_sent,
+        }
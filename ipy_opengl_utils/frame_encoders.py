@@ -0,0 +1,83 @@
+import io
+import os
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+_ENCODE_POOL = None
+
+def encode_pool():
+    """Process-wide thread pool used for frame encoding (zlib/libjpeg release the GIL)."""
+    global _ENCODE_POOL
+    if _ENCODE_POOL is None:
+        _ENCODE_POOL = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="frame-encode")
+    return _ENCODE_POOL
+
+class FrameEncoder:
+    """Turns a (height, width, 3) uint8 frame into bytes. `format` names the output."""
+    format = None
+
+    def encode(self, frame):
+        raise NotImplementedError
+
+class RawEncoder(FrameEncoder):
+    """Uncompressed RGBA bytes, row-major, top row first."""
+    format = "raw"
+
+    def encode(self, frame):
+        rgba = np.empty(frame.shape[:2] + (4,), dtype=np.uint8)
+        rgba[..., :3] = frame
+        rgba[..., 3] = 255
+        return rgba.tobytes()
+
+class PILEncoder(FrameEncoder):
+    """Encodes through Pillow with the given save() options."""
+    pil_format = None
+
+    def __init__(self, **options):
+        self.options = options
+
+    def encode(self, frame):
+        buffer = io.BytesIO()
+        Image.fromarray(frame).save(buffer, format=self.pil_format, **self.options)
+        return buffer.getvalue()
+
+class PNGEncoder(PILEncoder):
+    format = "png"
+    pil_format = "PNG"
+
+    def __init__(self, compress_level=1):
+        # zlib level 1 is several times faster than Pillow's default of 6 for a small size cost
+        super().__init__(compress_level=compress_level)
+
+class JPEGEncoder(PILEncoder):
+    format = "jpeg"
+    pil_format = "JPEG"
+
+    def __init__(self, quality=85):
+        super().__init__(quality=quality)
+
+class WebPEncoder(PILEncoder):
+    format = "webp"
+    pil_format = "WEBP"
+
+    def __init__(self, quality=80, method=0):
+        # method 0 is the fastest WebP effort level
+        super().__init__(quality=quality, method=method)
+
+ENCODERS = {
+    "raw": RawEncoder,
+    "png": PNGEncoder,
+    "jpeg": JPEGEncoder,
+    "jpg": JPEGEncoder,
+    "webp": WebPEncoder,
+}
+
+def get_encoder(encoder="png", **options):
+    """Returns an encoder instance from a FrameEncoder or a name in ENCODERS plus its options."""
+    if isinstance(encoder, FrameEncoder):
+        return encoder
+    try:
+        return ENCODERS[encoder.lower()](**options)
+    except KeyError:
+        raise ValueError(f"Unknown frame encoder '{encoder}', expected one of {sorted(ENCODERS)}")
@@ -0,0 +1,262 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+
+# Nothing here imports OpenGL at module level: PyOpenGL binds its platform (GLX,
+# EGL, OSMesa...) on first import, so the backend has to be chosen before that.
+
+class ContextBackend:
+    """
+    A way of creating an OpenGL 3.3 context. Widgets only render into their own
+    framebuffers, so the default framebuffer of the context is never used.
+    `platform` is the PYOPENGL_PLATFORM the backend needs, None for the native one.
+    """
+    name = None
+    platform = None
+
+    def available(self):
+        raise NotImplementedError
+
+    def create(self, width, height):
+        """Creates a context, makes it current and returns its handle."""
+        raise NotImplementedError
+
+    def make_current(self, handle):
+        raise NotImplementedError
+
+    def destroy(self, handle):
+        raise NotImplementedError
+
+class GLFWBackend(ContextBackend):
+    """Hidden GLFW window; needs a display server."""
+    name = "glfw"
+
+    def available(self):
+        if sys.platform.startswith("linux") and not (os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")):
+            return False
+        try:
+            import glfw
+        except ImportError:
+            return False
+        return True
+
+    def create(self, width, height):
+        from ipy_opengl_utils.opengl_utils import open_hidden_window
+        return open_hidden_window(width, height)
+
+    def make_current(self, handle):
+        import glfw
+        glfw.make_context_current(handle)
+
+    def destroy(self, handle):
+        import glfw
+        glfw.destroy_window(handle)
+
+class EGLBackend(ContextBackend):
+    """EGL context without any surface (Mesa's surfaceless platform, or a headless GPU driver)."""
+    name = "egl"
+    platform = "egl"
+
+    def available(self):
+        return ctypes.util.find_library("EGL") is not None
+
+    def create(self, width, height):
+        from OpenGL import EGL
+
+        display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError("EGL display can't be initialized")
+
+        config_attribs = (EGL.EGLint * 5)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                          EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        if not EGL.eglChooseConfig(display, config_attribs, ctypes.pointer(config), 1, ctypes.pointer(count)) or not count.value:
+            raise RuntimeError("No EGL config supports desktop OpenGL")
+
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context_attribs = (EGL.EGLint * 7)(EGL.EGL_CONTEXT_MAJOR_VERSION, 3, EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+                                           EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+                                           EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT, EGL.EGL_NONE)
+        context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, context_attribs)
+        if not context:
+            raise RuntimeError("EGL context can't be created")
+
+        # surfaceless where EGL_KHR_surfaceless_context is supported, else a small pbuffer
+        surface = EGL.EGL_NO_SURFACE
+        try:
+            current = EGL.eglMakeCurrent(display, surface, surface, context)
+        except EGL.EGLError:
+            current = False
+        if not current:
+            pbuffer_attribs = (EGL.EGLint * 5)(EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE)
+            surface = EGL.eglCreatePbufferSurface(display, config, pbuffer_attribs)
+            if not surface or not EGL.eglMakeCurrent(display, surface, surface, context):
+                EGL.eglDestroyContext(display, context)
+                raise RuntimeError("EGL context can't be made current")
+
+        return (display, surface, context)
+
+    def make_current(self, handle):
+        from OpenGL import EGL
+        display, surface, context = handle
+        EGL.eglMakeCurrent(display, surface, surface, context)
+
+    def destroy(self, handle):
+        from OpenGL import EGL
+        display, surface, context = handle
+        EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        if surface != EGL.EGL_NO_SURFACE:
+            EGL.eglDestroySurface(display, surface)
+        EGL.eglDestroyContext(display, context)
+
+class OSMesaBackend(ContextBackend):
+    """Mesa's off-screen software renderer; needs libOSMesa but nothing else."""
+    name = "osmesa"
+    platform = "osmesa"
+
+    def available(self):
+        return ctypes.util.find_library("OSMesa") is not None
+
+    def create(self, width, height):
+        from OpenGL import GL, arrays, osmesa
+
+        attribs = arrays.GLintArray.asArray([
+            osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+            osmesa.OSMESA_DEPTH_BITS, 24,
+            osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+            osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3,
+            osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3,
+            0,
+        ])
+        context = osmesa.OSMesaCreateContextAttribs(attribs, None)
+        if not context:
+            raise RuntimeError("OSMesa context can't be created")
+
+        # OSMesa always renders into client memory; keep the buffer with the handle
+        buffer = arrays.GLubyteArray.zeros((height, width, 4))
+        if not osmesa.OSMesaMakeCurrent(context, buffer, GL.GL_UNSIGNED_BYTE, width, height):
+            osmesa.OSMesaDestroyContext(context)
+            raise RuntimeError("OSMesa context can't be made current")
+        return (context, buffer)
+
+    def make_current(self, handle):
+        from OpenGL import GL, osmesa
+        context, buffer = handle
+        osmesa.OSMesaMakeCurrent(context, buffer, GL.GL_UNSIGNED_BYTE, buffer.shape[1], buffer.shape[0])
+
+    def destroy(self, handle):
+        from OpenGL import osmesa
+        osmesa.OSMesaDestroyContext(handle[0])
+
+BACKENDS = {backend.name: backend for backend in (GLFWBackend(), EGLBackend(), OSMesaBackend())}
+
+# Tried in this order; IPY_OPENGL_BACKEND names one backend (or a comma separated list) to use instead
+DEFAULT_ORDER = ("glfw", "egl", "osmesa")
+
+def backend_order():
+    names = os.environ.get("IPY_OPENGL_BACKEND")
+    if names:
+        names = tuple(name.strip().lower() for name in names.split(",") if name.strip())
+        unknown = [name for name in names if name not in BACKENDS]
+        if unknown:
+            raise ValueError(f"Unknown GL context backend(s) {unknown}, expected some of {sorted(BACKENDS)}")
+        return names
+    return DEFAULT_ORDER
+
+def loaded_platform():
+    """
+    The PyOpenGL platform in use: "egl", "osmesa" or "native" once OpenGL has been
+    imported, otherwise PYOPENGL_PLATFORM (None if unset).
+    """
+    module = sys.modules.get("OpenGL.platform")
+    if module is not None and hasattr(module, "PLATFORM"):
+        name = type(module.PLATFORM).__name__.lower()
+        for platform in ("egl", "osmesa"):
+            if platform in name:
+                return platform
+        return "native"
+    return os.environ.get("PYOPENGL_PLATFORM")
+
+def _compatible(backend):
+    platform = loaded_platform()
+    if platform is None:
+        return True
+    if backend.platform is None:
+        return platform not in ("egl", "osmesa")
+    return platform == backend.platform
+
+def select_platform():
+    """
+    Points PyOpenGL at the platform of the first available backend. Does nothing
+    once OpenGL has been imported or if PYOPENGL_PLATFORM is already set; called
+    when the package is imported.
+    """
+    if loaded_platform() is not None:
+        return
+    for name in backend_order():
+        backend = BACKENDS[name]
+        if backend.available():
+            if backend.platform is not None:
+                os.environ["PYOPENGL_PLATFORM"] = backend.platform
+            if backend.name == "egl":
+                # without a display Mesa would otherwise try X11 first
+                os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+            return backend.name
+    return None
+
+class GLContext:
+    """A context created by a backend, with how long creating it took."""
+
+    def __init__(self, backend, handle, create_seconds):
+        self.backend = backend
+        self.handle = handle
+        self.create_seconds = create_seconds
+
+    def make_current(self):
+        self.backend.make_current(self.handle)
+
+    def destroy(self):
+        if self.handle is not None:
+            self.backend.destroy(self.handle)
+            self.handle = None
+
+_CONTEXTS = []
+
+def create_context(backend=None, width=1, height=1):
+    """
+    Creates a hidden GL 3.3 context with `backend` (a name in BACKENDS) or the
+    first backend that is available and matches the loaded PyOpenGL platform,
+    and makes it current. Raises RuntimeError listing why each backend failed.
+    """
+    names = backend_order() if backend is None else (backend,)
+    errors = []
+    for name in names:
+        candidate = BACKENDS[name]
+        if not candidate.available():
+            errors.append(f"{name}: not available")
+            continue
+        if not _compatible(candidate):
+            errors.append(f"{name}: PyOpenGL is already bound to the '{loaded_platform()}' platform")
+            continue
+        start = time.perf_counter()
+        try:
+            handle = candidate.create(width, height)
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+            continue
+        context = GLContext(candidate, handle, time.perf_counter() - start)
+        _CONTEXTS.append(context)
+        return context
+    raise RuntimeError("No OpenGL context could be created (" + "; ".join(errors) + ")")
+
+def context_stats():
+    """Backend and creation time of the contexts created so far, first one first."""
+    return {
+        "platform": loaded_platform(),
+        "contexts": [{"backend": context.backend.name, "create_seconds": context.create_seconds}
+                     for context in _CONTEXTS],
+    }
@@ -0,0 +1,175 @@
+from OpenGL.GL import *
+
+# Buffer targets whose binding is context state (GL_ELEMENT_ARRAY_BUFFER belongs to the VAO)
+_TRACKED_BUFFER_TARGETS = (GL_ARRAY_BUFFER, GL_PIXEL_PACK_BUFFER, GL_UNIFORM_BUFFER)
+
+_STATES = {}
+
+def current_context():
+    """Opaque id of the GL context current in this thread, used to key per-context caches."""
+    from OpenGL import platform
+    return int(platform.PLATFORM.GetCurrentContext() or 0)
+
+def gl_state():
+    """The GLState of the context current in this thread."""
+    context = current_context()
+    state = _STATES.get(context)
+    if state is None:
+        state = _STATES[context] = GLState()
+    return state
+
+class GLState:
+    """
+    Shadow copy of the render state of one GL context. Every bind and state change
+    goes through it, and calls that would not change anything are skipped.
+
+    Objects must be deleted through the delete_* methods, since GL reuses the names
+    of deleted objects. Code issuing its own GL calls for tracked state should call
+    invalidate() afterwards.
+    """
+
+    def __init__(self):
+        self.issued = 0
+        self.avoided = 0
+        self.avoided_by_kind = {}
+        self.invalidate()
+
+    def invalidate(self):
+        """Forgets the cached state; the next change of each kind is always issued."""
+        self.capabilities = {}
+        self.framebuffer = None
+        self.program = None
+        self.vertex_array = None
+        self.buffers = {}
+        self.values = {}
+
+    def _changed(self, kind, cached, value):
+        if cached == value:
+            self.avoided += 1
+            self.avoided_by_kind[kind] = self.avoided_by_kind.get(kind, 0) + 1
+            return False
+        self.issued += 1
+        return True
+
+    def set_capability(self, capability, enabled):
+        if self._changed("capability", self.capabilities.get(capability), enabled):
+            if enabled:
+                glEnable(capability)
+            else:
+                glDisable(capability)
+            self.capabilities[capability] = enabled
+
+    def enable(self, capability):
+        self.set_capability(capability, True)
+
+    def disable(self, capability):
+        self.set_capability(capability, False)
+
+    def bind_framebuffer(self, framebuffer):
+        if self._changed("framebuffer", self.framebuffer, framebuffer):
+            glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+            self.framebuffer = framebuffer
+
+    def blit_framebuffer(self, source, destination, width, height, mask=GL_COLOR_BUFFER_BIT):
+        """
+        Copies the (width, height) corner of `source` into `destination`, resolving
+        multisampled buffers, and leaves `destination` bound.
+        """
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, source)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, destination)
+        glBlitFramebuffer(0, 0, width, height, 0, 0, width, height, mask, GL_NEAREST)
+        glBindFramebuffer(GL_FRAMEBUFFER, destination)
+        self.framebuffer = destination
+        self.issued += 1
+
+    def use_program(self, program):
+        if self._changed("program", self.program, program):
+            glUseProgram(program)
+            self.program = program
+
+    def bind_vertex_array(self, vertex_array):
+        if self._changed("vertex_array", self.vertex_array, vertex_array):
+            glBindVertexArray(vertex_array)
+            self.vertex_array = vertex_array
+
+    def bind_buffer(self, target, buffer):
+        if target not in _TRACKED_BUFFER_TARGETS:
+            glBindBuffer(target, buffer)
+            return
+        if self._changed("buffer", self.buffers.get(target), buffer):
+            glBindBuffer(target, buffer)
+            self.buffers[target] = buffer
+
+    def bind_buffer_base(self, target, index, buffer):
+        # also binds the generic target
+        if self._changed("buffer", self.values.get((target, index)), buffer) or self.buffers.get(target) != buffer:
+            glBindBufferBase(target, index, buffer)
+            self.values[(target, index)] = buffer
+            self.buffers[target] = buffer
+
+    def _set(self, kind, value, call):
+        if self._changed(kind, self.values.get(kind), value):
+            call(*value)
+            self.values[kind] = value
+
+    def viewport(self, x, y, width, height):
+        self._set("viewport", (x, y, width, height), glViewport)
+
+    def scissor(self, x, y, width, height):
+        self._set("scissor", (x, y, width, height), glScissor)
+
+    def clear_color(self, red, green, blue, alpha):
+        self._set("clear_color", (red, green, blue, alpha), glClearColor)
+
+    def cull_face(self, mode):
+        self._set("cull_face", (mode,), glCullFace)
+
+    def front_face(self, mode):
+        self._set("front_face", (mode,), glFrontFace)
+
+    def blend_func(self, source, destination):
+        self._set("blend_func", (source, destination), glBlendFunc)
+
+    def pack_alignment(self, alignment):
+        self._set("pack_alignment", (GL_PACK_ALIGNMENT, alignment), glPixelStorei)
+
+    def apply(self, render_state):
+        """
+        Applies a render state dict: "capabilities" maps capabilities to enabled flags,
+        the other keys name the setter methods above with their arguments.
+        """
+        for capability, enabled in render_state.get("capabilities", {}).items():
+            self.set_capability(capability, enabled)
+        for name, args in render_state.items():
+            if name != "capabilities":
+                getattr(self, name)(*args)
+
+    def delete_buffers(self, buffers):
+        for target, bound in list(self.buffers.items()):
+            if bound in buffers:
+                self.buffers[target] = 0
+        for key, bound in list(self.values.items()):
+            if isinstance(key, tuple) and bound in buffers:
+                self.values[key] = 0
+        glDeleteBuffers(len(buffers), buffers)
+
+    def delete_vertex_arrays(self, vertex_arrays):
+        if self.vertex_array in vertex_arrays:
+            self.vertex_array = 0
+        glDeleteVertexArrays(len(vertex_arrays), vertex_arrays)
+
+    def delete_framebuffers(self, framebuffers):
+        if self.framebuffer in framebuffers:
+            self.framebuffer = 0
+        glDeleteFramebuffers(len(framebuffers), framebuffers)
+
+    def delete_program(self, program):
+        # a program in use is only flagged for deletion, so keep the cached binding
+        glDeleteProgram(program)
+
+    def stats(self):
+        return {
+            "issued": self.issued,
+            "avoided": self.avoided,
+            "avoided_by_kind": dict(self.avoided_by_kind),
+        }
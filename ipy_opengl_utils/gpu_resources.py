@@ -0,0 +1,174 @@
+from OpenGL.GL import *
+import numpy as np
+import contextlib
+import functools
+import itertools
+from ipy_opengl_utils.gl_state import gl_state, current_context
+
+_TRACKERS = {}
+
+# Owners of the GL objects created right now, innermost last; see owned_by
+_OWNERS = []
+
+_OWNER_IDS = itertools.count(1)
+
+# glGen* call for each kind of object, taking the count
+_CREATORS = {
+    "buffer": glGenBuffers,
+    "vertex_array": glGenVertexArrays,
+    "framebuffer": glGenFramebuffers,
+    "texture": glGenTextures,
+    "renderbuffer": glGenRenderbuffers,
+    "query": glGenQueries,
+}
+
+# Deletion of each kind, through the state cache where it tracks the bindings
+_DELETERS = {
+    "buffer": lambda state, name: state.delete_buffers([name]),
+    "vertex_array": lambda state, name: state.delete_vertex_arrays([name]),
+    "framebuffer": lambda state, name: state.delete_framebuffers([name]),
+    "texture": lambda state, name: glDeleteTextures(1, [name]),
+    "renderbuffer": lambda state, name: glDeleteRenderbuffers(1, [name]),
+    "program": lambda state, name: state.delete_program(name),
+    "query": lambda state, name: glDeleteQueries(1, [name]),
+}
+
+# Estimated bytes per texel of an internal format; drivers store RGB8 padded to 4 bytes
+TEXEL_BYTES = {
+    GL_RGB: 4, GL_RGB8: 4, GL_RGBA: 4, GL_RGBA8: 4, GL_R32I: 4, GL_R32F: 4, GL_RGBA16F: 8, GL_RGBA32F: 16,
+    GL_DEPTH24_STENCIL8: 4, GL_DEPTH_COMPONENT24: 4, GL_DEPTH_COMPONENT32F: 4,
+}
+
+def gpu_resources(context=None):
+    """The ResourceTracker of `context`, by default the one current in this thread."""
+    if context is None:
+        context = current_context()
+    tracker = _TRACKERS.get(context)
+    if tracker is None:
+        tracker = _TRACKERS[context] = ResourceTracker()
+    return tracker
+
+def new_owner(obj):
+    """A unique owner tag for `obj`, e.g. "ParticleWidget-3"."""
+    return f"{type(obj).__name__}-{next(_OWNER_IDS)}"
+
+@contextlib.contextmanager
+def owned_by(owner):
+    """Attributes the GL objects created inside the block to `owner`; None means shared."""
+    _OWNERS.append(owner)
+    try:
+        yield
+    finally:
+        _OWNERS.pop()
+
+def current_owner():
+    """The owner the GL objects created right now are attributed to (None if shared)."""
+    return _OWNERS[-1] if _OWNERS else None
+
+def owns_gl_objects(method):
+    """Method decorator attributing the GL objects it creates to `self.resource_owner`."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if "resource_owner" not in self.__dict__:
+            # may run before the base class constructor
+            self.resource_owner = new_owner(self)
+        with owned_by(self.resource_owner):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class ResourceTracker:
+    """
+    Registry of the GL objects of one context: who owns each one, its estimated
+    size in GPU memory and its reference count.
+
+    Objects are created with `create` (or registered with `track`) and handed back
+    with `release`, which deletes them once the last reference is gone, along with
+    the objects registered as their children (e.g. the attachments of a
+    framebuffer). `release_owner` deletes everything an owner still holds, which
+    is what closing a widget does.
+    """
+
+    def __init__(self):
+        # (kind, name) -> {"owner", "bytes", "refs", "children"}
+        self.objects = {}
+        self.created = 0
+        self.deleted = 0
+
+    def create(self, kind, count=None, nbytes=0, parent=None):
+        """Generates `count` objects of `kind` (one name if None, else a list)."""
+        names = [int(name) for name in np.atleast_1d(_CREATORS[kind](count or 1))]
+        for name in names:
+            self.track(kind, name, nbytes, parent)
+        return names[0] if count is None else names
+
+    def track(self, kind, name, nbytes=0, parent=None):
+        """Registers an object created elsewhere, e.g. a program; `parent` is a (kind, name) key."""
+        key = (kind, int(name))
+        self.objects[key] = {"owner": current_owner(), "bytes": nbytes, "refs": 1,
+                             "children": []}
+        self.created += 1
+        if parent is not None and parent in self.objects:
+            self.objects[parent]["children"].append(key)
+        return name
+
+    def set_bytes(self, kind, name, nbytes):
+        """Updates the size estimate of an object, e.g. after glBufferData."""
+        entry = self.objects.get((kind, int(name)))
+        if entry is not None:
+            entry["bytes"] = nbytes
+
+    def retain(self, kind, name):
+        self.objects[(kind, int(name))]["refs"] += 1
+
+    def references(self, kind, name):
+        entry = self.objects.get((kind, int(name)))
+        return 0 if entry is None else entry["refs"]
+
+    def release(self, kind, names):
+        """
+        Drops one reference to each object in `names` (a name or a list), deleting
+        those left unreferenced. Returns the number of objects deleted. Unknown names,
+        e.g. objects already freed by release_owner, are ignored.
+        """
+        names = np.atleast_1d(names)
+        deleted = 0
+        for name in names:
+            key = (kind, int(name))
+            entry = self.objects.get(key)
+            if entry is None:
+                continue
+            entry["refs"] -= 1
+            if entry["refs"] <= 0:
+                deleted += self._delete(key)
+        return deleted
+
+    def release_owner(self, owner):
+        """Deletes every object still held by `owner`, whatever its reference count."""
+        keys = [key for key, entry in self.objects.items() if entry["owner"] == owner]
+        return sum(self._delete(key) for key in keys)
+
+    def _delete(self, key):
+        entry = self.objects.pop(key, None)
+        if entry is None:
+            return 0
+        deleted = 1
+        for child in entry["children"]:
+            deleted += self._delete(child)
+        _DELETERS[key[0]](gl_state(), key[1])
+        self.deleted += 1
+        return deleted
+
+    def stats(self, owner=...):
+        """Live object counts and estimated bytes by kind, for one owner or all of them."""
+        objects = {}
+        nbytes = {}
+        for (kind, _), entry in self.objects.items():
+            if owner is not ... and entry["owner"] != owner:
+                continue
+            objects[kind] = objects.get(kind, 0) + 1
+            nbytes[kind] = nbytes.get(kind, 0) + entry["bytes"]
+        return {"objects": objects, "bytes": nbytes, "total_bytes": sum(nbytes.values())}
+
+    def owners(self):
+        """stats() of each owner; shared objects are listed under None."""
+        return {owner: self.stats(owner) for owner in {entry["owner"] for entry in self.objects.values()}}
@@ -0,0 +1,288 @@
+from OpenGL.GL import *
+import ctypes
+from ipy_opengl_utils.gl_state import gl_state
+from ipy_opengl_utils.gpu_resources import gpu_resources, current_owner, owned_by
+import numpy as np
+
+# GL component type of each supported dtype
+_GL_TYPES = {
+    np.dtype(np.float32): GL_FLOAT,
+    np.dtype(np.float16): GL_HALF_FLOAT,
+    np.dtype(np.int8): GL_BYTE,
+    np.dtype(np.uint8): GL_UNSIGNED_BYTE,
+    np.dtype(np.int16): GL_SHORT,
+    np.dtype(np.uint16): GL_UNSIGNED_SHORT,
+    np.dtype(np.int32): GL_INT,
+    np.dtype(np.uint32): GL_UNSIGNED_INT,
+}
+
+class InstanceBuffer:
+    """
+    A GPU vertex buffer mirroring a CPU-side array of per-instance attributes.
+
+    Writes go through `write`/`set_data` (or are announced with `mark_dirty`) and are
+    recorded as dirty element ranges. `sync` uploads only those ranges, re-specifying
+    (orphaning) the whole buffer when most of it changed, and does nothing at all when
+    nothing changed. In double-buffered mode the upload goes into a second buffer that
+    the GPU is not reading, and the attached VAOs are switched over to it afterwards.
+
+    Storage is preallocated on both sides and grows geometrically, so appending
+    in small batches costs amortized O(1) copies per element and only the new
+    tail is uploaded. `data` is a view of the live elements.
+
+    Integer dtypes reach the shader as integers unless `normalized`, in which case
+    they are mapped to [0, 1] (or [-1, 1]) floats, e.g. uint8 colors.
+
+    The GL buffers are only generated on first use, on behalf of the owner current
+    at construction, so buffers can be built and filled before a context exists.
+    """
+
+    # merged ranges above this count are collapsed into one span to bound the number of calls
+    max_ranges = 32
+
+    def __init__(self, components=3, dtype=np.float32, double_buffered=False, orphan_threshold=0.5, usage=GL_DYNAMIC_DRAW,
+                 initial_capacity=1024, growth_factor=2.0, normalized=False):
+        self.components = components
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in _GL_TYPES:
+            raise ValueError(f"Unsupported instance attribute dtype {self.dtype}")
+        self.normalized = normalized
+        self.double_buffered = double_buffered
+        self.orphan_threshold = orphan_threshold
+        self.usage = usage
+        self.growth_factor = growth_factor
+
+        self._storage = np.zeros((initial_capacity, components), dtype=self.dtype)
+        self.count = 0
+
+        count = 2 if double_buffered else 1
+        self._buffers = None
+        self._owner = current_owner()
+        self.current = 0
+
+        # per-buffer state: allocated capacity in elements and pending dirty ranges
+        self._allocated = [-1] * count
+        self._dirty = [[] for _ in range(count)]
+
+        # (vao, location, divisor) triples that source their attribute from this buffer
+        self._attachments = []
+
+        self.bytes_uploaded = 0
+        self.upload_calls = 0
+
+        # bumped on every modification, lets consumers cache derived data
+        self.version = 0
+
+    @property
+    def buffers(self):
+        if self._buffers is None:
+            with owned_by(self._owner):
+                self._buffers = gpu_resources().create("buffer", len(self._allocated))
+        return self._buffers
+
+    @property
+    def buffer(self):
+        """The GL buffer currently used for drawing."""
+        return self.buffers[self.current]
+
+    @property
+    def data(self):
+        """View of the live elements; call `mark_dirty` after editing it in place."""
+        return self._storage[:self.count]
+
+    @property
+    def capacity(self):
+        return len(self._storage)
+
+    @property
+    def itemsize(self):
+        return self.components * self.dtype.itemsize
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, capacity):
+        """Ensures room for at least `capacity` elements, growing geometrically."""
+        if capacity <= self.capacity:
+            return
+        new_capacity = max(capacity, int(self.capacity * self.growth_factor), 1)
+        storage = np.zeros((new_capacity, self.components), dtype=self.dtype)
+        storage[:self.count] = self._storage[:self.count]
+        self._storage = storage
+
+    def shrink_to_fit(self):
+        """Releases unused capacity; the GPU side follows on the next sync."""
+        if self.count < self.capacity:
+            self._storage = self._storage[:max(self.count, 1)].copy()
+
+    def set_data(self, data):
+        """Replaces the whole array."""
+        data = np.asarray(data, dtype=self.dtype).reshape(-1, self.components)
+        self.reserve(len(data))
+        self._storage[:len(data)] = data
+        self.count = len(data)
+        self.mark_dirty()
+
+    def append(self, data):
+        """Appends elements at the end; only the new tail is uploaded on the next sync."""
+        data = np.asarray(data, dtype=self.dtype).reshape(-1, self.components)
+        start = self.count
+        self.reserve(start + len(data))
+        self._storage[start:start + len(data)] = data
+        self.count = start + len(data)
+        self.mark_dirty(start, self.count)
+        return start
+
+    def remove(self, indices):
+        """
+        Removes the elements selected by `indices` (index array or boolean mask),
+        compacting the survivors in place. Only the shifted range is re-uploaded.
+        """
+        keep = np.ones(self.count, dtype=bool)
+        keep[indices] = False
+        removed = np.flatnonzero(~keep)
+        if len(removed) == 0:
+            return
+
+        first = int(removed[0])
+        survivors = self._storage[first:self.count][keep[first:]]
+        self._storage[first:first + len(survivors)] = survivors
+        self.count = first + len(survivors)
+        self.mark_dirty(first, self.count)
+
+    def _columns(self, data, columns):
+        width = self.components if columns is None else len(range(*columns.indices(self.components)))
+        return np.asarray(data, dtype=self.dtype).reshape(-1, width), slice(None) if columns is None else columns
+
+    def write(self, data, start=0, columns=None):
+        """
+        Overwrites elements [start, start + len(data)) in place, or only the
+        components selected by the slice `columns`.
+        """
+        data, columns = self._columns(data, columns)
+        stop = start + len(data)
+        if start < 0 or stop > len(self.data):
+            raise IndexError(f"Write range [{start}, {stop}) out of bounds for {len(self.data)} elements")
+        self.data[start:stop, columns] = data
+        self.mark_dirty(start, stop)
+
+    def write_indices(self, indices, data, columns=None):
+        """Scatters `data` into the elements selected by `indices`."""
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        if len(indices) == 0:
+            return
+        data, columns = self._columns(data, columns)
+        self.data[indices, columns] = data
+        self.mark_dirty(int(indices.min()), int(indices.max()) + 1)
+
+    def mark_dirty(self, start=0, stop=None):
+        """Flags elements [start, stop) as changed, e.g. after editing `data` in place."""
+        if stop is None:
+            stop = len(self.data)
+        if stop <= start:
+            return
+        self.version += 1
+        for ranges in self._dirty:
+            ranges.append((start, stop))
+
+    def is_dirty(self):
+        return bool(self._dirty[self.current]) or self._allocated[self.current] != self.capacity
+
+    def attach(self, vao, location, divisor=1):
+        """Binds this buffer as vertex attribute `location` of `vao`, advancing per instance."""
+        self._attachments.append((vao, location, divisor))
+        self._bind_attribute(vao, location, divisor)
+
+    def bind_attribute(self, vao, location, divisor=1, first=0):
+        """One-off binding of attribute `location` of `vao` starting at element `first`."""
+        self._bind_attribute(vao, location, divisor, first)
+
+    def detach(self, vao):
+        """Forgets the attribute bindings of `vao`, e.g. before it is deleted."""
+        self._attachments = [a for a in self._attachments if a[0] != vao]
+
+    def _bind_attribute(self, vao, location, divisor, first=0):
+        state = gl_state()
+        state.bind_vertex_array(vao)
+        state.bind_buffer(GL_ARRAY_BUFFER, self.buffer)
+        offset = ctypes.c_void_p(first * self.itemsize)
+        gl_type = _GL_TYPES[self.dtype]
+        if self.dtype.kind in 'iu' and not self.normalized:
+            # integer attributes reach the shader unconverted, e.g. instance ids
+            glVertexAttribIPointer(location, self.components, gl_type, 0, offset)
+        else:
+            glVertexAttribPointer(location, self.components, gl_type, GL_TRUE if self.normalized else GL_FALSE, 0, offset)
+        glEnableVertexAttribArray(location)
+        glVertexAttribDivisor(location, divisor)
+        state.bind_vertex_array(0)
+
+    def sync(self):
+        """
+        Uploads pending changes and returns the number of bytes transferred.
+        Returns 0 without touching GL if the drawn buffer is already up to date.
+        """
+        if not self.is_dirty():
+            return 0
+
+        target = (self.current + 1) % len(self.buffers) if self.double_buffered else self.current
+        uploaded = self._upload(target)
+
+        if target != self.current:
+            self.current = target
+            for vao, location, divisor in self._attachments:
+                self._bind_attribute(vao, location, divisor)
+
+        self.bytes_uploaded += uploaded
+        return uploaded
+
+    def _upload(self, index):
+        count = self.count
+        ranges = self._merged_ranges(self._dirty[index], count)
+        self._dirty[index] = []
+
+        gl_state().bind_buffer(GL_ARRAY_BUFFER, self.buffers[index])
+
+        dirty_count = sum(stop - start for start, stop in ranges)
+        if self._allocated[index] != self.capacity or dirty_count >= self.orphan_threshold * count:
+            # re-specifying the storage lets the driver hand us a fresh block instead of
+            # waiting for draws still reading the old one; only the live part is sent
+            glBufferData(GL_ARRAY_BUFFER, self._storage.nbytes, None, self.usage)
+            gpu_resources().set_bytes("buffer", self.buffers[index], self._storage.nbytes)
+            self._allocated[index] = self.capacity
+            uploaded = 0
+            if count:
+                glBufferSubData(GL_ARRAY_BUFFER, 0, self.data.nbytes, self.data)
+                self.upload_calls += 1
+                uploaded = self.data.nbytes
+        else:
+            uploaded = 0
+            for start, stop in ranges:
+                chunk = self.data[start:stop]
+                glBufferSubData(GL_ARRAY_BUFFER, start * self.itemsize, chunk.nbytes, chunk)
+                self.upload_calls += 1
+                uploaded += chunk.nbytes
+
+        return uploaded
+
+    def _merged_ranges(self, ranges, count):
+        ranges = sorted((max(0, start), min(stop, count)) for start, stop in ranges)
+        merged = []
+        for start, stop in ranges:
+            if stop <= start:
+                continue
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+            else:
+                merged.append((start, stop))
+
+        if len(merged) > self.max_ranges:
+            merged = [(merged[0][0], merged[-1][1])]
+        return merged
+
+    def delete(self):
+        if self._buffers:
+            gpu_resources().release("buffer", self._buffers)
+        self._buffers = []
+        self._attachments = []
@@ -0,0 +1,106 @@
+from OpenGL.GL import *
+import numpy as np
+from ipy_opengl_utils.instance_buffer import InstanceBuffer
+from ipy_opengl_utils.gl_state import gl_state
+from ipy_opengl_utils.gpu_resources import gpu_resources
+
+# corner pairs of the 12 edges of a box, corners indexed by their (x, y, z) bits
+_BOX_EDGES = np.array([[0, 1], [2, 3], [4, 5], [6, 7],
+                       [0, 2], [1, 3], [4, 6], [5, 7],
+                       [0, 4], [1, 5], [2, 6], [3, 7]])
+
+class LineBatch:
+    """
+    Colored line segments drawn with a single glDrawArrays(GL_LINES) call, for
+    axes, bounding boxes, trajectories, bonds and other overlays.
+
+    Vertex positions and colors live in persistent buffers (InstanceBuffers with a
+    per-vertex divisor), so appending segments only uploads the new ones and an
+    unchanged batch costs nothing but the draw. Draw with the line shader in use.
+    """
+
+    def __init__(self, line_width=1.0, initial_capacity=256):
+        self.line_width = line_width
+        self.positions = InstanceBuffer(3, np.float32, initial_capacity=initial_capacity)
+        self.colors = InstanceBuffer(3, np.float32, initial_capacity=initial_capacity)
+        self.vao = None
+
+    def __len__(self):
+        """Number of segments."""
+        return len(self.positions) // 2
+
+    @staticmethod
+    def _vertex_colors(colors, count):
+        # one color for all, one per segment or one per vertex
+        colors = np.asarray(colors, dtype=np.float32)
+        if colors.size == 3:
+            return np.broadcast_to(colors.reshape(1, 3), (2 * count, 3))
+        if colors.size == 3 * count:
+            return np.repeat(colors.reshape(count, 3), 2, axis=0)
+        if colors.size == 6 * count:
+            return colors.reshape(2 * count, 3)
+        raise ValueError(f"Expected 1, {count} or {2 * count} colors for {count} segments, got {colors.size // 3}")
+
+    def add_segments(self, starts, ends, colors=(1.0, 1.0, 1.0)):
+        """
+        Appends segments from `starts` to `ends` ((N, 3) arrays). `colors` is a single
+        color, one per segment or one per vertex. Returns the index of the first segment.
+        """
+        starts = np.asarray(starts, dtype=np.float32).reshape(-1, 3)
+        ends = np.asarray(ends, dtype=np.float32).reshape(-1, 3)
+        if len(starts) != len(ends):
+            raise ValueError(f"Got {len(starts)} segment starts but {len(ends)} ends")
+
+        vertices = np.empty((2 * len(starts), 3), dtype=np.float32)
+        vertices[0::2] = starts
+        vertices[1::2] = ends
+        first = self.positions.append(vertices)
+        self.colors.append(self._vertex_colors(colors, len(starts)))
+        return first // 2
+
+    def add_polyline(self, points, colors=(1.0, 1.0, 1.0)):
+        """Appends segments joining consecutive `points`, e.g. a trajectory."""
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        return self.add_segments(points[:-1], points[1:], colors)
+
+    def add_box(self, box_min, box_max, colors=(1.0, 1.0, 1.0)):
+        """Appends the 12 edges of an axis-aligned box."""
+        box_min = np.asarray(box_min, dtype=np.float32)
+        box_max = np.asarray(box_max, dtype=np.float32)
+        bits = (np.arange(8)[:, None] >> np.arange(3)) & 1
+        corners = np.where(bits, box_max, box_min)
+        return self.add_segments(corners[_BOX_EDGES[:, 0]], corners[_BOX_EDGES[:, 1]], colors)
+
+    def set_colors(self, colors, first=0, count=None):
+        """Recolors `count` segments starting at segment `first`."""
+        if count is None:
+            count = len(self) - first
+        self.colors.write(self._vertex_colors(colors, count), 2 * first)
+
+    def clear(self):
+        self.positions.set_data(np.zeros((0, 3), dtype=np.float32))
+        self.colors.set_data(np.zeros((0, 3), dtype=np.float32))
+
+    def draw(self):
+        if len(self) == 0:
+            return
+        if self.vao is None:
+            self.vao = gpu_resources().create("vertex_array")
+            self.positions.attach(self.vao, 0, divisor=0)
+            self.colors.attach(self.vao, 1, divisor=0)
+
+        self.positions.sync()
+        self.colors.sync()
+
+        state = gl_state()
+        state.bind_vertex_array(self.vao)
+        glLineWidth(self.line_width)
+        glDrawArrays(GL_LINES, 0, 2 * len(self))
+        state.bind_vertex_array(0)
+
+    def delete(self):
+        if self.vao is not None:
+            gpu_resources().release("vertex_array", self.vao)
+            self.vao = None
+        self.positions.delete()
+        self.colors.delete()
@@ -39,3 +39,108 @@ def ray_sphere_intersect(ray_origin, ray_dir, sphere_center, sphere_radius):
     dist = (-b - np.sqrt(discriminant)) / (2.0 * a)
     return dist > 0, dist
 
+
+def ray_spheres_intersect(ray_origin, ray_dir, centers, radius):
+    """
+    Vectorized ray_sphere_intersect against many spheres at once.
+    `radius` is a scalar or one radius per sphere. Returns the entry distance
+    along the ray for every sphere, with np.inf where the ray misses.
+    """
+    centers = np.asarray(centers, dtype=np.float32).reshape(-1, 3)
+    ray_dir = np.asarray(ray_dir, dtype=np.float32)
+
+    oc = np.asarray(ray_origin, dtype=np.float32) - centers
+    a = np.dot(ray_dir, ray_dir)
+    half_b = oc @ ray_dir
+    c = np.einsum('ij,ij->i', oc, oc) - np.square(radius)
+    discriminant = half_b * half_b - a * c
+
+    dist = np.full(len(centers), np.inf, dtype=np.float32)
+    hit = discriminant >= 0
+    dist[hit] = (-half_b[hit] - np.sqrt(discriminant[hit])) / a
+    dist[dist <= 0] = np.inf
+    return dist
+
+def nearest_ray_sphere(ray_origin, ray_dir, centers, radius):
+    """
+    Returns (index, distance) of the closest sphere hit by the ray, or (-1, inf).
+    """
+    if len(centers) == 0:
+        return -1, np.inf
+    dist = ray_spheres_intersect(ray_origin, ray_dir, centers, radius)
+    index = int(np.argmin(dist))
+    if not np.isfinite(dist[index]):
+        return -1, np.inf
+    return index, float(dist[index])
+
+def ray_aabb_intersect(ray_origin, ray_dir, box_min, box_max):
+    """
+    Slab test between a ray and an axis aligned box.
+    Returns (t_enter, t_exit) clamped to t >= 0, or None if the box is missed.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_dir = 1.0 / np.asarray(ray_dir, dtype=np.float64)
+        t1 = (np.asarray(box_min) - ray_origin) * inv_dir
+        t2 = (np.asarray(box_max) - ray_origin) * inv_dir
+    t1 = np.nan_to_num(t1, nan=-np.inf)
+    t2 = np.nan_to_num(t2, nan=np.inf)
+    t_enter = max(float(np.max(np.minimum(t1, t2))), 0.0)
+    t_exit = float(np.min(np.maximum(t1, t2)))
+    if t_exit < t_enter:
+        return None
+    return t_enter, t_exit
+
+def view_depths(positions, camera):
+    """
+    Distance of each point in front of the camera along its viewing direction
+    (negated view-space z), vectorized over an (N, 3) array.
+    """
+    view = np.asarray(camera.get_view_matrix()).T
+    return -(np.asarray(positions) @ view[2, :3] + view[2, 3])
+
+def screen_radius(positions, radius, camera, viewport_height):
+    """
+    Approximate on-screen radius in pixels of spheres of the given radius
+    centered at `positions`, for a perspective camera.
+    """
+    focal = 0.5 * viewport_height / np.tan(np.radians(camera.fov) / 2.0)
+    depth = np.maximum(view_depths(positions, camera), camera.near)
+    return radius * focal / depth
+
+def view_projection(camera):
+    """Column-vector view-projection matrix (projection @ view) of the camera."""
+    proj = np.asarray(camera.get_projection_matrix()).T
+    view = np.asarray(camera.get_view_matrix()).T
+    return proj @ view
+
+def frustum_planes(camera):
+    """
+    The six frustum planes (left, right, bottom, top, near, far) as rows (a, b, c, d)
+    with inward unit normals, so a point p is inside when a*x + b*y + c*z + d >= 0.
+    """
+    m = view_projection(camera)
+    planes = np.array([m[3] + m[0], m[3] - m[0], m[3] + m[1], m[3] - m[1], m[3] + m[2], m[3] - m[2]])
+    return planes / np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+
+def spheres_in_frustum(planes, centers, radius):
+    """Boolean mask of the spheres that are at least partially inside the frustum."""
+    distances = np.asarray(centers) @ planes[:, :3].T + planes[:, 3]
+    return np.all(distances >= -np.asarray(radius).reshape(-1, 1), axis=1)
+
+def aabb_frustum_test(planes, box_min, box_max):
+    """
+    Classifies axis aligned boxes against the frustum.
+    Returns an int array: -1 outside, 0 intersecting, 1 fully inside.
+    """
+    normals = planes[:, :3]
+    positive = normals >= 0
+    # farthest and nearest box corners along each plane normal
+    p_vertex = np.where(positive[None], box_max[:, None, :], box_min[:, None, :])
+    n_vertex = np.where(positive[None], box_min[:, None, :], box_max[:, None, :])
+    p_dist = np.einsum('bpk,pk->bp', p_vertex, normals) + planes[:, 3]
+    n_dist = np.einsum('bpk,pk->bp', n_vertex, normals) + planes[:, 3]
+
+    result = np.zeros(len(box_min), dtype=np.int8)
+    result[np.all(n_dist >= 0, axis=1)] = 1
+    result[np.any(p_dist < 0, axis=1)] = -1
+    return result
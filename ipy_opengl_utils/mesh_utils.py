@@ -1,38 +1,35 @@
 # filepath: /ipy-opengl-utils/ipy-opengl-utils/ipy_opengl_utils/mesh_utils.py
 import numpy as np
+from functools import lru_cache
 
 def generate_sphere_mesh(radius=1.0, stacks=16, slices=16):
-    vertices = []
-    indices = []
-
-    for i in range(stacks + 1):
-        theta = np.pi * i / stacks
-        sin_theta = np.sin(theta)
-        cos_theta = np.cos(theta)
-
-        for j in range(slices + 1):
-            phi = 2 * np.pi * j / slices
-            sin_phi = np.sin(phi)
-            cos_phi = np.cos(phi)
-
-            x = cos_phi * sin_theta
-            y = cos_theta
-            z = sin_phi * sin_theta
-            vertices.append(radius * np.array([x, y, z]))
-
-    for i in range(stacks):
-        for j in range(slices):
-            first = (i * (slices + 1)) + j
-            second = first + slices + 1
-            indices.append(first)
-            indices.append(second)
-            indices.append(first + 1)
-            indices.append(second)
-            indices.append(second + 1)
-            indices.append(first + 1)
-
-    vertices = np.array(vertices, dtype=np.float32)
-    indices = np.array(indices, dtype=np.uint32)
+    """
+    UV sphere with (stacks + 1) * (slices + 1) vertices and 6 * stacks * slices indices.
+    Meshes are cached by their parameters; the caller gets its own copy of the arrays.
+    """
+    vertices, indices = _sphere_mesh(float(radius), int(stacks), int(slices))
+    return vertices.copy(), indices.copy()
+
+@lru_cache(maxsize=32)
+def _sphere_mesh(radius, stacks, slices):
+    # shared by every caller, hence read-only
+    theta = np.pi * np.arange(stacks + 1) / stacks
+    phi = 2 * np.pi * np.arange(slices + 1) / slices
+    theta, phi = np.meshgrid(theta, phi, indexing='ij')
+
+    x = np.cos(phi) * np.sin(theta)
+    y = np.cos(theta)
+    z = np.sin(phi) * np.sin(theta)
+    vertices = (radius * np.stack((x, y, z), axis=-1)).reshape(-1, 3).astype(np.float32)
+
+    # two triangles per quad of the (stacks, slices) grid
+    i, j = np.meshgrid(np.arange(stacks), np.arange(slices), indexing='ij')
+    first = i * (slices + 1) + j
+    second = first + slices + 1
+    indices = np.stack((first, second, first + 1, second, second + 1, first + 1), axis=-1).ravel().astype(np.uint32)
+
+    vertices.flags.writeable = False
+    indices.flags.writeable = False
     return vertices, indices
 
 def generate_cube_mesh(size=1.0):
@@ -0,0 +1,230 @@
+import os
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from ipy_opengl_utils.camera import Camera
+from ipy_opengl_utils.frame_encoders import get_encoder
+
+class Scene:
+    """
+    Picklable description of a ParticleWidget scene: particles, camera, overlay
+    lines and the widget options. `build` recreates the widget in the current GL
+    context, so the same setup renders in a notebook, a script or a worker process.
+    """
+
+    # ParticleWidget options that change the rendered image
+    OPTIONS = ("render_mode", "lod", "culling", "per_particle_radius", "color_format", "draw_axes")
+
+    def __init__(self, positions, colors, width=800, height=600, radii=None, particle_radius=1.0, camera=None,
+                 lines=None, **options):
+        self.positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        self.colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+        self.radii = None if radii is None else np.asarray(radii, dtype=np.float32)
+        self.width = width
+        self.height = height
+        self.particle_radius = particle_radius
+        self.camera = camera
+        # (vertices, colors) of the overlay segments, two rows per segment
+        self.lines = lines
+        self.options = options
+
+    @classmethod
+    def from_widget(cls, widget):
+        """Snapshot of a live ParticleWidget, including its current camera."""
+        options = {name: getattr(widget, name) for name in cls.OPTIONS}
+        lines = None
+        if len(widget.lines):
+            lines = (widget.lines.positions.data.copy(), widget.lines.colors.data.copy())
+        return cls(widget.positions.copy(), widget.colors, width=widget.width, height=widget.height,
+                   radii=widget.radii.copy() if widget.per_particle_radius else None,
+                   particle_radius=widget.particle_radius, camera=copy.deepcopy(widget.camera),
+                   lines=lines, **options)
+
+    def build(self):
+        """Creates a ParticleWidget showing this scene in the current GL context."""
+        from ipy_opengl_utils.particle_widget import ParticleWidget
+
+        widget = ParticleWidget(self.width, self.height, delta_frames=False, **self.options)
+        if self.particle_radius != 1.0:
+            widget.setup_sphere_buffers(radius=self.particle_radius)
+        widget.add_particles(self.positions, self.colors, update_cam=self.camera is None, radii=self.radii)
+        if self.camera is not None:
+            widget.camera = copy.deepcopy(self.camera)
+        if self.lines is not None:
+            vertices, colors = self.lines
+            widget.lines.add_segments(vertices[0::2], vertices[1::2], colors)
+        return widget
+
+def camera_pose(camera, pose):
+    """
+    Returns a copy of `camera` moved to `pose`: a Camera, a (position, target)
+    pair or a dict of Camera attributes (position, target, up, fov, near, far).
+    """
+    if isinstance(pose, Camera):
+        result = copy.deepcopy(pose)
+        result.aspect = camera.aspect
+        return result
+
+    result = copy.deepcopy(camera)
+    if not isinstance(pose, dict):
+        position, target = pose
+        pose = {"position": position, "target": target}
+    for name, value in pose.items():
+        if name in ("position", "target", "up"):
+            value = np.asarray(value, dtype=np.float32)
+        setattr(result, name, value)
+    return result
+
+def orbit_poses(center, radius, frames, pitch=30.0, start_yaw=0.0, turns=1.0):
+    """(position, target) poses circling `center`, e.g. for a turntable movie."""
+    center = np.asarray(center, dtype=np.float32)
+    poses = []
+    for yaw in start_yaw + np.arange(frames) * 360.0 * turns / frames:
+        orbit = Camera()
+        orbit.orbit(center, radius, pitch=pitch, yaw=yaw)
+        poses.append((orbit.position, center))
+    return poses
+
+# Per-process state of a pool worker, set up once by _init_worker
+_WORKER = {}
+
+def _setup_renderer(scene, trajectory, trajectory_options, context_factory, encoder, encoder_options):
+    import ipy_opengl_utils.base_opengl_widget as base_opengl_widget
+    if context_factory is not None:
+        # kept alive for the life of the process, widgets pick it up instead of opening a window
+        base_opengl_widget.IP_GL_INIT = context_factory()
+
+    widget = scene.build()
+    if trajectory is not None:
+        from ipy_opengl_utils.trajectory import open_trajectory
+        trajectory = open_trajectory(trajectory, **trajectory_options)
+    return {
+        "widget": widget,
+        "trajectory": trajectory,
+        "camera": copy.deepcopy(widget.camera),
+        "encoder": None if encoder is None else get_encoder(encoder, **encoder_options),
+    }
+
+def _init_worker(threads, *setup_args):
+    if threads is not None:
+        # llvmpipe rasterizer threads; several single-threaded workers scale better
+        # than one context fanning out, and it must be set before the context exists
+        os.environ["LP_NUM_THREADS"] = str(threads)
+    _WORKER.update(_setup_renderer(*setup_args))
+
+def _render_job(state, job):
+    pose, frame = job
+    widget = state["widget"]
+    if pose is not None:
+        widget.camera = camera_pose(state["camera"], pose)
+    if frame is not None:
+        widget.set_positions(state["trajectory"][frame])
+
+    image = widget.render_to_array()
+    encoder = state["encoder"]
+    # encoding happens in the worker too, the parent only writes bytes out
+    return image if encoder is None else encoder.encode(image)
+
+def _render_jobs(jobs):
+    return [_render_job(_WORKER, job) for job in jobs]
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def render_frames(scene, cameras=None, trajectory=None, frames=None, output=None, encoder="png",
+                  encoder_options=None, processes=None, threads_per_worker=None, context_factory=None,
+                  chunk_size=4, **trajectory_options):
+    """
+    Renders `scene` (a Scene or a ParticleWidget) offline for every camera pose
+    and/or trajectory frame, spreading the frames over a pool of worker processes
+    that each own a hidden GL context (EGL or OSMesa without a display) and a copy
+    of the scene.
+
+    `cameras` is a list of poses (see camera_pose); a single pose is used for every
+    frame. `trajectory` is anything open_trajectory accepts (`trajectory_options`
+    are passed on) and `frames` the frame indices to render, all by default. A file
+    trajectory is memory mapped by each worker instead of being copied to it.
+
+    `output` selects what happens to the frames, which always come out in order:
+    - a directory: an image sequence frame_00000.png, ... in `encoder`'s format,
+      returns the file paths;
+    - a writable binary file or pipe (e.g. the stdin of ffmpeg -f rawvideo
+      -pix_fmt rgb24 -s WxH -i -): raw rgb24 frames, returns the frame count;
+    - None: returns the (height, width, 3) uint8 frames as a list.
+
+    `processes` defaults to the CPU count; 0 renders in this process with the
+    current context. `threads_per_worker` caps Mesa's llvmpipe threads per worker
+    (CPU count / processes by default). `context_factory` is a picklable callable
+    creating and making current a GL context in a worker, by default
+    gl_context.create_context with the auto-selected backend.
+    """
+    if not isinstance(scene, Scene):
+        scene = Scene.from_widget(scene)
+
+    if trajectory is not None and frames is None:
+        from ipy_opengl_utils.trajectory import open_trajectory
+        frames = range(len(open_trajectory(trajectory, **trajectory_options)))
+    frames = None if frames is None else [int(frame) for frame in frames]
+    if cameras is not None and (isinstance(cameras, (Camera, dict)) or np.ndim(cameras[0]) == 1):
+        cameras = [cameras]
+
+    count = max(len(cameras) if cameras is not None else 0, len(frames) if frames is not None else 0)
+    if count == 0:
+        raise ValueError("Nothing to render: give camera poses and/or trajectory frames")
+    for name, values in (("cameras", cameras), ("frames", frames)):
+        if values is not None and len(values) not in (1, count):
+            raise ValueError(f"Got {len(values)} {name} for {count} frames")
+    jobs = [(None if cameras is None else cameras[i % len(cameras)],
+             None if frames is None else frames[i % len(frames)]) for i in range(count)]
+
+    to_directory = isinstance(output, (str, os.PathLike))
+    if to_directory:
+        encoder = get_encoder(encoder, **(encoder_options or {}))
+        encoder_options = {}
+        os.makedirs(output, exist_ok=True)
+    else:
+        encoder = None
+
+    cpus = os.cpu_count() or 1
+    if processes is None:
+        processes = cpus
+    processes = min(processes, count)
+    if threads_per_worker is None and processes > 0:
+        threads_per_worker = max(1, cpus // processes)
+    setup_args = (scene, trajectory, trajectory_options, context_factory, encoder, encoder_options or {})
+
+    def rendered():
+        if processes == 0:
+            # the current context, or a hidden window opened by the widget
+            state = _setup_renderer(scene, trajectory, trajectory_options, None, encoder, encoder_options or {})
+            try:
+                for job in jobs:
+                    yield _render_job(state, job)
+            finally:
+                state["widget"].close()
+            return
+        # spawn: a forked child would inherit the parent's GL context and driver threads
+        with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(threads_per_worker,) + setup_args) as pool:
+            for results in pool.map(_render_jobs, _chunks(jobs, chunk_size)):
+                yield from results
+
+    if to_directory:
+        paths = []
+        for i, data in enumerate(rendered()):
+            path = os.path.join(output, f"frame_{i:05d}.{encoder.format}")
+            with open(path, 'wb') as file:
+                file.write(data)
+            paths.append(path)
+        return paths
+
+    if output is not None:
+        written = 0
+        for image in rendered():
+            output.write(np.ascontiguousarray(image).tobytes())
+            written += 1
+        output.flush()
+        return written
+
+    return list(rendered())
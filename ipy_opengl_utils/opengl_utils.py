@@ -1,10 +1,15 @@
 from OpenGL.GL import *
-import glfw
 import numpy as np
 from PIL import Image
 import io
+import ctypes
+from ipy_opengl_utils.gl_state import gl_state
+from ipy_opengl_utils.gpu_resources import gpu_resources, TEXEL_BYTES
+from ipy_opengl_utils.profiling import profile_stage
 
 def open_hidden_window(width=100, height=100):
+    # imported here so display-less machines don't need GLFW at all
+    import glfw
     if not glfw.init():
         raise Exception("GLFW can't be initialized")
     
@@ -19,13 +24,23 @@ def open_hidden_window(width=100, height=100):
 
     return window
 
-def buffer_setup(width, height):
+def buffer_setup(width, height, extra_attachments=()):
+    """
+    Creates a framebuffer with an RGB color texture at GL_COLOR_ATTACHMENT0 and a
+    depth/stencil renderbuffer. `extra_attachments` is a list of
+    (internal_format, format, type) tuples, e.g. (GL_R32I, GL_RED_INTEGER, GL_INT),
+    each allocated as a texture at GL_COLOR_ATTACHMENT1, 2, ... Only attachment 0
+    is enabled for drawing; passes that write the others select them with glDrawBuffers.
+    The attachments are freed along with the framebuffer by delete_framebuffer.
+    """
     # create a framebuffer and bind it
-    fbo = glGenFramebuffers(1)
-    glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+    state = gl_state()
+    resources = gpu_resources()
+    fbo = resources.create("framebuffer")
+    state.bind_framebuffer(fbo)
 
     # create a texture and bind it
-    texture = glGenTextures(1)
+    texture = resources.create("texture", nbytes=width * height * TEXEL_BYTES[GL_RGB], parent=("framebuffer", fbo))
     glBindTexture(GL_TEXTURE_2D, texture)
 
     # allocate memory to the texture and set scaling parameters
@@ -36,8 +51,21 @@ def buffer_setup(width, height):
     # attach the framebuffer to the texture
     glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, texture, 0)
 
+    # additional color attachments, e.g. integer ID buffers
+    for i, (internal_format, pixel_format, pixel_type) in enumerate(extra_attachments, start=1):
+        attachment = resources.create("texture", nbytes=width * height * TEXEL_BYTES.get(internal_format, 4),
+                                      parent=("framebuffer", fbo))
+        glBindTexture(GL_TEXTURE_2D, attachment)
+        glTexImage2D(GL_TEXTURE_2D, 0, internal_format, width, height, 0, pixel_format, pixel_type, None)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0 + i, GL_TEXTURE_2D, attachment, 0)
+    glBindTexture(GL_TEXTURE_2D, 0)
+    glDrawBuffers(1, [GL_COLOR_ATTACHMENT0])
+
     # create a render buffer to store depth and stencil data, attach it to the framebuffer
-    rbo = glGenRenderbuffers(1)
+    rbo = resources.create("renderbuffer", nbytes=width * height * TEXEL_BYTES[GL_DEPTH24_STENCIL8],
+                           parent=("framebuffer", fbo))
     glBindRenderbuffer(GL_RENDERBUFFER, rbo)
     glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH24_STENCIL8, width, height)
     glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_STENCIL_ATTACHMENT, GL_RENDERBUFFER, rbo)
@@ -46,25 +74,46 @@ def buffer_setup(width, height):
         raise RuntimeError("ERROR::FRAMEBUFFER:: Framebuffer is not complete!")
 
     # unbind the framebuffer
-    glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    state.bind_framebuffer(0)
 
     return fbo
 
-def framebuffer_to_image(fbo, width, height):
-    # bind the framebuffer
-    glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+def multisample_buffer_setup(width, height, samples):
+    """
+    Creates a framebuffer with multisampled RGB8 color and depth/stencil
+    renderbuffers, for antialiased rendering. It can't be read back directly:
+    resolve it into a buffer_setup framebuffer of the same size with
+    GLState.blit_framebuffer. `samples` is capped at what the driver supports.
+    """
+    state = gl_state()
+    resources = gpu_resources()
+    samples = max(1, min(samples, int(glGetIntegerv(GL_MAX_SAMPLES))))
+    fbo = resources.create("framebuffer")
+    state.bind_framebuffer(fbo)
 
-    # read and store buffer data
-    glReadBuffer(GL_COLOR_ATTACHMENT0)
-    data = glReadPixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE)
-    
-    # unbind framebuffer
-    glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    for attachment, internal_format in ((GL_COLOR_ATTACHMENT0, GL_RGB8),
+                                        (GL_DEPTH_STENCIL_ATTACHMENT, GL_DEPTH24_STENCIL8)):
+        rbo = resources.create("renderbuffer", nbytes=width * height * samples * TEXEL_BYTES[internal_format],
+                               parent=("framebuffer", fbo))
+        glBindRenderbuffer(GL_RENDERBUFFER, rbo)
+        glRenderbufferStorageMultisample(GL_RENDERBUFFER, samples, internal_format, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, rbo)
+    glDrawBuffers(1, [GL_COLOR_ATTACHMENT0])
 
-    # create an image from data
-    image_data = np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
-    image_data_flipped = np.flipud(image_data)
-    pil_image = Image.fromarray(image_data_flipped)
+    if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+        raise RuntimeError("ERROR::FRAMEBUFFER:: Multisample framebuffer is not complete!")
+
+    state.bind_framebuffer(0)
+    return fbo
+
+def delete_framebuffer(fbo):
+    """Deletes a framebuffer made by buffer_setup together with its attachments."""
+    gpu_resources().release("framebuffer", fbo)
+
+def framebuffer_to_image(fbo, width, height, reader=None):
+    # read the framebuffer, top row first
+    image_data = framebuffer_to_array(fbo, width, height, reader)
+    pil_image = Image.fromarray(image_data)
     
     # save data to a binary memory buffer
     buffer = io.BytesIO()
@@ -72,6 +121,16 @@ def framebuffer_to_image(fbo, width, height):
 
     return buffer
 
+def read_pixel_int(fbo, attachment, x, y):
+    """Reads a single texel of an integer color attachment, e.g. an ID buffer."""
+    state = gl_state()
+    state.bind_framebuffer(fbo)
+    state.bind_buffer(GL_PIXEL_PACK_BUFFER, 0)
+    glReadBuffer(attachment)
+    data = glReadPixels(x, y, 1, 1, GL_RED_INTEGER, GL_INT)
+    glReadBuffer(GL_COLOR_ATTACHMENT0)
+    return int(np.asarray(data).ravel()[0])
+
 def load_texture_pillow(path):
     """Loads an image from a file into an OpenGL texture using Pillow."""
     try:
@@ -80,7 +139,7 @@ def load_texture_pillow(path):
         img_data = img.convert("RGBA").tobytes()
         width, height = img.size
         
-        texture = glGenTextures(1)
+        texture = gpu_resources().create("texture", nbytes=width * height * 4)
         
         glBindTexture(GL_TEXTURE_2D, texture)
         
@@ -99,12 +158,173 @@ def load_texture_pillow(path):
         print(f"Error: The file '{path}' was not found.")
         return None
 
-def framebuffer_to_array(fbo, width, height):
-    glBindFramebuffer(GL_FRAMEBUFFER, fbo)
+def framebuffer_to_array(fbo, width, height, reader=None):
+    """
+    Returns the color attachment of `fbo` as a (height, width, 3) uint8 array, top row first.
+    With a FramebufferReader the transfer goes through its pixel buffer objects.
+    """
+    if reader is not None:
+        reader.resize(width, height)
+        return reader.read_now(fbo)
+
+    state = gl_state()
+    state.bind_framebuffer(fbo)
+    state.bind_buffer(GL_PIXEL_PACK_BUFFER, 0)
+    state.pack_alignment(1)
     glReadBuffer(GL_COLOR_ATTACHMENT0)
     data = glReadPixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE)
-    glBindFramebuffer(GL_FRAMEBUFFER, 0)
     image_data = np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
     image_data_flipped = np.flipud(image_data)
     return image_data_flipped
 
+def framebuffer_depth(fbo, width, height):
+    """
+    Returns the depth attachment of `fbo` as a (height, width) float32 array of window
+    depths, bottom row first. Leaves `fbo` bound so it can be used mid-frame.
+    """
+    state = gl_state()
+    state.bind_framebuffer(fbo)
+    state.bind_buffer(GL_PIXEL_PACK_BUFFER, 0)
+    state.pack_alignment(4)
+    data = glReadPixels(0, 0, width, height, GL_DEPTH_COMPONENT, GL_FLOAT)
+    return np.asarray(data, dtype=np.float32).reshape(height, width)
+
+class FramebufferReader:
+    """
+    Asynchronous framebuffer readback through a ring of pixel buffer objects.
+
+    `begin` queues a glReadPixels into the next PBO and drops a fence after it, so
+    the call returns before the GPU has finished rendering. `end` waits on the
+    oldest fence, maps that PBO and copies it out flipped, which is the only copy
+    made of the frame. `read` combines both with `latency` frames in flight: with
+    latency=1, frame N is mapped while frame N+1 renders. `flush` drains the ring
+    and returns the newest frame, e.g. for the last frame of an interaction.
+    With a `profiler` (see profiling.FrameProfiler) the read, the wait for the
+    GPU and the copy out of the mapping are timed as separate stages.
+    """
+
+    def __init__(self, width, height, buffers=2, latency=0, profiler=None):
+        if not 0 <= latency < buffers:
+            raise ValueError(f"latency must be in [0, {buffers}), got {latency}")
+        self.buffers = buffers
+        self.latency = latency
+        self.profiler = profiler
+        self.width = 0
+        self.height = 0
+        self.pbos = gpu_resources().create("buffer", buffers)
+
+        self._next = 0
+        self._pending = []  # (pbo index, fence) in submission order
+        self.last_frame = None
+
+        self.resize(width, height)
+
+    @property
+    def frame_bytes(self):
+        return self.width * self.height * 3
+
+    def resize(self, width, height):
+        if (width, height) == (self.width, self.height):
+            return
+        # frames queued at the old size cannot be reinterpreted, drop them
+        self._discard_pending()
+        self.width = width
+        self.height = height
+        state = gl_state()
+        resources = gpu_resources()
+        for pbo in self.pbos:
+            state.bind_buffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, self.frame_bytes, None, GL_STREAM_READ)
+            resources.set_bytes("buffer", pbo, self.frame_bytes)
+        self.last_frame = None
+
+    def begin(self, fbo):
+        """Queues an asynchronous read of the color attachment of `fbo`."""
+        if len(self._pending) == self.buffers:
+            # every PBO is in flight: retire the oldest so its buffer can be reused
+            self.end()
+
+        index = self._next
+        self._next = (self._next + 1) % self.buffers
+
+        with profile_stage(self.profiler, "read_pixels", gpu=True):
+            state = gl_state()
+            state.bind_framebuffer(fbo)
+            state.pack_alignment(1)
+            state.bind_buffer(GL_PIXEL_PACK_BUFFER, self.pbos[index])
+            glReadBuffer(GL_COLOR_ATTACHMENT0)
+            glReadPixels(0, 0, self.width, self.height, GL_RGB, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+
+        fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self._pending.append((index, fence))
+
+    def ready(self):
+        """True if the oldest queued frame can be mapped without blocking."""
+        if not self._pending:
+            return False
+        status = glClientWaitSync(self._pending[0][1], 0, 0)
+        return status in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED)
+
+    def end(self, timeout_ns=1000000000):
+        """Waits for the oldest queued frame and returns it as a (height, width, 3) array."""
+        if not self._pending:
+            return None
+        index, fence = self._pending.pop(0)
+
+        with profile_stage(self.profiler, "readback_wait"):
+            flags = GL_SYNC_FLUSH_COMMANDS_BIT
+            while glClientWaitSync(fence, flags, timeout_ns) == GL_TIMEOUT_EXPIRED:
+                flags = 0
+            glDeleteSync(fence)
+
+        with profile_stage(self.profiler, "map_copy"):
+            frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+            gl_state().bind_buffer(GL_PIXEL_PACK_BUFFER, self.pbos[index])
+            address = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, self.frame_bytes, GL_MAP_READ_BIT)
+            try:
+                mapped = np.frombuffer((ctypes.c_ubyte * self.frame_bytes).from_address(address), dtype=np.uint8)
+                # GL rows are bottom-up: flip while copying out of the mapping
+                np.copyto(frame, mapped.reshape(self.height, self.width, 3)[::-1])
+            finally:
+                glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+
+        self.last_frame = frame
+        return frame
+
+    def read(self, fbo):
+        """
+        Queues a read of `fbo` and returns the frame submitted `latency` reads ago,
+        or None while the pipeline is still filling up.
+        """
+        self.begin(fbo)
+        frame = None
+        while len(self._pending) > self.latency:
+            frame = self.end()
+        return frame
+
+    def read_now(self, fbo):
+        """Synchronous read of `fbo`, still through the PBOs."""
+        self.begin(fbo)
+        return self.flush()
+
+    def flush(self):
+        """Waits for every queued frame and returns the newest one."""
+        frame = None
+        while self._pending:
+            frame = self.end()
+        return frame
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def _discard_pending(self):
+        for _, fence in self._pending:
+            glDeleteSync(fence)
+        self._pending = []
+
+    def delete(self):
+        self._discard_pending()
+        gpu_resources().release("buffer", self.pbos)
+        self.pbos = []
+
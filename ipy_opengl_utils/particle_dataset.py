@@ -0,0 +1,223 @@
+import numpy as np
+from ipy_opengl_utils.instance_buffer import InstanceBuffer
+from ipy_opengl_utils.gpu_resources import gpu_resources, owns_gl_objects
+
+class ParticleDataset:
+    """
+    Particle positions (+ radii) and colors stored once per GL context, in
+    CPU-mirrored instance buffers that any number of ParticleWidgets draw from.
+
+    Each view keeps its own camera, size, selection and draw lists and binds the
+    shared buffers into its own VAOs. An update is uploaded once, by whichever view
+    draws first, and every view is told about it so it can drop stale pick indices;
+    `request_draw` redraws them all.
+    """
+
+    # Storage of the instance colors as (components, dtype, normalized); the shader only reads rgb
+    COLOR_FORMATS = {
+        "float32": (3, np.float32, False),
+        "float16": (4, np.float16, False),
+        "uint8": (4, np.uint8, True),
+    }
+
+    @owns_gl_objects
+    def __init__(self, per_particle_radius=False, color_format="float32", double_buffered=False, particle_radius=1.0):
+        # Instance layout: xyz (+ radius) float32 positions and colors in `color_format`,
+        # from 24 bytes per particle (float32 rgb) down to 16 (uint8 rgba, shared radius)
+        if color_format not in self.COLOR_FORMATS:
+            raise ValueError(f"Unknown color format '{color_format}', expected one of {sorted(self.COLOR_FORMATS)}")
+        self.per_particle_radius = per_particle_radius
+        self.color_format = color_format
+        self._particle_radius = particle_radius
+
+        color_components, color_dtype, color_normalized = self.COLOR_FORMATS[color_format]
+        self.position_buffer = InstanceBuffer(4 if per_particle_radius else 3, np.float32,
+                                              double_buffered=double_buffered)
+        self.color_buffer = InstanceBuffer(color_components, color_dtype, double_buffered=double_buffered,
+                                           normalized=color_normalized)
+
+        self.views = []
+
+    def __len__(self):
+        return len(self.position_buffer)
+
+    def add_view(self, view):
+        if view not in self.views:
+            self.views.append(view)
+
+    def remove_view(self, view, vaos=()):
+        """Forgets `view` and the VAOs it bound the instance buffers into."""
+        for vao in vaos:
+            self.position_buffer.detach(vao)
+            self.color_buffer.detach(vao)
+        if view in self.views:
+            self.views.remove(view)
+
+    def _notify(self, change):
+        # "append", "geometry" (positions or radii changed), "colors" or "remove"
+        for view in self.views:
+            view._on_dataset_change(change)
+
+    def request_draw(self):
+        """Asks every view for a redraw."""
+        for view in self.views:
+            view.request_draw()
+
+    @property
+    def particle_radius(self):
+        """Radius of the particles without one of their own."""
+        return self._particle_radius
+
+    @particle_radius.setter
+    def particle_radius(self, radius):
+        if radius != self._particle_radius:
+            self._particle_radius = radius
+            self._notify("geometry")
+
+    @property
+    def positions(self):
+        return self.position_buffer.data[:, :3]
+
+    @property
+    def colors(self):
+        data = self.color_buffer.data[:, :3]
+        if self.color_format == "float32":
+            return data
+        if self.color_format == "uint8":
+            return data.astype(np.float32) / 255.0
+        return data.astype(np.float32)
+
+    @property
+    def radii(self):
+        if self.per_particle_radius:
+            return self.position_buffer.data[:, 3]
+        return np.full(len(self), self._particle_radius, dtype=np.float32)
+
+    def radius_values(self):
+        """The radii as a view, or a scalar when all particles share the radius."""
+        return self.position_buffer.data[:, 3] if self.per_particle_radius else self._particle_radius
+
+    def position_rows(self, positions, radii=None):
+        """(N, 3) positions (+ radii) in the layout of the position buffer."""
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        if not self.per_particle_radius:
+            if radii is not None:
+                raise ValueError("Per-particle radii need per_particle_radius=True")
+            return positions
+        rows = np.empty((len(positions), 4), dtype=np.float32)
+        rows[:, :3] = positions
+        rows[:, 3] = self._particle_radius if radii is None else radii
+        return rows
+
+    def encode_colors(self, colors):
+        """Converts (N, 3) float colors in [0, 1] to the storage format."""
+        colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+        components, dtype, normalized = self.COLOR_FORMATS[self.color_format]
+        if components == 3:
+            return colors
+        rows = np.ones((len(colors), components), dtype=np.float32)
+        rows[:, :3] = colors
+        if normalized:
+            return np.rint(np.clip(rows, 0.0, 1.0) * np.iinfo(dtype).max).astype(dtype)
+        return rows.astype(dtype)
+
+    def set_all(self, positions=None, colors=None):
+        """
+        Replaces all positions and/or colors; radii are kept if the count does not
+        change. Changing the count needs both, so the two buffers stay the same length.
+        """
+        if positions is not None:
+            positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        if colors is not None:
+            colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+        count = len(positions) if positions is not None else len(colors) if colors is not None else len(self)
+        if positions is not None and colors is not None and len(positions) != len(colors):
+            raise ValueError(f"Got {len(positions)} positions but {len(colors)} colors")
+        if count != len(self) and (positions is None or colors is None):
+            raise ValueError(f"Changing the particle count from {len(self)} to {count} needs both positions and colors")
+
+        if positions is not None:
+            radii = self.radii if self.per_particle_radius and len(positions) == len(self) else None
+            self.position_buffer.set_data(self.position_rows(positions, radii))
+            self._notify("geometry")
+        if colors is not None:
+            self.color_buffer.set_data(self.encode_colors(colors))
+            self._notify("colors")
+
+    def set_positions(self, positions, start=0):
+        self.position_buffer.write(positions, start, columns=slice(0, 3))
+        self._notify("geometry")
+
+    def set_colors(self, colors, start=0):
+        self.color_buffer.write(self.encode_colors(colors), start)
+        self._notify("colors")
+
+    def set_radii(self, radii, start=0):
+        if not self.per_particle_radius:
+            raise ValueError("Per-particle radii need per_particle_radius=True")
+        self.position_buffer.write(radii, start, columns=slice(3, 4))
+        self._notify("geometry")
+
+    def update(self, indices=None, positions=None, colors=None, radii=None):
+        """See ParticleWidget.update_particles."""
+        if indices is None:
+            indices = slice(0, len(self))
+        if radii is not None and not self.per_particle_radius:
+            raise ValueError("Per-particle radii need per_particle_radius=True")
+        if colors is not None:
+            colors = self.encode_colors(colors)
+
+        updates = ((self.position_buffer, positions, slice(0, 3)), (self.color_buffer, colors, None),
+                   (self.position_buffer, radii, slice(3, 4)))
+        for buffer, values, columns in updates:
+            if values is None:
+                continue
+            if isinstance(indices, slice):
+                start, stop, step = indices.indices(len(buffer))
+                if step == 1:
+                    buffer.write(values, start, columns)
+                    continue
+                indices = np.arange(start, stop, step)
+            buffer.write_indices(indices, values, columns)
+
+        if positions is not None or radii is not None:
+            self._notify("geometry")
+        elif colors is not None:
+            self._notify("colors")
+
+    def invalidate(self, start=0, stop=None):
+        """Flags particles [start, stop) for upload after editing the buffer data in place."""
+        self.position_buffer.mark_dirty(start, stop)
+        self.color_buffer.mark_dirty(start, stop)
+        self._notify("geometry")
+
+    def add(self, positions, colors, radii=None):
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        colors = np.asarray(colors, dtype=np.float32).reshape(-1, 3)
+        if len(positions) != len(colors):
+            raise ValueError(f"Got {len(positions)} positions but {len(colors)} colors")
+
+        # Append into the preallocated stores; only the new tail is uploaded on draw
+        self.position_buffer.append(self.position_rows(positions, radii))
+        self.color_buffer.append(self.encode_colors(colors))
+        self._notify("append")
+
+    def remove(self, indices):
+        """Removes the particles selected by `indices` (index array or boolean mask)."""
+        self.position_buffer.remove(indices)
+        self.color_buffer.remove(indices)
+        self._notify("remove")
+
+    def reserve(self, count):
+        """Preallocates room for `count` particles to avoid regrowth while streaming."""
+        self.position_buffer.reserve(count)
+        self.color_buffer.reserve(count)
+
+    def sync(self):
+        """Uploads pending changes, returning the number of bytes sent; a no-op for every view but the first."""
+        return self.position_buffer.sync() + self.color_buffer.sync()
+
+    def close(self):
+        """Frees the instance buffers; views still drawing from them must be closed first."""
+        self.views = []
+        gpu_resources().release_owner(self.resource_owner)
@@ -1,55 +1,95 @@
 from ipy_opengl_utils.base_opengl_widget import BaseOpenglWidget
-from ipy_opengl_utils.shader_utils import ShaderProgram
+from ipy_opengl_utils.shader_utils import get_shader_program, release_shader_program, CameraUniformBuffer
 from ipy_opengl_utils.camera import Camera
 from ipy_opengl_utils.mesh_utils import generate_sphere_mesh
-from ipy_opengl_utils.opengl_utils import framebuffer_to_array
-from ipy_opengl_utils.math_utils import unproject_ray, ray_sphere_intersect
+from ipy_opengl_utils.opengl_utils import read_pixel_int
+from ipy_opengl_utils.math_utils import unproject_ray, nearest_ray_sphere, ray_spheres_intersect, screen_radius
+from ipy_opengl_utils.particle_dataset import ParticleDataset
+from ipy_opengl_utils.spatial_index import UniformGrid
+from ipy_opengl_utils.draw_list import InstanceDrawList, group_by_level
+from ipy_opengl_utils.line_batch import LineBatch
+from ipy_opengl_utils.culling import ParticleCuller, build_depth_pyramid
+from ipy_opengl_utils.trajectory import open_trajectory, TrajectoryPlayer
+from ipy_opengl_utils.redraw_scheduler import running_loop
+from ipy_opengl_utils.gpu_resources import gpu_resources, owns_gl_objects
 from OpenGL.GL import *
 import numpy as np
-import time
 import os
 
 class ParticleWidget(BaseOpenglWidget):
-    def __init__(self, width, height, select_particles=False, draw_axes=False):
-        super().__init__(width, height)
-
-        shader_dir = os.path.join(os.path.dirname(__file__), "shaders")
-        self.shader = ShaderProgram(
-            vertex_source=os.path.join(shader_dir, "vertex_shader.glsl"),
-            fragment_source=os.path.join(shader_dir, "fragment_shader.glsl")
-        )
-        self.line_shader = ShaderProgram(
-            vertex_source=os.path.join(shader_dir, "line_vertex_shader.glsl"),
-            fragment_source=os.path.join(shader_dir, "line_fragment_shader.glsl")
-        )
+    # Sphere levels of detail as (stacks, slices, minimum on-screen radius in pixels), finest first
+    LOD_LEVELS = ((16, 16, 24.0), (10, 10, 10.0), (6, 6, 4.0), (4, 4, 0.0))
+
+    COLOR_FORMATS = ParticleDataset.COLOR_FORMATS
+
+    # Below this many particles a brute-force ray test picks faster than the grid index
+    SPATIAL_INDEX_MIN_PARTICLES = 1_000_000
+
+    @owns_gl_objects
+    def __init__(self, width, height, select_particles=False, draw_axes=False, double_buffered=False, spatial_index=False,
+                 pick_mode="cpu", render_mode="mesh", lod=False, lod_levels=None, culling=False,
+                 occlusion_culling=False, per_particle_radius=False, color_format="float32", dataset=None, **kwargs):
+        super().__init__(width, height, **kwargs)
+
+        # The particles, possibly shared with other widgets showing them from other angles;
+        # a shared dataset brings its own layout, so per_particle_radius, color_format and
+        # double_buffered only apply to the private one created otherwise
+        self.owns_dataset = dataset is None
+        if dataset is None:
+            dataset = ParticleDataset(per_particle_radius, color_format, double_buffered)
+        self.dataset = dataset
+        dataset.add_view(self)
+        position_components = self.position_buffer.components
+        color_components, color_dtype, color_normalized = self.COLOR_FORMATS[dataset.color_format]
+
+        # programs and meshes are built on first display or draw, see init_gl
+        self.shader = None
+        self.line_shader = None
+        self.shader_dir = os.path.join(os.path.dirname(__file__), "shaders")
+
+        # view/projection/viewPos for every program, uploaded once per frame
+        self.camera_uniforms = CameraUniformBuffer()
+
+        # "mesh" instances a tessellated sphere, "impostor" ray casts spheres on camera-facing quads
+        self.render_mode = render_mode
+        self.impostor_shader = None
+        self.impostor_vao = None
+        self.impostor_vbo = None
+        self.impostor_list_vao = None
+
+        # Distance-based level of detail: one instanced draw per mesh level
+        self.lod = lod
+        self.lod_levels = tuple(lod_levels) if lod_levels is not None else self.LOD_LEVELS
+        self.lod_meshes = []
+
+        # Frustum (and optionally occlusion) culling over a coarse cluster grid
+        self.culling = culling or occlusion_culling
+        self.culler = ParticleCuller(occlusion=occlusion_culling)
+
+        # Instances actually drawn when culling or LOD is active; the late list holds
+        # clusters revealed by the occlusion test
+        self.draw_list = InstanceDrawList(position_components, color_components, color_dtype, color_normalized)
+        self.late_draw_list = InstanceDrawList(position_components, color_components, color_dtype, color_normalized)
+        # Particles the GPU pick ray passes through, see _pick_particle_gpu
+        self.pick_draw_list = InstanceDrawList(position_components, color_components, color_dtype, color_normalized)
         
         self.camera = Camera(position=(0, 0, 20), aspect=width/height)
         self.view = self.camera.get_view_matrix()
         self.projection = self.camera.get_projection_matrix()
 
-        self.positions = np.array([], dtype=np.float32)
-        self.colors = np.array([], dtype=np.float32)
-        
         self.sphere_vao = None
         self.sphere_vbo = None
         self.sphere_ebo = None
-        self.instance_vbo = None
-        self.color_vbo = None
+        self.sphere_detail = (16, 16)
         self.index_count = 0
         self._dragging = False
 
-        self._redraw_pending = False
-        self._last_redraw = 0
-        self._redraw_interval = 1 / 60
-
         self.yaw = 45.0
         self.pitch = 30.0
         self.radius = 20.0
 
-        glEnable(GL_DEPTH_TEST)
-        glEnable(GL_CULL_FACE)
-        glCullFace(GL_BACK)
-        glFrontFace(GL_CW)
+        # The sphere mesh winds clockwise; applied before each draw of this widget
+        self.render_state["front_face"] = (GL_CW,)
 
         self.canvas.on_mouse_down(self._on_mouse_down)
         self.canvas.on_mouse_up(self._on_mouse_up)
@@ -58,13 +98,37 @@ class ParticleWidget(BaseOpenglWidget):
 
         self.select_particles = select_particles
         self.selection_index = -1
+        # "cpu" ray casts against the particle spheres, "gpu" reads the ID buffer under the cursor
+        self.pick_mode = pick_mode
+
+        # Optional acceleration structure for picking, kept in sync by add_particles once
+        # there are enough particles for it to pay off
+        self.spatial_index = UniformGrid(radius=self.particle_radius) if spatial_index else None
+
+        # Trajectory playback, see play_trajectory
+        self.player = None
 
         self.draw_axes = draw_axes
+        self.axes = LineBatch(line_width=3.0)
+        # user overlay segments (boxes, trajectories, bonds...), one draw call in total
+        self.lines = LineBatch()
 
         self.setup_axes()
         self.setup_sphere_buffers()
         self.camera_setup()
 
+    @owns_gl_objects
+    def init_gl(self):
+        self.shader = get_shader_program(
+            vertex_source=os.path.join(self.shader_dir, "vertex_shader.glsl"),
+            fragment_source=os.path.join(self.shader_dir, "fragment_shader.glsl")
+        )
+        self.line_shader = get_shader_program(
+            vertex_source=os.path.join(self.shader_dir, "line_vertex_shader.glsl"),
+            fragment_source=os.path.join(self.shader_dir, "line_fragment_shader.glsl")
+        )
+        self.setup_sphere_buffers(None, *self.sphere_detail)
+
     def _on_mouse_down(self, x, y):
         self._dragging = True
         self._last_mouse = (x, y)
@@ -84,15 +148,78 @@ class ParticleWidget(BaseOpenglWidget):
 
             self.camera.orbit(self.center, radius=self.radius, pitch=self.pitch, yaw=self.yaw)
 
-            #self.draw()
-            #self.update_image()
-            self._throttled_draw()
+            self.mark_interaction()
+            self.request_draw()
             self._last_mouse = (x, y)
         
         elif self.select_particles:
             self._pick_particle(x, y)
  
+    def _fbo_attachments(self):
+        # Integer instance ID buffer for GPU picking
+        return ((GL_R32I, GL_RED_INTEGER, GL_INT),)
+
     def _pick_particle(self, x, y):
+        if self.pick_mode == "gpu":
+            selected = self._pick_particle_gpu(x, y)
+        else:
+            selected = self._pick_particle_cpu(x, y)
+
+        changed = selected >= 0 and selected != self.selection_index
+        self.selection_index = selected
+        if changed:
+            self.request_draw()
+
+    @owns_gl_objects
+    def _pick_particle_gpu(self, x, y):
+        """
+        Renders instance IDs into the ID attachment for the single pixel under the
+        cursor and reads it back. Only the particles whose sphere the ray through
+        that pixel hits are drawn (every triangle of a sphere lies inside it), so the
+        pass costs one ray test per particle on the CPU plus a handful of instances.
+
+        The ID pass rasterizes the same meshes as the frame (impostors are exact), so
+        at silhouettes it can disagree with the exact spheres of the CPU pick. With
+        LOD the coarse levels make that frequent, so the CPU pick wins there.
+        """
+        px = int(x)
+        py = self.height - 1 - int(y)
+        if not (0 <= px < self.width and 0 <= py < self.height) or len(self.positions) == 0:
+            return -1
+
+        # Ray through the pixel center, the point the rasterizer samples
+        ndc_x = 2.0 * (px + 0.5) / self.width - 1.0
+        ndc_y = 2.0 * (py + 0.5) / self.height - 1.0
+        ray_origin, ray_dir = unproject_ray(ndc_x, ndc_y, self.camera)
+        # slightly larger spheres so rounding never drops a covering particle
+        hit = ray_spheres_intersect(ray_origin, ray_dir, self.positions, self._radius_values() * 1.01)
+        candidates = np.flatnonzero(np.isfinite(hit))
+        if len(candidates) == 0:
+            return -1
+
+        # Only the full resolution framebuffer has the ID attachment
+        with self.render_target():
+            self.bind_render_state()
+            glDrawBuffers(2, [GL_NONE, GL_COLOR_ATTACHMENT1])
+            self.gl.enable(GL_SCISSOR_TEST)
+            self.gl.scissor(px, py, 1, 1)
+
+            glClearBufferiv(GL_COLOR, 1, np.array([-1, 0, 0, 0], dtype=np.int32))
+            glClear(GL_DEPTH_BUFFER_BIT)
+            self._draw_spheres(pick_indices=candidates)
+
+            self.gl.disable(GL_SCISSOR_TEST)
+            glDrawBuffers(1, [GL_COLOR_ATTACHMENT0])
+
+            selected = read_pixel_int(self.fbo, GL_COLOR_ATTACHMENT1, px, py)
+
+        if self.lod and self.render_mode != "impostor":
+            exact = self._pick_particle_cpu(x, y)
+            if exact != selected:
+                return exact
+        return selected
+
+    def _pick_particle_cpu(self, x, y):
         # Convert (x, y) to normalized device coordinates
         ndc_x = (2.0 * x) / self.width - 1.0
         y_flipped = self.height - y
@@ -100,24 +227,24 @@ class ParticleWidget(BaseOpenglWidget):
 
         # Unproject to get ray in world space
         ray_origin, ray_dir = unproject_ray(ndc_x, ndc_y, self.camera)
-        min_dist = float('inf')
-        selected = -1
-        for i, pos in enumerate(self.positions):
-            hit, dist = ray_sphere_intersect(ray_origin, ray_dir, pos, 1.0)  # 1.0 = sphere radius
-            if hit and dist < min_dist:
-                min_dist = dist
-                selected = i
-
-        if selected >= 0 and selected != self.selection_index:
-            self._throttled_draw()
-        
-        self.selection_index = selected
+        radius = self._radius_values()
+        if self._uses_spatial_index():
+            # the grid only finds spheres no larger than its radius
+            max_radius = float(np.max(radius)) if len(self.positions) else 0.0
+            if max_radius > self.spatial_index.radius:
+                self.spatial_index.radius = max_radius
+                self.spatial_index.invalidate()
+            selected, _ = self.spatial_index.intersect_ray(self.positions, ray_origin, ray_dir, radius)
+        else:
+            selected, _ = nearest_ray_sphere(ray_origin, ray_dir, self.positions, radius)
+        return selected
 
     def _on_wheel(self, delta_x, delta_y):
         self.radius += delta_y * 0.1
         self.radius = max(1.0, self.radius)
         self.camera.orbit(self.center, radius=self.radius, pitch=self.pitch, yaw=self.yaw)
-        self._throttled_draw()
+        self.mark_interaction()
+        self.request_draw()
     
     def camera_setup(self):
         if len(self.positions) == 0:
@@ -130,38 +257,182 @@ class ParticleWidget(BaseOpenglWidget):
         self.center = center
         self.camera.orbit(center, radius=self.radius, pitch=self.pitch, yaw=self.yaw)
 
-    def update_particles(self):
-        pass
+    @property
+    def position_buffer(self):
+        """CPU-mirrored instance buffer of the positions (+ radii), owned by the dataset."""
+        return self.dataset.position_buffer
+
+    @property
+    def color_buffer(self):
+        return self.dataset.color_buffer
+
+    @property
+    def per_particle_radius(self):
+        return self.dataset.per_particle_radius
+
+    @property
+    def color_format(self):
+        return self.dataset.color_format
+
+    @property
+    def particle_radius(self):
+        """Radius shared by particles without their own, a property of the dataset."""
+        return self.dataset.particle_radius
+
+    @particle_radius.setter
+    def particle_radius(self, radius):
+        self.dataset.particle_radius = radius
+
+    @property
+    def positions(self):
+        """(N, 3) view of the particle centers; call `invalidate_particles` after editing it in place."""
+        return self.dataset.positions
+
+    @positions.setter
+    def positions(self, positions):
+        self.dataset.set_all(positions=positions)
+
+    @property
+    def colors(self):
+        """(N, 3) float colors in [0, 1]; a decoded copy unless colors are stored as float32."""
+        return self.dataset.colors
+
+    @colors.setter
+    def colors(self, colors):
+        self.dataset.set_all(colors=colors)
+
+    @property
+    def radii(self):
+        """(N,) particle radii; a view when they are stored per particle."""
+        return self.dataset.radii
+
+    def _radius_values(self):
+        # scalar when all particles share the radius, which keeps the math cheaper
+        return self.dataset.radius_values()
+
+    def set_positions(self, positions, start=0):
+        """Overwrites the positions of particles [start, start + len(positions))."""
+        self.dataset.set_positions(positions, start)
+
+    def set_colors(self, colors, start=0):
+        """Overwrites the colors of particles [start, start + len(colors))."""
+        self.dataset.set_colors(colors, start)
+
+    def set_radii(self, radii, start=0):
+        """Overwrites the radii of particles [start, start + len(radii))."""
+        self.dataset.set_radii(radii, start)
+
+    def update_particles(self, indices=None, positions=None, colors=None, redraw=True, radii=None):
+        """
+        Updates the positions, colors and/or radii of the particles selected by
+        `indices` (an index array, boolean mask or slice; all particles if None).
+        Only the touched range is uploaded on the next draw, once for all views.
+        """
+        self.dataset.update(indices, positions, colors, radii)
+        if redraw:
+            self.dataset.request_draw()
+
+    def invalidate_particles(self, start=0, stop=None):
+        """Flags particles [start, stop) for upload after `positions`/`colors` were edited in place."""
+        self.dataset.invalidate(start, stop)
+
+    def _on_dataset_change(self, change):
+        # called on every view of the dataset, whichever of them made the change
+        if change == "append":
+            # New particles go into the index's pending tail and are merged in batches
+            if self._uses_spatial_index():
+                self.spatial_index.insert(self.positions)
+        elif change in ("geometry", "remove"):
+            # also sent for radius changes, which move particles between LOD levels
+            self._invalidate_spatial_index()
+            self.draw_list.invalidate()
+            self.late_draw_list.invalidate()
+        if change == "remove":
+            self.selection_index = -1
+
+    def _uses_spatial_index(self):
+        return self.spatial_index is not None and len(self.positions) >= self.SPATIAL_INDEX_MIN_PARTICLES
+
+    def _invalidate_spatial_index(self):
+        if self.spatial_index is not None:
+            self.spatial_index.invalidate()
+
+    def sync_instances(self):
+        """Uploads pending instance changes, returning the number of bytes sent to the GPU."""
+        return self.dataset.sync()
+
+    def add_particles(self, positions, colors, update_cam=False, radii=None):
+        self.dataset.add(positions, colors, radii)
+        if update_cam:
+            self.camera_setup()
 
-    def add_particles(self, positions, colors, update_cam=False):
-        if len(self.positions) == 0:
-            self.positions = positions
-            self.colors = colors
-            self.setup_sphere_buffers()
-        
-        else:
-            # Append new particle positions to existing ones
-            self.positions = np.concatenate((self.positions, positions), axis=0)
-            self.colors = np.concatenate((self.colors, colors), axis=0)
-            self.setup_sphere_buffers()
+    def set_particles(self, positions, colors, update_cam=False):
+        """Replaces all particles; unlike assigning `positions` or `colors` alone, the count may change."""
+        self.dataset.set_all(positions, colors)
+        if update_cam:
+            self.camera_setup()
 
+    def remove_particles(self, indices, update_cam=False):
+        """Removes the particles selected by `indices` (index array or boolean mask)."""
+        self.dataset.remove(indices)
         if update_cam:
             self.camera_setup()
 
-    def setup_sphere_buffers(self, radius=1.0, stacks=16, slices=16):
-        # Generate sphere mesh
-        vertices, indices = generate_sphere_mesh(radius, stacks, slices)
+    def play_trajectory(self, source, fps=30, loop=True, prefetch=8, colors=None, autoplay=True, **open_options):
+        """
+        Plays a (frames, N, 3) trajectory: an array, a .npy/.npz file or a raw binary
+        file (see open_trajectory for `open_options`), memory mapped and streamed
+        frame by frame. Returns the TrajectoryPlayer with the playback controls.
+        """
+        if self.player is not None:
+            self.player.close()
+        self.player = TrajectoryPlayer(self, open_trajectory(source, **open_options), fps=fps, loop=loop,
+                                       prefetch=prefetch, colors=colors)
+        self.player.show(0)
+        if autoplay and running_loop() is not None:
+            self.player.play()
+        return self.player
+
+    def reserve_particles(self, count):
+        """Preallocates room for `count` particles to avoid regrowth while streaming."""
+        self.dataset.reserve(count)
+
+    @owns_gl_objects
+    def setup_sphere_buffers(self, radius=None, stacks=16, slices=16):
+        """
+        Builds the instanced sphere mesh; `radius` (kept if None) is the radius shared
+        by particles without their own, for every view of the dataset. Before the
+        first draw only the settings are kept, the mesh is built by init_gl.
+        """
+        if radius is not None:
+            self.particle_radius = radius
+        self.sphere_detail = (stacks, slices)
+        self.draw_list.invalidate()
+        self._invalidate_spatial_index()
+        if not self.gl_ready:
+            return
+
+        # Free the previous mesh objects when the mesh is rebuilt
+        resources = gpu_resources()
+        if self.sphere_vao is not None:
+            resources.release("vertex_array", self.sphere_vao)
+            resources.release("buffer", [self.sphere_vbo, self.sphere_ebo])
+            self.position_buffer.detach(self.sphere_vao)
+            self.color_buffer.detach(self.sphere_vao)
+
+        # Unit sphere, scaled per instance in the vertex shader
+        vertices, indices = generate_sphere_mesh(1.0, stacks, slices)
         self.index_count = len(indices)
 
         # Create VAO, VBO, EBO for sphere mesh
-        self.sphere_vao = glGenVertexArrays(1)
-        self.sphere_vbo = glGenBuffers(1)
-        self.sphere_ebo = glGenBuffers(1)
+        self.sphere_vao = resources.create("vertex_array")
+        self.sphere_vbo = resources.create("buffer", nbytes=vertices.nbytes)
+        self.sphere_ebo = resources.create("buffer", nbytes=indices.nbytes)
 
-        glBindVertexArray(self.sphere_vao)
+        self.gl.bind_vertex_array(self.sphere_vao)
 
         # Vertex positions
-        glBindBuffer(GL_ARRAY_BUFFER, self.sphere_vbo)
+        self.gl.bind_buffer(GL_ARRAY_BUFFER, self.sphere_vbo)
         glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
         glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, ctypes.c_void_p(0))
         glEnableVertexAttribArray(0)
@@ -170,102 +441,308 @@ class ParticleWidget(BaseOpenglWidget):
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.sphere_ebo)
         glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
 
-        # Instance positions buffer (will be updated each frame)
-        self.instance_vbo = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.instance_vbo)
-        # Allocate empty buffer for now
-        glBufferData(GL_ARRAY_BUFFER, len(self.positions) * 4, None, GL_DYNAMIC_DRAW)
-        glVertexAttribPointer(1, 3, GL_FLOAT, GL_FALSE, 0, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(1)
-        glVertexAttribDivisor(1, 1)  # Advance per instance
-
-        # Instance colors buffer
-        self.color_vbo = glGenBuffers(1)
-        glBindBuffer(GL_ARRAY_BUFFER, self.color_vbo)
-        glBufferData(GL_ARRAY_BUFFER, self.colors.nbytes, self.colors, GL_DYNAMIC_DRAW)
-        glVertexAttribPointer(2, 3, GL_FLOAT, GL_FALSE, 0, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(2)
-        glVertexAttribDivisor(2, 1)  # Advance per instance
-
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
-        glBindVertexArray(0)
+        self.gl.bind_vertex_array(0)
+
+        # Instance positions and colors, advancing per instance
+        self.position_buffer.attach(self.sphere_vao, 1)
+        self.color_buffer.attach(self.sphere_vao, 2)
+
+    @owns_gl_objects
+    def setup_lod_meshes(self):
+        """Builds one VAO per entry of `lod_levels`; instances come from the draw list."""
+        resources = gpu_resources()
+        for vao, vbo, ebo, _ in self.lod_meshes:
+            resources.release("vertex_array", vao)
+            resources.release("buffer", [vbo, ebo])
+        self.lod_meshes = []
+
+        for stacks, slices, _ in self.lod_levels:
+            vertices, indices = generate_sphere_mesh(1.0, stacks, slices)
+            vao = resources.create("vertex_array")
+            vbo = resources.create("buffer", nbytes=vertices.nbytes)
+            ebo = resources.create("buffer", nbytes=indices.nbytes)
+
+            self.gl.bind_vertex_array(vao)
+            self.gl.bind_buffer(GL_ARRAY_BUFFER, vbo)
+            glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
+            glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, ctypes.c_void_p(0))
+            glEnableVertexAttribArray(0)
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ebo)
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
+            self.gl.bind_vertex_array(0)
+
+            self.lod_meshes.append((vao, vbo, ebo, len(indices)))
+
+        self.draw_list.invalidate()
+
+    def _uses_draw_list(self):
+        return self.lod or self.culling
+
+    def _draw_list_key(self):
+        # Draw lists only go stale when the camera, the viewport, the particles or what
+        # decides their LOD level (radius, levels, render mode) change
+        camera = self.camera
+        return (camera.position.tobytes(), camera.target.tobytes(), camera.fov, self.render_width,
+                self.render_height, self.position_buffer.version, self.color_buffer.version,
+                self.particle_radius, self.render_mode, self.lod_levels)
+
+    def _fill_draw_list(self, draw_list, indices, key=None):
+        """Gathers the particles `indices` into `draw_list`, grouped by LOD level when enabled."""
+        with self.profiler.stage("draw_list"):
+            if self.lod and len(indices):
+                radius = self._radius_values()
+                radius = radius if np.isscalar(radius) else radius[indices]
+                pixels = screen_radius(self.positions[indices], radius, self.camera, self.render_height)
+                min_pixels = np.array([level[2] for level in self.lod_levels], dtype=np.float32)
+                # finest level whose threshold the sphere reaches
+                levels = len(min_pixels) - np.searchsorted(min_pixels[::-1], pixels, side='right')
+                levels = np.clip(levels, 0, len(min_pixels) - 1)
+                order, groups = group_by_level(levels, len(min_pixels))
+                order = indices[order]
+            else:
+                order, groups = indices, [(0, 0, len(indices))] if len(indices) else []
+            draw_list.build(order, groups, self.position_buffer.data, self.color_buffer.data, key)
+
+    def _draw_from_list(self, draw_list):
+        if self.render_mode == "impostor":
+            if len(draw_list):
+                draw_list.bind(self.impostor_list_vao)
+                self.gl.bind_vertex_array(self.impostor_list_vao)
+                glDrawArraysInstanced(GL_TRIANGLE_STRIP, 0, 4, len(draw_list))
+        else:
+            for level, start, count in draw_list.groups:
+                vao, _, _, index_count = self.lod_meshes[level]
+                draw_list.bind(vao, start)
+                self.gl.bind_vertex_array(vao)
+                glDrawElementsInstanced(GL_TRIANGLES, index_count, GL_UNSIGNED_INT, None, count)
+        self.gl.bind_vertex_array(0)
+
+    def _draw_visible(self):
+        """Culls and/or LOD-sorts the particles into the draw lists and draws them."""
+        if not self.lod_meshes:
+            self.setup_lod_meshes()
+
+        key = self._draw_list_key()
+        if self.draw_list.is_current(key):
+            self._draw_from_list(self.draw_list)
+            self._draw_from_list(self.late_draw_list)
+            return
+
+        if not self.culling:
+            self._fill_draw_list(self.draw_list, np.arange(len(self.positions)), key)
+            self._draw_from_list(self.draw_list)
+            return
+
+        culler = self.culler
+        radius = self._radius_values()
+        culler.update(self.positions, radius, (self.position_buffer.version, self.particle_radius))
+        planes, classes = culler.frustum_cells(self.camera)
+        in_frustum = classes >= 0
+
+        # Occlusion culling draws last frame's visible clusters first and tests the rest
+        # against the depth they leave behind
+        early = in_frustum if culler.visible_cells is None or not culler.occlusion else in_frustum & culler.visible_cells
+        self._fill_draw_list(self.draw_list, culler.particles(early, classes, planes, self.positions, radius), key)
+        self._draw_from_list(self.draw_list)
+
+        late = np.zeros_like(early)
+        if culler.occlusion:
+            pyramid = build_depth_pyramid(self.frame_depth())
+            tested = np.flatnonzero(in_frustum)
+            occluded = culler.occluded(tested, pyramid, self.camera, (self.render_width, self.render_height))
+
+            visible = np.zeros_like(in_frustum)
+            visible[tested[~occluded]] = True
+            late = visible & ~early
+            culler.visible_cells = visible
+            culler.stats["occluded_cells"] = int(np.count_nonzero(occluded))
+
+        self._fill_draw_list(self.late_draw_list, culler.particles(late, classes, planes, self.positions, radius))
+        self._draw_from_list(self.late_draw_list)
+        culler.stats["visible_instances"] = len(self.draw_list) + len(self.late_draw_list)
+
+    @owns_gl_objects
+    def setup_impostor_buffers(self):
+        """Builds the quad used by the impostor render mode, 4 vertices per particle."""
+        self.impostor_shader = get_shader_program(
+            vertex_source=os.path.join(self.shader_dir, "impostor_vertex_shader.glsl"),
+            fragment_source=os.path.join(self.shader_dir, "impostor_fragment_shader.glsl")
+        )
+
+        corners = np.array([[-1, -1], [1, -1], [-1, 1], [1, 1]], dtype=np.float32)
+        resources = gpu_resources()
+        self.impostor_vao = resources.create("vertex_array")
+        self.impostor_vbo = resources.create("buffer", nbytes=corners.nbytes)
+
+        self.gl.bind_buffer(GL_ARRAY_BUFFER, self.impostor_vbo)
+        glBufferData(GL_ARRAY_BUFFER, corners.nbytes, corners, GL_STATIC_DRAW)
+
+        # One VAO reading the instance buffers, one reading the draw lists
+        self.impostor_list_vao = resources.create("vertex_array")
+        for vao in (self.impostor_vao, self.impostor_list_vao):
+            self.gl.bind_vertex_array(vao)
+            self.gl.bind_buffer(GL_ARRAY_BUFFER, self.impostor_vbo)
+            glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 0, ctypes.c_void_p(0))
+            glEnableVertexAttribArray(0)
+        self.gl.bind_vertex_array(0)
+
+        # Same instance attributes as the mesh path
+        self.position_buffer.attach(self.impostor_vao, 1)
+        self.color_buffer.attach(self.impostor_vao, 2)
 
     def uniform_setup(self, light_pos=(50.0, 50.0, 100.0), light_color=(1.0, 1.0, 1.0), material_color=(0.8, 0.2, 0.2)):
-        self.shader.set_uniform("view", self.camera.get_view_matrix())
-        self.shader.set_uniform("projection", self.camera.get_projection_matrix())
         self.shader.set_uniform("lightPos", light_pos)
         self.shader.set_uniform("lightColor", light_color)
-        self.shader.set_uniform("viewPos", self.camera.position)
         self.shader.set_uniform("materialColor", material_color)
 
-    def _throttled_draw(self):
-        now = time.monotonic()
-        if now - self._last_redraw > self._redraw_interval:
-            self.draw()
-            self._last_redraw = now
-        
+    def setup_axes(self, position=(0,0,0), scale=1.0):
+        origin = np.array(position, dtype=np.float32) * scale
+        ends = origin + np.eye(3, dtype=np.float32) * scale
+        self.axes.clear()
+        self.axes.add_segments(np.repeat(origin[None], 3, axis=0), ends, colors=np.eye(3))  # X red, Y green, Z blue
+
+    def add_lines(self, starts, ends, colors=(0.0, 0.0, 0.0), redraw=False):
+        """Adds overlay segments; see LineBatch.add_segments. Returns the index of the first one."""
+        first = self.lines.add_segments(starts, ends, colors)
+        if redraw:
+            self.request_draw()
+        return first
+
+    def clear_lines(self, redraw=False):
+        self.lines.clear()
+        if redraw:
+            self.request_draw()
+
+    def _draw_frame(self):
+        # draw() presents the frame itself
+        self.draw()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats["instances"] = {
+            "count": len(self.positions),
+            "bytes_uploaded": self.position_buffer.bytes_uploaded + self.color_buffer.bytes_uploaded,
+            "upload_calls": self.position_buffer.upload_calls + self.color_buffer.upload_calls,
+            "bytes_per_instance": self.position_buffer.itemsize + self.color_buffer.itemsize,
+            "views": len(self.dataset.views),
+            "gpu_bytes": gpu_resources().stats(self.dataset.resource_owner)["total_bytes"] if self.gl_ready else 0,
+        }
+        if self.lod:
+            stats["lod"] = {
+                "instances_per_level": {level: count for level, _, count in self.draw_list.groups},
+                "draw_list_builds": self.draw_list.builds,
+            }
+        if self.culling:
+            stats["culling"] = dict(self.culler.stats)
+        if self.player is not None:
+            stats["trajectory"] = self.player.stats()
+        return stats
+
+    def release_gl_objects(self):
+        if self.__dict__.get("fbo") is None:
+            # never drawn, so nothing on the GPU, but a shared dataset must forget the view
+            if "dataset" in self.__dict__:
+                self.dataset.remove_view(self)
+            return
+        if self.player is not None:
+            self.player.close()
+            self.player = None
+        # programs are shared with other widgets: only drop this widget's references
+        for shader in (self.shader, self.line_shader, self.impostor_shader):
+            if shader is not None:
+                release_shader_program(shader)
+        self.shader = self.line_shader = self.impostor_shader = None
+
+        # a shared dataset outlives its views, but must stop rebinding this widget's VAOs
+        self.dataset.remove_view(self, [vao for vao in (self.sphere_vao, self.impostor_vao) if vao is not None])
+        if self.owns_dataset:
+            self.dataset.close()
+        super().release_gl_objects()
+
+    def _draw_spheres(self, pick_indices=None):
+        self.camera_uniforms.update(self.camera)
+
+        if self.render_mode == "impostor":
+            shader = self._use_impostor_shader()
+            # The billboards always face the camera, so face culling only gets in the way
+            self.gl.disable(GL_CULL_FACE)
         else:
-            pass
+            shader = self.shader
+            shader.use()
+            self.uniform_setup()
+            shader.set_uniform("selectionIndex", self.selection_index)
+            shader.set_uniform("isLine", False)  # <--- Not a line for spheres
+
+        # Per-particle radii are stored absolute, otherwise the w of every instance reads as 1
+        shader.set_uniform("radiusScale", 1.0 if self.per_particle_radius else float(self.particle_radius))
+
+        # Upload only the instance data that changed since the last frame
+        with self.profiler.stage("upload"):
+            self.sync_instances()
+
+        # the picking pass is timed apart so it doesn't skew the frame's draw times
+        with self.profiler.stage("draw" if pick_indices is None else "pick", gpu=True):
+            if pick_indices is not None:
+                # LOD levels chosen as in the frame, so the IDs match what is on screen
+                shader.set_uniform("useInstanceIds", True)
+                if not self.lod_meshes:
+                    self.setup_lod_meshes()
+                self._fill_draw_list(self.pick_draw_list, pick_indices)
+                self._draw_from_list(self.pick_draw_list)
+            elif self._uses_draw_list():
+                shader.set_uniform("useInstanceIds", True)
+                self._draw_visible()
+            else:
+                shader.set_uniform("useInstanceIds", False)
+                if self.render_mode == "impostor":
+                    self.gl.bind_vertex_array(self.impostor_vao)
+                    glDrawArraysInstanced(GL_TRIANGLE_STRIP, 0, 4, len(self.positions))
+                else:
+                    # Bind VAO and draw instances
+                    self.gl.bind_vertex_array(self.sphere_vao)
+                    glDrawElementsInstanced(GL_TRIANGLES, self.index_count, GL_UNSIGNED_INT, None, len(self.positions))
+                self.gl.bind_vertex_array(0)
+
+        if self.render_mode == "impostor":
+            self.gl.enable(GL_CULL_FACE)
+
+    def _use_impostor_shader(self):
+        if self.impostor_vao is None:
+            self.setup_impostor_buffers()
+
+        shader = self.impostor_shader
+        shader.use()
+        shader.set_uniform("lightPos", (50.0, 50.0, 100.0))
+        shader.set_uniform("lightColor", (1.0, 1.0, 1.0))
+        shader.set_uniform("selectionIndex", self.selection_index)
+        return shader
 
-    def setup_axes(self, position=(0,0,0), scale=1.0):
-        line_vertices = np.array([[0, 0, 0], [1, 0, 0],
-                                      [0, 0, 0], [0, 1, 0],
-                                      [0, 0, 0], [0, 0, 1]], dtype=np.float32)
-        
-        line_vertices += np.array(position, dtype=np.float32)
-        line_vertices *= scale
+    def draw(self, draw_particles=True, draw_axes=False):
+        self._render_scene(draw_particles, draw_axes)
 
-        self.axes_verts = line_vertices
+        # Update the canvas with the new image; with a readback latency this is
+        # the frame queued earlier, or nothing while the PBO ring fills up
+        img_array = self.read_frame()
+        if img_array is not None:
+            self._present_frame(img_array)
 
-        self.axes_vao = glGenVertexArrays(1)
-        self.axes_vbo = glGenBuffers(1)
-        glBindVertexArray(self.axes_vao)
-        glBindBuffer(GL_ARRAY_BUFFER, self.axes_vbo)
-        glBufferData(GL_ARRAY_BUFFER, line_vertices.nbytes, line_vertices, GL_STATIC_DRAW)
-        glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, ctypes.c_void_p(0))
-        glEnableVertexAttribArray(0)
+    def render_to_array(self, draw_particles=True, draw_axes=False):
+        """Renders a frame and returns it as a (height, width, 3) uint8 array without presenting it."""
+        self._render_scene(draw_particles, draw_axes)
+        return self.read_frame(now=True)
 
-    def draw(self, draw_particles=True, draw_axes=False):
+    @owns_gl_objects
+    def _render_scene(self, draw_particles=True, draw_axes=False):
         super().draw((0.8, 0.8, 0.8, 1))
 
         if draw_particles:
-            self.shader.use()
-
-            self.uniform_setup()
-            self.shader.set_uniform("selectionIndex", self.selection_index)
-            self.shader.set_uniform("isLine", False)  # <--- Not a line for spheres
-
-            # Prepare instance positions
-            glBindBuffer(GL_ARRAY_BUFFER, self.instance_vbo)
-            glBufferData(GL_ARRAY_BUFFER, self.positions.nbytes, self.positions, GL_DYNAMIC_DRAW)
-
-            # Bind VAO and draw instances
-            glBindVertexArray(self.sphere_vao)
-            glDrawElementsInstanced(GL_TRIANGLES, self.index_count, GL_UNSIGNED_INT, None, len(self.positions))
-            glBindVertexArray(0)
+            self._draw_spheres()
         
-        if self.draw_axes or draw_axes:
-            glBindBuffer(GL_ARRAY_BUFFER, self.axes_vbo)
-            glBufferData(GL_ARRAY_BUFFER, self.axes_verts.nbytes, self.axes_verts, GL_STATIC_DRAW)
-            glVertexAttribPointer(0, 3, GL_FLOAT, GL_FALSE, 0, ctypes.c_void_p(0))
-            glEnableVertexAttribArray(0)
-
-            self.line_shader.use()
-            self.line_shader.set_uniform("view", self.camera.get_view_matrix())
-            self.line_shader.set_uniform("projection", self.camera.get_projection_matrix())
-
-            glLineWidth(3.0)
-
-            self.line_shader.set_uniform("lineColor", (1.0, 0.0, 0.0))  # X axis - red
-            glDrawArrays(GL_LINES, 0, 2)
-
-            self.line_shader.set_uniform("lineColor", (0.0, 1.0, 0.0))  # Y axis - green
-            glDrawArrays(GL_LINES, 2, 2)
-
-            self.line_shader.set_uniform("lineColor", (0.0, 0.0, 1.0))  # Z axis - blue
-            glDrawArrays(GL_LINES, 4, 2)
-            glBindVertexArray(0)
-
-        # Update the canvas with the new image
-        img_array = framebuffer_to_array(self.fbo, self.width, self.height)
-        self.canvas.put_image_data(img_array, 0, 0)
+        draw_axes = self.draw_axes or draw_axes
+        if draw_axes or len(self.lines):
+            with self.profiler.stage("lines", gpu=True):
+                self.camera_uniforms.update(self.camera)
+                self.line_shader.use()
+                if draw_axes:
+                    self.axes.draw()
+                self.lines.draw()
@@ -0,0 +1,204 @@
+from OpenGL.GL import *
+import numpy as np
+import collections
+import contextlib
+import ctypes
+import json
+import os
+import threading
+import time
+from ipy_opengl_utils.gpu_resources import gpu_resources, owned_by
+
+def profile_stage(profiler, name, gpu=False):
+    """`profiler.stage(name, gpu)`, or a no-op context when `profiler` is None."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name, gpu)
+
+class RollingStats:
+    """The last `window` durations of one stage, in seconds."""
+
+    def __init__(self, window=240):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def summary(self):
+        """count (all time) plus mean, p50, p95 and max over the window, in milliseconds."""
+        if not self.samples:
+            return {"count": self.count, "mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        ms = np.fromiter(self.samples, dtype=np.float64, count=len(self.samples)) * 1000.0
+        p50, p95 = np.percentile(ms, (50, 95))
+        return {"count": self.count, "mean": float(ms.mean()), "p50": float(p50), "p95": float(p95),
+                "max": float(ms.max())}
+
+class FrameProfiler:
+    """
+    Per-stage timings of the frame pipeline.
+
+    `stage(name)` times a block on the CPU; with `gpu` enabled, stages opened with
+    gpu=True are also bracketed by GL timestamp queries, which give the time the
+    GPU spent between the two points. Query results are collected a few frames
+    later, once available, so measuring never stalls the pipeline. `stats` gives
+    rolling p50/p95/max per stage and `trace` records every stage of every frame
+    into a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+
+    Stages may be recorded from other threads (e.g. the encoder pool); GPU queries
+    only from the thread owning the context.
+    """
+
+    def __init__(self, window=240, gpu=False, owner=None):
+        self.window = window
+        self.gpu = gpu
+        self.enabled = True
+        # resource owner the timer queries are attributed to
+        self.owner = owner
+
+        self.frames = 0
+        self.cpu_stats = {}
+        self.gpu_stats = {}
+        self._lock = threading.Lock()
+
+        self._queries = []
+        self._free_queries = []
+        self._pending = []  # (name, frame, start query, end query) in submission order
+
+        self._events = None  # Chrome trace events while tracing
+        self._threads = {}
+        self._gpu_clock = None  # (GL timestamp ns, perf_counter s) sampled together
+
+    @contextlib.contextmanager
+    def stage(self, name, gpu=False):
+        if not self.enabled:
+            yield
+            return
+        queries = self._timestamp() if gpu and self.gpu else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            if queries is not None:
+                glQueryCounter(queries[1], GL_TIMESTAMP)
+                self._pending.append((name, self.frames, queries[0], queries[1]))
+            self.record(name, start, end)
+
+    @contextlib.contextmanager
+    def frame(self):
+        """Times a whole frame as the "frame" stage and collects finished GPU timings."""
+        with self.stage("frame", gpu=True):
+            yield
+        self.frames += 1
+        if self.gpu:
+            self.collect_gpu()
+
+    def record(self, name, start, end, frame=None):
+        """Adds a CPU stage that ran from `start` to `end` (perf_counter seconds)."""
+        with self._lock:
+            stats = self.cpu_stats.get(name)
+            if stats is None:
+                stats = self.cpu_stats[name] = RollingStats(self.window)
+            stats.add(end - start)
+            if self._events is not None:
+                thread = threading.current_thread()
+                self._threads[thread.ident] = thread.name
+                self._events.append(self._event(name, "cpu", start * 1e6, (end - start) * 1e6, thread.ident,
+                                                self.frames if frame is None else frame))
+
+    def _event(self, name, category, ts, dur, tid, frame):
+        return {"name": name, "cat": category, "ph": "X", "ts": ts, "dur": dur, "pid": os.getpid(), "tid": tid,
+                "args": {"frame": frame}}
+
+    def _timestamp(self):
+        # two queries from the pool, the first one issued now
+        if len(self._free_queries) < 2:
+            with owned_by(self.owner):
+                queries = gpu_resources().create("query", 8)
+            self._queries.extend(queries)
+            self._free_queries.extend(queries)
+        queries = (self._free_queries.pop(), self._free_queries.pop())
+        glQueryCounter(queries[0], GL_TIMESTAMP)
+        return queries
+
+    def _query_result(self, query):
+        value = ctypes.c_uint64()
+        glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(value))
+        return value.value
+
+    def collect_gpu(self, wait=False):
+        """
+        Records the GPU timings whose queries have completed; results arrive in
+        submission order. With `wait` blocks until all of them are in.
+        """
+        done = 0
+        for name, frame, start_query, end_query in self._pending:
+            if not wait and not glGetQueryObjectiv(end_query, GL_QUERY_RESULT_AVAILABLE):
+                break
+            start, end = self._query_result(start_query), self._query_result(end_query)
+            stats = self.gpu_stats.get(name)
+            if stats is None:
+                stats = self.gpu_stats[name] = RollingStats(self.window)
+            stats.add((end - start) * 1e-9)
+            if self._events is not None and self._gpu_clock is not None:
+                # place GPU work on the CPU timeline through the clock pair sampled at trace start
+                gpu_ns, cpu_s = self._gpu_clock
+                ts = cpu_s * 1e6 + (start - gpu_ns) * 1e-3
+                self._events.append(self._event(name, "gpu", ts, (end - start) * 1e-3, 0, frame))
+            self._free_queries.extend((start_query, end_query))
+            done += 1
+        del self._pending[:done]
+        return done
+
+    @contextlib.contextmanager
+    def trace(self, path):
+        """
+        Records every stage inside the block and writes them to `path` as Chrome
+        trace JSON, GPU stages on their own "GPU" track.
+        """
+        self._events = []
+        self._threads = {}
+        if self.gpu:
+            value = ctypes.c_int64()
+            glGetInteger64v(GL_TIMESTAMP, ctypes.byref(value))
+            self._gpu_clock = (value.value, time.perf_counter())
+        try:
+            yield self
+        finally:
+            if self.gpu:
+                self.collect_gpu(wait=True)
+            events, self._events = self._events, None
+            self.write_trace(path, events)
+
+    def write_trace(self, path, events):
+        pid = os.getpid()
+        metadata = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                    for tid, name in self._threads.items()]
+        if self.gpu:
+            metadata.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "GPU"}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+
+    def stats(self):
+        """Rolling summaries of every stage, in milliseconds, for the CPU and (if enabled) the GPU."""
+        with self._lock:
+            cpu = {name: stats.summary() for name, stats in self.cpu_stats.items()}
+        stats = {"frames": self.frames, "cpu": cpu}
+        if self.gpu:
+            stats["gpu"] = {name: rolling.summary() for name, rolling in self.gpu_stats.items()}
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self.frames = 0
+            self.cpu_stats = {}
+            self.gpu_stats = {}
+
+    def delete(self):
+        """Frees the timer queries; GPU timings still in flight are dropped."""
+        gpu_resources().release("query", self._queries)
+        self._queries = []
+        self._free_queries = []
+        self._pending = []
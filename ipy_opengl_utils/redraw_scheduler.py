@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+def running_loop():
+    """The asyncio loop running in this thread (the kernel's loop inside Jupyter), or None."""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+class RedrawScheduler:
+    """
+    Coalescing, trailing-edge redraw scheduler running on the asyncio event loop.
+
+    `invalidate` marks the view as stale. The first invalidation schedules one render
+    no earlier than `frame_budget` after the previous frame started; any invalidations
+    arriving before it runs are folded into it, and since the render happens after
+    them it always shows the latest state. Between frames the loop is free to process
+    further events. `on_idle` is called once no frame was requested for `idle_delay`
+    seconds after the last one, e.g. to flush pipelined readbacks or refine the image.
+
+    Without a running event loop (plain scripts) every invalidation renders immediately.
+    """
+
+    def __init__(self, render, frame_budget=1 / 60, on_idle=None, idle_delay=0.15):
+        self.render = render
+        self.frame_budget = frame_budget
+        self.on_idle = on_idle
+        self.idle_delay = idle_delay
+
+        self._frame_handle = None
+        self._idle_handle = None
+        self._last_start = -float('inf')
+
+        self.invalidations = 0
+        self.frames = 0
+        self.coalesced = 0
+        # frames whose render took longer than frame_budget
+        self.budget_overruns = 0
+        self.last_frame_time = 0.0
+        self.total_frame_time = 0.0
+
+    @property
+    def pending(self):
+        return self._frame_handle is not None
+
+    def invalidate(self):
+        self.invalidations += 1
+        if self._frame_handle is not None:
+            # a frame is already on its way and will pick up this change too
+            self.coalesced += 1
+            return
+
+        loop = running_loop()
+        if loop is None:
+            self._render_frame()
+            return
+
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+        delay = max(0.0, self._last_start + self.frame_budget - time.monotonic())
+        self._frame_handle = loop.call_later(delay, self._on_frame, loop)
+
+    def _on_frame(self, loop):
+        self._frame_handle = None
+        self._render_frame()
+        if self.on_idle is not None and self._frame_handle is None:
+            self._idle_handle = loop.call_later(self.idle_delay, self._on_idle)
+
+    def _render_frame(self):
+        start = time.monotonic()
+        self._last_start = start
+        try:
+            self.render()
+        finally:
+            duration = time.monotonic() - start
+            self.frames += 1
+            self.last_frame_time = duration
+            self.total_frame_time += duration
+            if duration > self.frame_budget:
+                self.budget_overruns += 1
+
+    def _on_idle(self):
+        self._idle_handle = None
+        self.on_idle()
+
+    def cancel(self):
+        for handle in (self._frame_handle, self._idle_handle):
+            if handle is not None:
+                handle.cancel()
+        self._frame_handle = None
+        self._idle_handle = None
+
+    def stats(self):
+        return {
+            "invalidations": self.invalidations,
+            "frames": self.frames,
+            "coalesced": self.coalesced,
+            "budget_overruns": self.budget_overruns,
+            "last_frame_time": self.last_frame_time,
+            "mean_frame_time": self.total_frame_time / self.frames if self.frames else 0.0,
+        }
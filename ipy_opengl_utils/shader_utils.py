@@ -1,63 +1,352 @@
 from OpenGL.GL import *
 import numpy as np
+import ctypes
+import hashlib
+import os
+from ipy_opengl_utils.gl_state import gl_state, current_context
+from ipy_opengl_utils.gpu_resources import gpu_resources, owned_by
+
+# Linked program binaries are stored here; set IPY_OPENGL_SHADER_CACHE to "" to disable
+SHADER_CACHE_DIR = os.environ.get(
+    "IPY_OPENGL_SHADER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "ipy_opengl_utils", "programs"))
+
+# Linked programs shared within each context: {context: {key: program}}; their
+# reference counts are kept by the context's ResourceTracker
+_PROGRAMS = {}
+
+# Uniform blocks are bound to fixed binding points in every program that declares them
+UNIFORM_BLOCK_BINDINGS = {"Camera": 0}
+
+# Sampler uniforms of every kind hold a texture unit, set like an int
+_SAMPLER_TYPES = (
+    GL_SAMPLER_1D, GL_SAMPLER_2D, GL_SAMPLER_3D, GL_SAMPLER_CUBE, GL_SAMPLER_1D_SHADOW, GL_SAMPLER_2D_SHADOW,
+    GL_SAMPLER_1D_ARRAY, GL_SAMPLER_2D_ARRAY, GL_SAMPLER_1D_ARRAY_SHADOW, GL_SAMPLER_2D_ARRAY_SHADOW,
+    GL_SAMPLER_CUBE_SHADOW, GL_SAMPLER_2D_MULTISAMPLE, GL_SAMPLER_2D_MULTISAMPLE_ARRAY, GL_SAMPLER_BUFFER,
+    GL_SAMPLER_2D_RECT, GL_SAMPLER_2D_RECT_SHADOW,
+    GL_INT_SAMPLER_1D, GL_INT_SAMPLER_2D, GL_INT_SAMPLER_3D, GL_INT_SAMPLER_CUBE, GL_INT_SAMPLER_1D_ARRAY,
+    GL_INT_SAMPLER_2D_ARRAY, GL_INT_SAMPLER_2D_MULTISAMPLE, GL_INT_SAMPLER_2D_MULTISAMPLE_ARRAY,
+    GL_INT_SAMPLER_BUFFER, GL_INT_SAMPLER_2D_RECT,
+    GL_UNSIGNED_INT_SAMPLER_1D, GL_UNSIGNED_INT_SAMPLER_2D, GL_UNSIGNED_INT_SAMPLER_3D,
+    GL_UNSIGNED_INT_SAMPLER_CUBE, GL_UNSIGNED_INT_SAMPLER_1D_ARRAY, GL_UNSIGNED_INT_SAMPLER_2D_ARRAY,
+    GL_UNSIGNED_INT_SAMPLER_2D_MULTISAMPLE, GL_UNSIGNED_INT_SAMPLER_2D_MULTISAMPLE_ARRAY,
+    GL_UNSIGNED_INT_SAMPLER_BUFFER, GL_UNSIGNED_INT_SAMPLER_2D_RECT,
+)
+
+def _matrix_setter(function):
+    return lambda location, count, value: function(location, count, GL_FALSE, value)
+
+# For each GLSL uniform type: the glUniform* call taking (location, count, array),
+# the dtype values are converted to and the number of components per element
+_UNIFORM_SETTERS = {
+    GL_FLOAT: (glUniform1fv, np.float32, 1),
+    GL_FLOAT_VEC2: (glUniform2fv, np.float32, 2),
+    GL_FLOAT_VEC3: (glUniform3fv, np.float32, 3),
+    GL_FLOAT_VEC4: (glUniform4fv, np.float32, 4),
+    GL_FLOAT_MAT2: (_matrix_setter(glUniformMatrix2fv), np.float32, 4),
+    GL_FLOAT_MAT3: (_matrix_setter(glUniformMatrix3fv), np.float32, 9),
+    GL_FLOAT_MAT4: (_matrix_setter(glUniformMatrix4fv), np.float32, 16),
+    GL_FLOAT_MAT2x3: (_matrix_setter(glUniformMatrix2x3fv), np.float32, 6),
+    GL_FLOAT_MAT2x4: (_matrix_setter(glUniformMatrix2x4fv), np.float32, 8),
+    GL_FLOAT_MAT3x2: (_matrix_setter(glUniformMatrix3x2fv), np.float32, 6),
+    GL_FLOAT_MAT3x4: (_matrix_setter(glUniformMatrix3x4fv), np.float32, 12),
+    GL_FLOAT_MAT4x2: (_matrix_setter(glUniformMatrix4x2fv), np.float32, 8),
+    GL_FLOAT_MAT4x3: (_matrix_setter(glUniformMatrix4x3fv), np.float32, 12),
+    GL_INT: (glUniform1iv, np.int32, 1),
+    GL_INT_VEC2: (glUniform2iv, np.int32, 2),
+    GL_INT_VEC3: (glUniform3iv, np.int32, 3),
+    GL_INT_VEC4: (glUniform4iv, np.int32, 4),
+    GL_BOOL: (glUniform1iv, np.int32, 1),
+    GL_BOOL_VEC2: (glUniform2iv, np.int32, 2),
+    GL_BOOL_VEC3: (glUniform3iv, np.int32, 3),
+    GL_BOOL_VEC4: (glUniform4iv, np.int32, 4),
+    GL_UNSIGNED_INT: (glUniform1uiv, np.uint32, 1),
+    GL_UNSIGNED_INT_VEC2: (glUniform2uiv, np.uint32, 2),
+    GL_UNSIGNED_INT_VEC3: (glUniform3uiv, np.uint32, 3),
+    GL_UNSIGNED_INT_VEC4: (glUniform4uiv, np.uint32, 4),
+}
+_UNIFORM_SETTERS.update({sampler: (glUniform1iv, np.int32, 1) for sampler in _SAMPLER_TYPES})
+
+def _set_uniform_generic(name, location, value):
+    # Untyped path for uniform types without a setter, picked from the Python value
+    if isinstance(value, np.ndarray) and value.shape == (4, 4):
+        glUniformMatrix4fv(location, 1, GL_FALSE, value)
+    elif isinstance(value, (list, tuple, np.ndarray)) and len(value) == 4:
+        glUniform4fv(location, 1, value)
+    elif isinstance(value, (list, tuple, np.ndarray)) and len(value) == 3:
+        glUniform3fv(location, 1, value)
+    elif isinstance(value, float):
+        glUniform1f(location, value)
+    elif isinstance(value, int):
+        glUniform1i(location, value)
+    else:
+        raise TypeError(f"Unsupported uniform type for '{name}': {type(value)}")
+
+def apply_defines(source, defines):
+    """Inserts `#define NAME VALUE` lines after the #version directive of `source`."""
+    if not defines:
+        return source
+    lines = "".join(f"#define {name} {value}\n" for name, value in sorted(defines.items()))
+    if source.lstrip().startswith("#version"):
+        version, _, body = source.lstrip().partition("\n")
+        return f"{version}\n{lines}{body}"
+    return lines + source
+
+def program_key(vertex_source, fragment_source, defines=None):
+    """Hash identifying a program by its final sources."""
+    digest = hashlib.sha1()
+    for source in (apply_defines(vertex_source, defines), apply_defines(fragment_source, defines)):
+        digest.update(source.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def get_shader_program(vertex_source, fragment_source, from_str=False, defines=None):
+    """
+    Returns the ShaderProgram for these sources and defines in the current context,
+    building it only the first time. Programs are shared, so hand them back with
+    release_shader_program() instead of deleting them.
+    """
+    if not from_str:
+        vertex_source, fragment_source = _read(vertex_source), _read(fragment_source)
+    key = program_key(vertex_source, fragment_source, defines)
+
+    programs = _PROGRAMS.setdefault(current_context(), {})
+    shader = programs.get(key)
+    if shader is None:
+        # not attributed to the widget that happened to ask first
+        with owned_by(None):
+            shader = programs[key] = ShaderProgram(vertex_source, fragment_source, from_str=True, defines=defines)
+    else:
+        gpu_resources().retain("program", shader.program)
+    return shader
+
+def release_shader_program(shader):
+    """Drops one reference to a shared program, deleting it once unused."""
+    programs = _PROGRAMS.get(current_context(), {})
+    if shader.delete() and programs.get(shader.key) is shader:
+        del programs[shader.key]
+
+def shader_cache_stats():
+    return {
+        "contexts": len(_PROGRAMS),
+        "programs": sum(len(programs) for programs in _PROGRAMS.values()),
+        "references": sum(gpu_resources(context).references("program", shader.program)
+                          for context, programs in _PROGRAMS.items() for shader in programs.values()),
+        "binary_hits": ShaderProgram.binary_hits,
+        "binary_misses": ShaderProgram.binary_misses,
+        "compiled": ShaderProgram.compiled,
+    }
+
+def program_binaries_supported():
+    """Whether the current context can save and load linked programs (GL 4.1 / ARB_get_program_binary)."""
+    try:
+        return bool(glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS))
+    except GLError:
+        return False
+
+class CameraUniformBuffer:
+    """
+    std140 uniform buffer holding the `Camera` block (view, projection, viewPos)
+    shared by all the shaders of a widget, so the camera is uploaded once per frame
+    rather than once per program.
+    """
+    SIZE = 2 * 64 + 16
+
+    def __init__(self, binding=UNIFORM_BLOCK_BINDINGS["Camera"]):
+        self.binding = binding
+        # created by the first update, in the context and for the owner current then
+        self.ubo = None
+        self._data = np.zeros(self.SIZE // 4, dtype=np.float32)
+        self._uploaded = None
+        self.uploads = 0
+
+    def update(self, camera):
+        """Uploads the camera if it changed and binds the buffer to its binding point."""
+        data = self._data
+        data[0:16] = np.asarray(camera.get_view_matrix(), dtype=np.float32).ravel()
+        data[16:32] = np.asarray(camera.get_projection_matrix(), dtype=np.float32).ravel()
+        data[32:35] = camera.position
+
+        if self.ubo is None:
+            self.ubo = gpu_resources().create("buffer", nbytes=self.SIZE)
+            gl_state().bind_buffer(GL_UNIFORM_BUFFER, self.ubo)
+            glBufferData(GL_UNIFORM_BUFFER, self.SIZE, None, GL_DYNAMIC_DRAW)
+
+        # other widgets may have bound their own camera in between
+        gl_state().bind_buffer_base(GL_UNIFORM_BUFFER, self.binding, self.ubo)
+        raw = data.tobytes()
+        if raw != self._uploaded:
+            glBufferSubData(GL_UNIFORM_BUFFER, 0, len(raw), data)
+            self._uploaded = raw
+            self.uploads += 1
+
+    def delete(self):
+        if self.ubo is not None:
+            gpu_resources().release("buffer", self.ubo)
+            self.ubo = None
+
+def _read(file_path):
+    with open(file_path, 'r') as file:
+        return file.read()
 
 class ShaderProgram:
-    def __init__(self, vertex_source, fragment_source, from_str=False):
+    # process-wide counters, see shader_cache_stats()
+    binary_hits = 0
+    binary_misses = 0
+    compiled = 0
 
-        if (not from_str):
-            self.vertex_shader = self.compile_shader_from_file(vertex_source, GL_VERTEX_SHADER)
-            self.fragment_shader = self.compile_shader_from_file(fragment_source, GL_FRAGMENT_SHADER)
-        
-        else:
+    def __init__(self, vertex_source, fragment_source, from_str=False, defines=None, binary_cache=True):
+        if not from_str:
+            vertex_source, fragment_source = self.load_source(vertex_source), self.load_source(fragment_source)
+        vertex_source = apply_defines(vertex_source, defines)
+        fragment_source = apply_defines(fragment_source, defines)
+        self.key = program_key(vertex_source, fragment_source)
+
+        binary_cache = binary_cache and self._binary_path() is not None
+        self.program = self.load_binary() if binary_cache else None
+        if self.program is None:
             self.vertex_shader = self.compile_shader_from_str(vertex_source, GL_VERTEX_SHADER)
             self.fragment_shader = self.compile_shader_from_str(fragment_source, GL_FRAGMENT_SHADER)
-        
-        self.program = self.link_shader_program(self.vertex_shader, self.fragment_shader)
+            self.program = self.link_shader_program(self.vertex_shader, self.fragment_shader, retrievable=binary_cache)
+
+            # Clean up shaders after linking
+            glDeleteShader(self.vertex_shader)
+            glDeleteShader(self.fragment_shader)
+            ShaderProgram.compiled += 1
+
+            if binary_cache:
+                self.save_binary()
+
+        gpu_resources().track("program", self.program)
+        self.introspect()
+
+    def _binary_path(self):
+        if not SHADER_CACHE_DIR or not program_binaries_supported():
+            return None
+        # binaries are only valid for the driver that produced them
+        driver = b"|".join(glGetString(name) or b"" for name in (GL_VENDOR, GL_RENDERER, GL_VERSION))
+        name = hashlib.sha1(self.key.encode() + driver).hexdigest()
+        return os.path.join(SHADER_CACHE_DIR, name + ".bin")
+
+    def load_binary(self):
+        """Program linked from a cached binary, or None when there is none or the driver rejects it."""
+        path = self._binary_path()
+        if path is None or not os.path.exists(path):
+            ShaderProgram.binary_misses += 1
+            return None
+
+        with open(path, 'rb') as file:
+            data = file.read()
+        binary_format = int.from_bytes(data[:4], 'little')
+        binary = data[4:]
+
+        program = glCreateProgram()
+        try:
+            glProgramBinary(program, binary_format, binary, len(binary))
+            linked = glGetProgramiv(program, GL_LINK_STATUS)
+        except GLError:
+            linked = False
+        if not linked:
+            # stale binary (e.g. driver update): drop it and build from source
+            glDeleteProgram(program)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            ShaderProgram.binary_misses += 1
+            return None
+
+        ShaderProgram.binary_hits += 1
+        return program
+
+    def save_binary(self):
+        path = self._binary_path()
+        if path is None:
+            return
+        length = glGetProgramiv(self.program, GL_PROGRAM_BINARY_LENGTH)
+        if not length:
+            return
+
+        binary = (ctypes.c_ubyte * length)()
+        written = GLsizei(0)
+        binary_format = GLenum(0)
+        glGetProgramBinary(self.program, length, ctypes.byref(written), ctypes.byref(binary_format), binary)
 
-        # Clean up shaders after linking
-        glDeleteShader(self.vertex_shader)
-        glDeleteShader(self.fragment_shader)
+        # the cache is an optimization only, so I/O errors are ignored
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as file:
+                file.write(int(binary_format.value).to_bytes(4, 'little'))
+                file.write(bytes(binary)[:written.value])
+            os.replace(temp_path, path)
+        except OSError:
+            pass
 
     def use(self):
-        glUseProgram(self.program)
+        gl_state().use_program(self.program)
 
     def delete(self):
-        glDeleteProgram(self.program)
+        """Drops a reference to the program; returns True if that deleted it."""
+        return gpu_resources().release("program", self.program) > 0
+
+    def introspect(self):
+        """Builds the typed setter table of the active uniforms and binds known uniform blocks."""
+        self.uniforms = {}
+        for index in range(glGetProgramiv(self.program, GL_ACTIVE_UNIFORMS)):
+            name, size, uniform_type = glGetActiveUniform(self.program, index)
+            name = name.decode() if isinstance(name, bytes) else name
+            name = name.split('[')[0]
+            location = glGetUniformLocation(self.program, name)
+            # members of uniform blocks have no location
+            if location != -1:
+                # arrays report their length in `size`
+                self.uniforms[name] = (location, int(uniform_type), int(size))
+
+        # last value uploaded to each uniform; uniform state lives in the program, so it
+        # stays valid when the program is shared between widgets
+        self._values = {}
+
+        for block, binding in UNIFORM_BLOCK_BINDINGS.items():
+            self.bind_uniform_block(block, binding)
+
+    def bind_uniform_block(self, name, binding):
+        index = glGetUniformBlockIndex(self.program, name)
+        if index != GL_INVALID_INDEX:
+            glUniformBlockBinding(self.program, index, binding)
 
     def set_uniform(self, name, value, dbg_print=False):
+        """Sets a uniform of the program in use, skipping the upload when the value did not change."""
         if dbg_print:
             print(f"Setting uniform '{name}' to {value}")
 
-        location = glGetUniformLocation(self.program, name)
-        if location == -1:
+        uniform = self.uniforms.get(name)
+        if uniform is None:
             # This warning can be noisy, so it's okay to comment out
             # print(f"Warning: Uniform '{name}' not found in shader.")
             return
+        location, uniform_type, size = uniform
 
-        # Check for 4x4 matrix first (most specific case)
-        if isinstance(value, np.ndarray) and value.shape == (4, 4):
-            # glUniformMatrix4fv(location, count, transpose, value)
-            glUniformMatrix4fv(location, 1, GL_FALSE, value)
-
-        # Check for vector types (handles list, tuple, or numpy array)
-        elif isinstance(value, (list, tuple, np.ndarray)) and len(value) == 4:
-            glUniform4fv(location, 1, value)
-        elif isinstance(value, (list, tuple, np.ndarray)) and len(value) == 3:
-            glUniform3fv(location, 1, value)
-            
-        # Check for scalar types
-        elif isinstance(value, (float)):
-            glUniform1f(location, value)
-        
-        elif isinstance(value, (int)):
-            glUniform1i(location, value)
+        typed = _UNIFORM_SETTERS.get(uniform_type)
+        if typed is None:
+            _set_uniform_generic(name, location, value)
+            self._values.pop(name, None)
+            return
+        setter, dtype, components = typed
+
+        value = np.ascontiguousarray(value, dtype=dtype)
+        if value.size < components or value.size % components:
+            raise ValueError(f"Uniform '{name}' takes {components} components per element, got {value.size} values")
+        # array uniforms take as many elements as given, up to their length
+        count = min(size, value.size // components)
+        cached = value.tobytes()
+        if self._values.get(name) == cached:
+            return
 
-        else:
-            raise TypeError(f"Unsupported uniform type for '{name}': {type(value)}")
+        setter(location, count, value)
+        self._values[name] = cached
 
     def load_source(self, file_path):
-        with open(file_path, 'r') as file:
-            return file.read()
+        return _read(file_path)
 
     def compile_shader_from_file(self, file_path, shader_type):
         shader_source = self.load_source(file_path)
@@ -86,10 +375,12 @@ class ShaderProgram:
 
         return shader
 
-    def link_shader_program(self, vertex_shader, fragment_shader):
+    def link_shader_program(self, vertex_shader, fragment_shader, retrievable=False):
         shader_program = glCreateProgram()
         glAttachShader(shader_program, vertex_shader)
         glAttachShader(shader_program, fragment_shader)
+        if retrievable:
+            glProgramParameteri(shader_program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
         glLinkProgram(shader_program)
 
         success = glGetProgramiv(shader_program, GL_LINK_STATUS)
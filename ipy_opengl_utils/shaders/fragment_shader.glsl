@@ -4,15 +4,24 @@ in vec3 FragPos;
 in vec3 FragColor;
 flat in int vInstanceID;
 
-out vec4 OutColor;
+layout (location = 0) out vec4 OutColor;
+layout (location = 1) out int OutID;  // only written during the ID pick pass
+
+// Shared by all programs, see CameraUniformBuffer
+layout (std140) uniform Camera {
+    mat4 view;
+    mat4 projection;
+    vec3 viewPos;
+};
 
 uniform vec3 lightPos;
 uniform vec3 lightColor;
-uniform vec3 viewPos;
 uniform int selectionIndex;
 
 void main()
 {   
+    OutID = vInstanceID;
+
     if (vInstanceID == selectionIndex) {
         OutColor = vec4(1.0, 0.0, 0.0, 1.0); // Highlight selected instance in red
     } else {
@@ -0,0 +1,63 @@
+#version 330 core
+in vec3 FragPos;
+flat in vec3 SphereCenter;
+flat in float SphereRadius;
+in vec3 FragColor;
+flat in int vInstanceID;
+
+layout (location = 0) out vec4 OutColor;
+layout (location = 1) out int OutID;  // only written during the ID pick pass
+
+// Shared by all programs, see CameraUniformBuffer
+layout (std140) uniform Camera {
+    mat4 view;
+    mat4 projection;
+    vec3 viewPos;
+};
+
+uniform vec3 lightPos;
+uniform vec3 lightColor;
+uniform int selectionIndex;
+
+void main()
+{
+    // Ray cast the sphere through this fragment of the billboard
+    vec3 rayDir = normalize(FragPos - viewPos);
+    vec3 oc = viewPos - SphereCenter;
+    float b = dot(oc, rayDir);
+    float c = dot(oc, oc) - SphereRadius * SphereRadius;
+    float discriminant = b * b - c;
+    if (discriminant < 0.0) {
+        discard;
+    }
+    vec3 hitPos = viewPos + (-b - sqrt(discriminant)) * rayDir;
+    vec3 norm = (hitPos - SphereCenter) / SphereRadius;
+
+    // Depth of the actual sphere surface, not of the billboard
+    vec4 clipPos = projection * view * vec4(hitPos, 1.0);
+    gl_FragDepth = 0.5 * (clipPos.z / clipPos.w) * (gl_DepthRange.far - gl_DepthRange.near)
+                 + 0.5 * (gl_DepthRange.far + gl_DepthRange.near);
+
+    OutID = vInstanceID;
+
+    if (vInstanceID == selectionIndex) {
+        OutColor = vec4(1.0, 0.0, 0.0, 1.0); // Highlight selected instance in red
+    } else {
+        // Same lighting model as fragment_shader.glsl
+        float ambientStrength = 0.2;
+        vec3 ambient = ambientStrength * lightColor;
+
+        vec3 lightDir = normalize(lightPos - hitPos);
+        float diff = max(dot(norm, lightDir), 0.0);
+        vec3 diffuse = diff * lightColor;
+
+        float specularStrength = 0.5;
+        vec3 viewDir = normalize(viewPos - hitPos);
+        vec3 reflectDir = reflect(-lightDir, norm);
+        float spec = pow(max(dot(viewDir, reflectDir), 0.0), 32);
+        vec3 specular = specularStrength * spec * lightColor;
+
+        vec3 result = (ambient + diffuse + specular) * FragColor;
+        OutColor = vec4(result, 1.0);
+    }
+}
@@ -0,0 +1,47 @@
+#version 330 core
+layout (location = 0) in vec2 aCorner;       // billboard corner in [-1, 1]^2
+layout (location = 1) in vec4 instancePos;   // xyz center, w radius (1 when not supplied)
+layout (location = 2) in vec3 instanceColor;
+layout (location = 3) in int instanceId;  // original index when drawing from a draw list
+
+out vec3 FragPos;        // world-space point on the billboard
+flat out vec3 SphereCenter;
+flat out float SphereRadius;
+out vec3 FragColor;
+flat out int vInstanceID;
+
+// Shared by all programs, see CameraUniformBuffer
+layout (std140) uniform Camera {
+    mat4 view;
+    mat4 projection;
+    vec3 viewPos;
+};
+
+uniform float radiusScale;
+uniform bool useInstanceIds;
+
+void main()
+{
+    vec3 center = instancePos.xyz;
+    float radius = radiusScale * instancePos.w;
+
+    // Billboard facing the camera, spanned by the camera's up vector
+    vec3 toCamera = viewPos - center;
+    float dist = length(toCamera);
+    vec3 forward = toCamera / dist;
+    vec3 cameraUp = vec3(view[0][1], view[1][1], view[2][1]);
+    vec3 right = normalize(cross(cameraUp, forward));
+    vec3 up = cross(forward, right);
+
+    // Half size covering the sphere's perspective silhouette in the billboard plane
+    float scale = radius * dist / sqrt(max(dist * dist - radius * radius, 1e-6));
+
+    vec3 worldPos = center + scale * (aCorner.x * right + aCorner.y * up);
+    gl_Position = projection * view * vec4(worldPos, 1.0);
+
+    FragPos = worldPos;
+    SphereCenter = center;
+    SphereRadius = radius;
+    FragColor = instanceColor;
+    vInstanceID = useInstanceIds ? instanceId : gl_InstanceID;
+}
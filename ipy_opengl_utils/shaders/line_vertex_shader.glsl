@@ -1,13 +1,17 @@
 #version 330 core
 layout (location = 0) in vec3 aPos;
+layout (location = 1) in vec3 aColor;
 
-uniform mat4 view;
-uniform mat4 projection;
-uniform vec3 lineColor;
+// Shared by all programs, see CameraUniformBuffer
+layout (std140) uniform Camera {
+    mat4 view;
+    mat4 projection;
+    vec3 viewPos;
+};
 
 out vec3 fragColor;
 
 void main() {
     gl_Position = projection * view * vec4(aPos, 1.0);
-    fragColor = lineColor;
+    fragColor = aColor;
 }
\ No newline at end of file
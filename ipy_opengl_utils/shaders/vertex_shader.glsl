@@ -1,17 +1,25 @@
 #version 330 core
 layout (location = 0) in vec3 aPos;
-layout (location = 1) in vec3 instancePos;
+layout (location = 1) in vec4 instancePos;   // xyz center, w radius (1 when not supplied)
 layout (location = 2) in vec3 instanceColor;
+layout (location = 3) in int instanceId;  // original index when drawing from a draw list
 
 out vec3 Normal;
 out vec3 FragPos;
 out vec3 FragColor;
 flat out int vInstanceID;
 
-uniform mat4 view;
-uniform mat4 projection;
+// Shared by all programs, see CameraUniformBuffer
+layout (std140) uniform Camera {
+    mat4 view;
+    mat4 projection;
+    vec3 viewPos;
+};
+
 uniform vec3 materialColor;
 uniform bool isLine;
+uniform bool useInstanceIds;
+uniform float radiusScale;  // the mesh is a unit sphere
 
 void main()
 {
@@ -20,9 +28,9 @@ void main()
         FragColor = materialColor;
         vInstanceID = -1;
     } else {
-        worldPos += instancePos;
+        worldPos = aPos * (radiusScale * instancePos.w) + instancePos.xyz;
         FragColor = instanceColor;
-        vInstanceID = gl_InstanceID;
+        vInstanceID = useInstanceIds ? instanceId : gl_InstanceID;
     }
     gl_Position = projection * view * vec4(worldPos, 1.0);
     FragPos = worldPos;
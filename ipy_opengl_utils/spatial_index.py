@@ -0,0 +1,224 @@
+import numpy as np
+from ipy_opengl_utils.math_utils import ray_spheres_intersect, ray_aabb_intersect
+
+# large primes for spatial hashing of integer cell coordinates
+_HASH_PRIMES = np.array([73856093, 19349663, 83492791], dtype=np.int64)
+
+# 3x3x3 neighbourhood offsets, used to dilate the set of cells a ray visits
+_NEIGHBOURS = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'), axis=-1).reshape(-1, 3)
+
+class UniformGrid:
+    """
+    Hashed uniform grid over a set of sphere centers, used to answer ray picks
+    without testing every particle.
+
+    The grid only stores particle indices sorted by cell hash; the positions are
+    passed in on every call, so it can follow a growing array. Appended particles
+    are kept in a pending tail that is brute-forced and merged into the sorted
+    index once it grows past `rebuild_fraction` of the indexed count, which keeps
+    streaming inserts amortized linear.
+    """
+
+    def __init__(self, radius=1.0, cell_size=None, particles_per_cell=2.0, rebuild_fraction=0.25, min_pending=4096):
+        self.radius = radius
+        self.fixed_cell_size = cell_size
+        self.particles_per_cell = particles_per_cell
+        self.rebuild_fraction = rebuild_fraction
+        self.min_pending = min_pending
+        self.invalidate()
+
+    def invalidate(self):
+        """Drops the index; it is rebuilt from scratch on the next insert or query."""
+        self.cell_size = None
+        self.indexed = 0
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._order = np.zeros(0, dtype=np.int64)
+        self.bounds = None
+
+    def _choose_cell_size(self, points):
+        if self.fixed_cell_size is not None:
+            return max(self.fixed_cell_size, 2.0 * self.radius)
+        extent = np.ptp(points, axis=0) + 2.0 * self.radius
+        volume = float(np.prod(np.maximum(extent, 2.0 * self.radius)))
+        cell = (volume * self.particles_per_cell / len(points)) ** (1.0 / 3.0)
+        # spheres must not reach past the neighbouring cell, see intersect_ray
+        return max(cell, 2.0 * self.radius)
+
+    def _cell_coords(self, points):
+        return np.floor(np.asarray(points) / self.cell_size).astype(np.int64)
+
+    @staticmethod
+    def _hash(coords):
+        return np.bitwise_xor.reduce(coords * _HASH_PRIMES, axis=-1)
+
+    def insert(self, points, threshold=None):
+        """
+        Brings the index up to date with `points`, whose first `indexed` entries
+        are assumed unchanged. New entries are merged once more than `threshold`
+        accumulate (by default `rebuild_fraction` of the indexed count).
+        """
+        count = len(points)
+        if count < self.indexed:
+            self.invalidate()
+        if count == 0:
+            return
+
+        pending = count - self.indexed
+        if threshold is None:
+            threshold = max(self.min_pending, self.rebuild_fraction * self.indexed)
+        if pending == 0 or (self.indexed and pending < threshold):
+            return
+
+        # re-hash everything when the density drifted far from what the cells were sized for
+        cell_size = self._choose_cell_size(points)
+        if self.cell_size is None or not 0.5 <= cell_size / self.cell_size <= 2.0:
+            self.invalidate()
+            self.cell_size = cell_size
+        self._merge(points, self.indexed, count)
+
+    def _merge(self, points, start, stop):
+        new_points = points[start:stop]
+        new_keys = self._hash(self._cell_coords(new_points))
+        sort = np.argsort(new_keys, kind='stable')
+        new_keys = new_keys[sort]
+        new_order = np.arange(start, stop, dtype=np.int64)[sort]
+
+        # merge two sorted runs without re-sorting the indexed part
+        slots = np.searchsorted(self._keys, new_keys, side='right')
+        self._keys = np.insert(self._keys, slots, new_keys)
+        self._order = np.insert(self._order, slots, new_order)
+
+        box_min, box_max = new_points.min(axis=0), new_points.max(axis=0)
+        if self.bounds is not None:
+            box_min = np.minimum(box_min, self.bounds[0])
+            box_max = np.maximum(box_max, self.bounds[1])
+        self.bounds = (box_min, box_max)
+        self.indexed = stop
+
+    def candidates_near_ray(self, ray_origin, ray_dir, t_start, t_stop):
+        """Indexed particles whose cell lies within one cell of the ray segment."""
+        step = 0.5 * self.cell_size
+        ts = np.arange(t_start, t_stop + step, step)
+        samples = np.asarray(ray_origin) + ts[:, None] * np.asarray(ray_dir)
+
+        cells = np.unique(self._cell_coords(samples), axis=0)
+        cells = (cells[:, None, :] + _NEIGHBOURS[None, :, :]).reshape(-1, 3)
+        keys = np.unique(self._hash(cells))
+
+        lo = np.searchsorted(self._keys, keys, side='left')
+        hi = np.searchsorted(self._keys, keys, side='right')
+        lengths = hi - lo
+        nonempty = lengths > 0
+        lo, lengths = lo[nonempty], lengths[nonempty]
+        if len(lo) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # expand the [lo, hi) runs into one flat index array
+        offsets = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+        slots = offsets + np.arange(lengths.sum())
+        return self._order[slots]
+
+    def intersect_ray(self, points, ray_origin, ray_dir, radius=None, chunk_cells=64):
+        """
+        Returns (index, distance) of the closest sphere hit by the ray, or (-1, inf).
+        `radius` defaults to the grid radius and may be one radius per point, in
+        which case the grid radius must be at least the largest of them.
+        """
+        if radius is None:
+            radius = self.radius
+        # picks are far more frequent than inserts, so merge a large pending tail eagerly
+        self.insert(points, threshold=self.min_pending)
+
+        best_index, best_dist = -1, np.inf
+        ray_dir = np.asarray(ray_dir, dtype=np.float64)
+        ray_dir = ray_dir / np.linalg.norm(ray_dir)
+
+        if self.indexed:
+            span = ray_aabb_intersect(ray_origin, ray_dir, self.bounds[0] - self.radius, self.bounds[1] + self.radius)
+        else:
+            span = None
+
+        if span is not None:
+            t_enter, t_exit = span
+            # a sphere touching the ray at t has its center within radius of the ray point,
+            # hence in a cell adjacent to a sample taken no further than a cell away
+            margin = 2.0 * np.sqrt(3.0) * self.cell_size + self.radius
+            chunk = chunk_cells * self.cell_size
+            seen = np.zeros(0, dtype=np.int64)
+            t = t_enter
+            while t <= t_exit:
+                candidates = self.candidates_near_ray(ray_origin, ray_dir, t, min(t + chunk, t_exit))
+                candidates = np.setdiff1d(candidates, seen, assume_unique=True)
+                seen = np.union1d(seen, candidates)
+
+                if len(candidates):
+                    r = radius if np.isscalar(radius) else np.asarray(radius)[candidates]
+                    dist = ray_spheres_intersect(ray_origin, ray_dir, points[candidates], r)
+                    i = int(np.argmin(dist))
+                    if dist[i] < best_dist:
+                        best_index, best_dist = int(candidates[i]), float(dist[i])
+
+                t += chunk
+                # spheres found further along cannot be closer than this
+                if best_dist < t - margin:
+                    break
+
+        # brute-force the pending tail that is not merged yet
+        if self.indexed < len(points):
+            tail = points[self.indexed:]
+            r = radius if np.isscalar(radius) else np.asarray(radius)[self.indexed:]
+            dist = ray_spheres_intersect(ray_origin, ray_dir, tail, r)
+            i = int(np.argmin(dist))
+            if dist[i] < best_dist:
+                best_index, best_dist = self.indexed + i, float(dist[i])
+
+        return best_index, best_dist
+
+class ClusterGrid:
+    """
+    Coarse uniform grid that groups particles into clusters of roughly
+    `particles_per_cell`, with per-cluster bounding boxes. Used to cull whole
+    clusters at once; particle indices are stored sorted by cluster.
+    """
+
+    def __init__(self, particles_per_cell=64):
+        self.particles_per_cell = particles_per_cell
+        self.order = np.zeros(0, dtype=np.int64)
+        self.starts = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.box_min = np.zeros((0, 3), dtype=np.float32)
+        self.box_max = np.zeros((0, 3), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def build(self, points, radius):
+        """`radius` is a scalar or one radius per point; boxes bound the whole spheres."""
+        if len(points) == 0:
+            self.__init__(self.particles_per_cell)
+            return
+
+        lo = points.min(axis=0)
+        extent = np.maximum(points.max(axis=0) - lo, 1e-6)
+        cell = (float(np.prod(extent)) * self.particles_per_cell / len(points)) ** (1.0 / 3.0)
+        dims = np.clip(np.ceil(extent / cell).astype(np.int64), 1, 1024)
+
+        coords = np.minimum(((points - lo) * (dims / extent)).astype(np.int64), dims - 1)
+        cell_ids = (coords[:, 0] * dims[1] + coords[:, 1]) * dims[2] + coords[:, 2]
+
+        self.order = np.argsort(cell_ids, kind='stable')
+        sorted_ids = cell_ids[self.order]
+        _, self.starts, self.counts = np.unique(sorted_ids, return_index=True, return_counts=True)
+
+        sorted_points = points[self.order]
+        r = radius if np.isscalar(radius) else np.asarray(radius)[self.order][:, None]
+        self.box_min = np.minimum.reduceat(sorted_points - r, self.starts, axis=0)
+        self.box_max = np.maximum.reduceat(sorted_points + r, self.starts, axis=0)
+
+    def particles(self, cells):
+        """Particle indices of the given clusters (index array or boolean mask), cluster by cluster."""
+        starts, counts = self.starts[cells], self.counts[cells]
+        if len(starts) == 0:
+            return np.zeros(0, dtype=np.int64)
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return self.order[offsets + np.arange(counts.sum())]
@@ -1,6 +1,7 @@
 import numpy as np
 from PIL import Image
 from OpenGL.GL import *
+from ipy_opengl_utils.gpu_resources import gpu_resources
 
 def load_texture(image_path):
     """Loads a texture from an image file and generates an OpenGL texture object."""
@@ -8,7 +9,7 @@ def load_texture(image_path):
     img_data = img.convert("RGBA").tobytes()
     width, height = img.size
 
-    texture_id = glGenTextures(1)
+    texture_id = gpu_resources().create("texture", nbytes=width * height * 4)
     glBindTexture(GL_TEXTURE_2D, texture_id)
 
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
@@ -23,4 +24,4 @@ def load_texture(image_path):
 
 def delete_texture(texture_id):
     """Deletes an OpenGL texture object."""
-    glDeleteTextures(1, [texture_id])
+    gpu_resources().release("texture", texture_id)
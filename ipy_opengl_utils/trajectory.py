@@ -0,0 +1,256 @@
+import os
+import time
+import threading
+import zipfile
+import numpy as np
+from ipy_opengl_utils.redraw_scheduler import running_loop
+
+def open_trajectory(source, key=None, n_particles=None, dtype=np.float32, offset=0):
+    """
+    Opens a (frames, N, 3) trajectory without reading it into memory.
+
+    `source` is an array, a `.npy` file, an uncompressed `.npz` file (member `key`,
+    the first one by default) or a raw binary file of `dtype` values starting at
+    byte `offset`, in which case `n_particles` is required.
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        trajectory = np.asarray(source)
+    else:
+        path = os.fspath(source)
+        if path.endswith(".npy"):
+            trajectory = np.load(path, mmap_mode='r')
+        elif path.endswith(".npz"):
+            trajectory = _npz_memmap(path, key)
+        else:
+            if n_particles is None:
+                raise ValueError("Raw trajectories need `n_particles`")
+            frame_bytes = n_particles * 3 * np.dtype(dtype).itemsize
+            frames = (os.path.getsize(path) - offset) // frame_bytes
+            trajectory = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(frames, n_particles, 3))
+
+    if trajectory.ndim != 3 or trajectory.shape[2] != 3:
+        raise ValueError(f"Expected a (frames, N, 3) trajectory, got shape {trajectory.shape}")
+    return trajectory
+
+def _npz_memmap(path, key=None):
+    """Memory maps a member of an .npz archive; only stored (uncompressed) members can be mapped."""
+    with zipfile.ZipFile(path) as archive:
+        names = [name for name in archive.namelist() if name.endswith(".npy")]
+        name = names[0] if key is None else key + ".npy"
+        info = archive.getinfo(name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f"'{name}' in {path} is compressed and cannot be memory mapped; save it with np.savez")
+
+    with open(path, 'rb') as file:
+        # the local file header is 30 bytes plus the name and extra fields
+        file.seek(info.header_offset)
+        header = file.read(30)
+        name_length = int.from_bytes(header[26:28], 'little')
+        extra_length = int.from_bytes(header[28:30], 'little')
+        file.seek(info.header_offset + 30 + name_length + extra_length)
+
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        data_offset = file.tell()
+
+    return np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=shape, order='F' if fortran_order else 'C')
+
+class FramePrefetcher:
+    """
+    Background thread copying upcoming trajectory frames into a bounded ring of
+    float32 slots, so disk reads and page faults happen off the event loop.
+
+    `request` sets the frames wanted next; `get` returns a frame, from its slot if
+    it was prefetched. The slot of the last returned frame is never reused until
+    the next `get`, so the returned array stays valid until then.
+    """
+
+    def __init__(self, trajectory, slots=8):
+        self.trajectory = trajectory
+        self.slots = np.empty((slots,) + trajectory.shape[1:], dtype=np.float32)
+        self._slot_frames = [-1] * slots
+        self._pinned = -1
+        self._wanted = []
+
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+        self._thread = threading.Thread(target=self._run, name="trajectory-prefetch", daemon=True)
+        self._thread.start()
+
+    def request(self, frames):
+        with self._condition:
+            self._wanted = list(frames)
+            self._condition.notify()
+
+    def get(self, frame):
+        with self._condition:
+            if frame in self._slot_frames:
+                slot = self._slot_frames.index(frame)
+                self._pinned = slot
+                self.hits += 1
+                return self.slots[slot]
+            self._pinned = -1
+        # not fetched yet: read it synchronously
+        self.misses += 1
+        return np.asarray(self.trajectory[frame], dtype=np.float32)
+
+    def _next_job(self):
+        # first wanted frame that is not loaded, and a slot holding nothing wanted
+        missing = [frame for frame in self._wanted if frame not in self._slot_frames]
+        if not missing:
+            return None
+        for slot, frame in enumerate(self._slot_frames):
+            if slot != self._pinned and frame not in self._wanted:
+                return slot, missing[0]
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None and not self._closed:
+                    self._condition.wait()
+                    job = self._next_job()
+                if self._closed:
+                    return
+                slot, frame = job
+                # not readable while it is being filled
+                self._slot_frames[slot] = -1
+
+            np.copyto(self.slots[slot], self.trajectory[frame], casting='unsafe')
+
+            with self._condition:
+                self._slot_frames[slot] = frame
+                self.prefetched += 1
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+class TrajectoryPlayer:
+    """
+    Plays a (frames, N, 3) trajectory on a ParticleWidget: play/pause/seek/step with
+    optional looping, ticking on the asyncio event loop at `fps`. Upcoming frames
+    are prefetched into a ring of `prefetch` slots and each shown frame is written
+    straight into the widget's position buffer, so only that frame is uploaded.
+    Without a running event loop (plain scripts) drive it with `step` or `seek`.
+    """
+
+    def __init__(self, widget, trajectory, fps=30, loop=True, prefetch=8, colors=None):
+        self.widget = widget
+        self.trajectory = trajectory
+        self.fps = fps
+        self.loop = loop
+        self.frame = 0
+        self.playing = False
+
+        n_particles = trajectory.shape[1]
+        if len(widget.positions) == 0:
+            if colors is None:
+                colors = np.full((n_particles, 3), 0.8, dtype=np.float32)
+            widget.add_particles(trajectory[0], colors, update_cam=True)
+        elif len(widget.positions) != n_particles:
+            raise ValueError(f"Trajectory has {n_particles} particles but the widget has {len(widget.positions)}")
+
+        self.prefetcher = FramePrefetcher(trajectory, slots=prefetch)
+        self._handle = None
+        self._next_tick = 0.0
+
+        self.frames_shown = 0
+        self.late_ticks = 0
+
+    def __len__(self):
+        return len(self.trajectory)
+
+    def _upcoming(self, frame):
+        frames = []
+        for step in range(1, len(self.prefetcher.slots)):
+            upcoming = frame + step
+            if upcoming >= len(self):
+                if not self.loop:
+                    break
+                upcoming %= len(self)
+            frames.append(upcoming)
+        return frames
+
+    def show(self, frame):
+        """Displays `frame` and starts prefetching the ones after it."""
+        if not 0 <= frame < len(self):
+            raise IndexError(f"Frame {frame} out of range for {len(self)} frames")
+        self.frame = frame
+        # get() pins the frame's slot first, so prefetching the next ones can't reclaim it
+        positions = self.prefetcher.get(frame)
+        self.prefetcher.request(self._upcoming(frame))
+        self.widget.set_positions(positions)
+        self.frames_shown += 1
+        # every widget showing the same dataset follows the trajectory
+        self.widget.dataset.request_draw()
+
+    def seek(self, frame):
+        self.show(frame)
+
+    def step(self, count=1):
+        """Advances `count` frames; returns False at the end of a non-looping trajectory."""
+        frame = self.frame + count
+        if not 0 <= frame < len(self):
+            if not self.loop:
+                self.pause()
+                return False
+            frame %= len(self)
+        self.show(frame)
+        return True
+
+    def play(self):
+        if self.playing:
+            return
+        loop = running_loop()
+        if loop is None:
+            raise RuntimeError("play() needs a running event loop; use step() or seek() instead")
+        self.playing = True
+        self.prefetcher.request(self._upcoming(self.frame))
+        self._next_tick = time.monotonic() + 1.0 / self.fps
+        self._handle = loop.call_later(1.0 / self.fps, self._tick, loop)
+
+    def _tick(self, loop):
+        self._handle = None
+        if not self.playing or not self.step():
+            return
+
+        # keep a steady cadence, but never queue up ticks we are already late for
+        self._next_tick += 1.0 / self.fps
+        delay = self._next_tick - time.monotonic()
+        if delay < 0:
+            self.late_ticks += 1
+            self._next_tick = time.monotonic()
+            delay = 0.0
+        self._handle = loop.call_later(delay, self._tick, loop)
+
+    def pause(self):
+        self.playing = False
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def close(self):
+        self.pause()
+        self.prefetcher.close()
+
+    def stats(self):
+        return {
+            "frame": self.frame,
+            "frames": len(self),
+            "frames_shown": self.frames_shown,
+            "late_ticks": self.late_ticks,
+            "prefetch_hits": self.prefetcher.hits,
+            "prefetch_misses": self.prefetcher.misses,
+        }
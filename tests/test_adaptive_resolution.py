@@ -0,0 +1,76 @@
+from ipy_opengl_utils.adaptive_resolution import ResolutionController
+
+BUDGET = 1 / 30
+
+
+def feed(controller, frame_time, count):
+    return [controller.update(frame_time) for _ in range(count)]
+
+
+def test_starts_at_full_resolution():
+    controller = ResolutionController((0.25, 1.0, 0.5), frame_budget=BUDGET)
+    assert controller.scales == (1.0, 0.5, 0.25)
+    assert controller.scale == 1.0
+
+
+def test_slow_frames_step_down_one_level_at_a_time():
+    controller = ResolutionController(frame_budget=BUDGET)
+    assert controller.update(2 * BUDGET) == 0.5
+    assert controller.update(2 * BUDGET) == 0.25
+    assert controller.changes == 2
+
+
+def test_scale_never_goes_below_the_coarsest():
+    controller = ResolutionController(frame_budget=BUDGET)
+    scales = feed(controller, 10 * BUDGET, 50)
+    assert min(scales) == 0.25
+    assert controller.scale == 0.25
+    assert controller.changes == 2
+
+
+def test_fast_frames_recover_full_resolution_and_stop_there():
+    controller = ResolutionController(frame_budget=BUDGET)
+    feed(controller, 10 * BUDGET, 5)
+    assert controller.scale == 0.25
+
+    scales = feed(controller, 0.01 * BUDGET, 50)
+    assert controller.scale == 1.0
+    assert max(scales) == 1.0
+    assert controller.changes == 4
+
+
+def test_frames_near_the_budget_do_not_upgrade():
+    # at half resolution a frame of 0.3 budgets predicts 1.2 budgets at full resolution
+    controller = ResolutionController(frame_budget=BUDGET, upgrade_margin=0.6)
+    controller.update(2 * BUDGET)
+    assert controller.scale == 0.5
+
+    feed(controller, 0.3 * BUDGET, 50)
+    assert controller.scale == 0.5
+    assert controller.changes == 1
+
+    # 0.1 budgets predicts 0.4, within the margin
+    feed(controller, 0.1 * BUDGET, 10)
+    assert controller.scale == 1.0
+
+
+def test_one_slow_frame_is_smoothed_out():
+    controller = ResolutionController(frame_budget=BUDGET, smoothing=0.9)
+    feed(controller, 0.5 * BUDGET, 10)
+    assert controller.update(3 * BUDGET) == 1.0
+
+
+def test_level_change_resets_the_average():
+    controller = ResolutionController(frame_budget=BUDGET)
+    controller.update(2 * BUDGET)
+    assert controller.stats()["average_frame_time"] == 0.0
+    controller.update(0.5 * BUDGET)
+    assert controller.stats()["average_frame_time"] == 0.5 * BUDGET
+
+
+def test_reset_returns_to_full_resolution():
+    controller = ResolutionController(frame_budget=BUDGET)
+    feed(controller, 10 * BUDGET, 5)
+    controller.reset()
+    assert controller.scale == 1.0
+    assert controller.stats() == {"scale": 1.0, "average_frame_time": 0.0, "changes": 2}
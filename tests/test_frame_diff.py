@@ -0,0 +1,105 @@
+import numpy as np
+
+from ipy_opengl_utils.frame_diff import TileDiffer
+
+
+def random_frame(rng, height=96, width=128):
+    return rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+
+
+def apply_rects(image, rects):
+    image = image.copy()
+    for x, y, patch in rects:
+        image[y:y + patch.shape[0], x:x + patch.shape[1]] = patch
+    return image
+
+
+def test_first_frame_is_sent_in_full():
+    differ = TileDiffer(tile_size=32)
+    assert differ.diff(random_frame(np.random.default_rng(0))) is None
+    assert differ.stats()["full_frames"] == 1
+
+
+def test_unchanged_frame_sends_no_tiles():
+    frame = random_frame(np.random.default_rng(1))
+    differ = TileDiffer(tile_size=32)
+    differ.diff(frame)
+    assert differ.diff(frame.copy()) == []
+    assert differ.stats()["tiles_sent"] == 0
+
+
+def test_one_pixel_change_sends_one_tile():
+    frame = random_frame(np.random.default_rng(2))
+    differ = TileDiffer(tile_size=32)
+    differ.diff(frame)
+
+    changed = frame.copy()
+    changed[40, 70, 1] ^= 0xFF
+    rects = differ.diff(changed)
+
+    assert len(rects) == 1
+    x, y, patch = rects[0]
+    assert (x, y) == (64, 32)
+    assert patch.shape == (32, 32, 3)
+    assert differ.stats()["tiles_sent"] == 1
+
+
+def test_edge_tiles_are_clipped_to_the_frame():
+    # 100x70 with 32 pixel tiles: the last column and row of tiles are partial
+    frame = random_frame(np.random.default_rng(3), height=70, width=100)
+    differ = TileDiffer(tile_size=32)
+    differ.diff(frame)
+
+    changed = frame.copy()
+    changed[69, 99] = 0 if changed[69, 99, 0] else 255
+    rects = differ.diff(changed)
+
+    assert len(rects) == 1
+    x, y, patch = rects[0]
+    assert (x, y) == (96, 64)
+    assert patch.shape == (6, 4, 3)
+
+
+def test_adjacent_tiles_in_a_row_are_merged():
+    frame = random_frame(np.random.default_rng(4))
+    differ = TileDiffer(tile_size=32)
+    differ.diff(frame)
+
+    changed = frame.copy()
+    changed[5, 10:80] ^= 0xFF  # spans tiles 0, 1 and 2 of the first row
+    rects = differ.diff(changed)
+
+    assert [(x, y, patch.shape) for x, y, patch in rects] == [(0, 0, (32, 96, 3))]
+    assert differ.stats()["tiles_sent"] == 3
+
+
+def test_deltas_reassemble_the_target_frame():
+    rng = np.random.default_rng(5)
+    differ = TileDiffer(tile_size=16, full_frame_threshold=0.5)
+    shown = random_frame(rng, height=90, width=110)
+    assert differ.diff(shown) is None
+
+    for _ in range(30):
+        target = shown.copy()
+        for _ in range(rng.integers(0, 6)):
+            y, x = rng.integers(0, 90), rng.integers(0, 110)
+            h, w = rng.integers(1, 30), rng.integers(1, 30)
+            target[y:y + h, x:x + w] = rng.integers(0, 256, size=3, dtype=np.uint8)
+
+        rects = differ.diff(target)
+        shown = target.copy() if rects is None else apply_rects(shown, rects)
+        np.testing.assert_array_equal(shown, target)
+
+
+def test_large_changes_size_changes_and_reset_send_full_frames():
+    rng = np.random.default_rng(6)
+    differ = TileDiffer(tile_size=32, full_frame_threshold=0.5)
+    differ.diff(random_frame(rng))
+
+    assert differ.diff(random_frame(rng)) is None
+    assert differ.diff(random_frame(rng, height=64)) is None
+
+    frame = random_frame(rng, height=64)
+    differ.diff(frame)
+    differ.reset()
+    assert differ.diff(frame) is None
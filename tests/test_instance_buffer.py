@@ -0,0 +1,190 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("OpenGL.GL")
+
+import ipy_opengl_utils.instance_buffer as instance_buffer
+from ipy_opengl_utils.instance_buffer import InstanceBuffer
+
+
+class FakeState:
+    def bind_buffer(self, target, buffer):
+        self.bound = buffer
+
+
+class FakeResources:
+    def __init__(self):
+        self.next_id = 1
+
+    def create(self, kind, count=1, **kwargs):
+        ids = list(range(self.next_id, self.next_id + count))
+        self.next_id += count
+        return ids
+
+    def set_bytes(self, kind, name, nbytes):
+        pass
+
+    def release(self, kind, names):
+        pass
+
+
+class FakeGL:
+    """Records the buffer uploads InstanceBuffer issues instead of calling GL."""
+
+    def __init__(self):
+        self.state = FakeState()
+        self.allocations = []  # (buffer, nbytes) for every glBufferData
+        self.uploads = []  # (buffer, offset in bytes, nbytes) for every glBufferSubData
+
+    def buffer_data(self, target, nbytes, data, usage):
+        self.allocations.append((self.state.bound, nbytes))
+
+    def buffer_sub_data(self, target, offset, nbytes, data):
+        self.uploads.append((self.state.bound, offset, nbytes))
+
+    def reset(self):
+        self.allocations = []
+        self.uploads = []
+
+
+@pytest.fixture
+def gl(monkeypatch):
+    fake = FakeGL()
+    resources = FakeResources()
+    monkeypatch.setattr(instance_buffer, "gl_state", lambda: fake.state)
+    monkeypatch.setattr(instance_buffer, "gpu_resources", lambda: resources)
+    monkeypatch.setattr(instance_buffer, "glBufferData", fake.buffer_data)
+    monkeypatch.setattr(instance_buffer, "glBufferSubData", fake.buffer_sub_data)
+    return fake
+
+
+def synced_buffer(count=100, **kwargs):
+    buffer = InstanceBuffer(3, np.float32, orphan_threshold=0.5, **kwargs)
+    buffer.set_data(np.arange(count * 3, dtype=np.float32).reshape(count, 3))
+    buffer.sync()
+    return buffer
+
+
+def test_merged_ranges_coalesce_overlapping_and_adjacent():
+    buffer = InstanceBuffer()
+    ranges = [(10, 20), (0, 5), (15, 30), (30, 35), (50, 60)]
+    assert buffer._merged_ranges(ranges, 100) == [(0, 5), (10, 35), (50, 60)]
+
+
+def test_merged_ranges_clip_to_count_and_drop_empty():
+    buffer = InstanceBuffer()
+    assert buffer._merged_ranges([(-5, 3), (8, 8), (90, 120), (130, 140)], 100) == [(0, 3), (90, 100)]
+
+
+def test_merged_ranges_collapse_past_max_ranges():
+    buffer = InstanceBuffer()
+    ranges = [(i * 2, i * 2 + 1) for i in range(buffer.max_ranges + 1)]
+    assert buffer._merged_ranges(ranges, 1000) == [(0, buffer.max_ranges * 2 + 1)]
+
+
+def test_sync_uploads_only_dirty_ranges(gl):
+    buffer = synced_buffer()
+    gl.reset()
+
+    buffer.write(np.ones((2, 3)), start=10)
+    buffer.write(np.ones((3, 3)), start=11)
+    buffer.write(np.ones((1, 3)), start=40)
+    uploaded = buffer.sync()
+
+    itemsize = buffer.itemsize
+    assert gl.allocations == []
+    assert [(offset, nbytes) for _, offset, nbytes in gl.uploads] == [(10 * itemsize, 4 * itemsize),
+                                                                      (40 * itemsize, itemsize)]
+    assert uploaded == 5 * itemsize
+
+
+def test_sync_without_changes_does_nothing(gl):
+    buffer = synced_buffer()
+    gl.reset()
+    assert buffer.sync() == 0
+    assert gl.allocations == [] and gl.uploads == []
+
+
+def test_mostly_dirty_buffer_is_orphaned(gl):
+    buffer = synced_buffer()
+    gl.reset()
+
+    buffer.write(np.zeros((60, 3)), start=0)
+    uploaded = buffer.sync()
+
+    # storage re-specified, then the live elements sent in one call
+    assert gl.allocations == [(buffer.buffer, buffer._storage.nbytes)]
+    assert [(offset, nbytes) for _, offset, nbytes in gl.uploads] == [(0, buffer.data.nbytes)]
+    assert uploaded == buffer.data.nbytes
+
+
+def test_append_uploads_only_the_tail(gl):
+    buffer = synced_buffer(count=100)
+    gl.reset()
+
+    start = buffer.append(np.ones((5, 3)))
+
+    assert start == 100
+    assert buffer.sync() == 5 * buffer.itemsize
+    assert [(offset, nbytes) for _, offset, nbytes in gl.uploads] == [(100 * buffer.itemsize, 5 * buffer.itemsize)]
+
+
+def test_growth_is_geometric_and_keeps_data(gl):
+    buffer = InstanceBuffer(3, np.float32, initial_capacity=4, growth_factor=2.0)
+    capacities = set()
+    for i in range(1000):
+        buffer.append(np.full((1, 3), i))
+        capacities.add(buffer.capacity)
+
+    assert len(buffer) == 1000
+    assert sorted(capacities) == [4 * 2 ** k for k in range(9)]
+    np.testing.assert_array_equal(buffer.data[:, 0], np.arange(1000))
+
+
+def test_growth_reallocates_gpu_storage(gl):
+    buffer = InstanceBuffer(3, np.float32, initial_capacity=4)
+    buffer.append(np.ones((4, 3)))
+    buffer.sync()
+    gl.reset()
+
+    buffer.append(np.ones((1, 3)))
+    buffer.sync()
+
+    assert gl.allocations == [(buffer.buffer, buffer.capacity * buffer.itemsize)]
+
+
+def test_remove_compacts_and_uploads_shifted_range(gl):
+    buffer = synced_buffer(count=100)
+    gl.reset()
+
+    buffer.remove([90, 95])
+
+    assert len(buffer) == 98
+    np.testing.assert_array_equal(buffer.data[90], [91 * 3, 91 * 3 + 1, 91 * 3 + 2])
+    buffer.sync()
+    assert [(offset, nbytes) for _, offset, nbytes in gl.uploads] == [(90 * buffer.itemsize, 8 * buffer.itemsize)]
+
+
+def test_double_buffered_sync_swaps_and_rebinds(gl, monkeypatch):
+    buffer = InstanceBuffer(3, np.float32, double_buffered=True, orphan_threshold=0.5)
+    rebinds = []
+    monkeypatch.setattr(buffer, "_bind_attribute", lambda vao, location, divisor, first=0: rebinds.append(
+        (vao, buffer.buffer)))
+    buffer.attach(7, location=1)
+    buffer.set_data(np.zeros((100, 3)))
+
+    front, back = buffer.buffers
+    assert buffer.buffer == front
+    buffer.sync()
+    # uploaded into the buffer the GPU isn't drawing from, which then becomes current
+    assert buffer.buffer == back
+    assert {target for target, _ in gl.allocations} == {back}
+    assert rebinds[-1] == (7, back)
+
+    gl.reset()
+    buffer.write(np.ones((1, 3)), start=3)
+    buffer.sync()
+    # the old front buffer catches up on both the initial fill and the new write
+    assert buffer.buffer == front
+    assert {target for target, _ in gl.allocations} == {front}
+    assert rebinds[-1] == (7, front)
@@ -0,0 +1,22 @@
+import numpy as np
+
+from ipy_opengl_utils.mesh_utils import generate_sphere_mesh
+
+
+def test_sphere_mesh_sizes():
+    vertices, indices = generate_sphere_mesh(2.0, 8, 12)
+    assert vertices.shape == (9 * 13, 3) and vertices.dtype == np.float32
+    assert indices.shape == (6 * 8 * 12,) and indices.dtype == np.uint32
+    np.testing.assert_allclose(np.linalg.norm(vertices, axis=1), 2.0, rtol=1e-6)
+
+
+def test_returned_arrays_can_be_edited_without_touching_the_cache():
+    vertices, indices = generate_sphere_mesh(1.0, 8, 8)
+    expected = vertices.copy()
+    vertices *= 3.0
+    indices[:] = 0
+
+    again, again_indices = generate_sphere_mesh(1.0, 8, 8)
+    np.testing.assert_array_equal(again, expected)
+    assert again_indices.any()
+    assert again is not vertices
@@ -0,0 +1,172 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("OpenGL.GL")
+
+from ipy_opengl_utils.particle_dataset import ParticleDataset
+
+
+class RecordingView:
+    def __init__(self):
+        self.changes = []
+        self.draw_requests = 0
+
+    def _on_dataset_change(self, change):
+        self.changes.append(change)
+
+    def request_draw(self):
+        self.draw_requests += 1
+
+
+def dataset_with_views(count=10, views=2, **kwargs):
+    rng = np.random.default_rng(0)
+    dataset = ParticleDataset(**kwargs)
+    dataset.add(rng.random((count, 3)), rng.random((count, 3)), radii=rng.random(count) if kwargs.get(
+        "per_particle_radius") else None)
+    recorders = [RecordingView() for _ in range(views)]
+    for view in recorders:
+        dataset.add_view(view)
+    return dataset, recorders
+
+
+def assert_consistent(dataset):
+    assert len(dataset.position_buffer) == len(dataset.color_buffer) == len(dataset)
+
+
+def test_add_notifies_every_view():
+    dataset, views = dataset_with_views()
+    dataset.add(np.zeros((2, 3)), np.zeros((2, 3)))
+    assert len(dataset) == 12
+    assert_consistent(dataset)
+    assert all(view.changes == ["append"] for view in views)
+
+
+def test_set_all_same_count_notifies_every_view():
+    dataset, views = dataset_with_views()
+    positions, colors = np.ones((10, 3)), np.full((10, 3), 0.5)
+
+    dataset.set_all(positions=positions)
+    dataset.set_all(colors=colors)
+
+    np.testing.assert_array_equal(dataset.positions, positions)
+    np.testing.assert_allclose(dataset.colors, colors)
+    assert_consistent(dataset)
+    assert all(view.changes == ["geometry", "colors"] for view in views)
+
+
+@pytest.mark.parametrize("arrays", [
+    {"positions": np.zeros((12, 3))},
+    {"colors": np.zeros((8, 3))},
+    {"positions": np.zeros((12, 3)), "colors": np.zeros((11, 3))},
+])
+def test_set_all_rejects_mismatched_counts_without_changing_anything(arrays):
+    dataset, views = dataset_with_views()
+    before = dataset.positions.copy(), dataset.colors.copy()
+
+    with pytest.raises(ValueError):
+        dataset.set_all(**arrays)
+
+    np.testing.assert_array_equal(dataset.positions, before[0])
+    np.testing.assert_array_equal(dataset.colors, before[1])
+    assert_consistent(dataset)
+    assert all(view.changes == [] for view in views)
+
+
+def test_set_all_changes_the_count_with_both_arrays():
+    dataset, views = dataset_with_views()
+    dataset.set_all(np.ones((25, 3)), np.zeros((25, 3)))
+    assert len(dataset) == 25
+    assert_consistent(dataset)
+    assert all(view.changes == ["geometry", "colors"] for view in views)
+
+
+def test_set_all_keeps_per_particle_radii_only_for_the_same_count():
+    dataset, _ = dataset_with_views(per_particle_radius=True)
+    radii = dataset.radii.copy()
+
+    dataset.set_all(positions=np.ones((10, 3)))
+    np.testing.assert_array_equal(dataset.radii, radii)
+
+    dataset.set_all(np.ones((4, 3)), np.ones((4, 3)))
+    assert len(dataset.radii) == 4
+
+
+@pytest.mark.parametrize("indices", [np.array([1, 4, 7]), np.arange(10) % 3 == 1, slice(2, 8, 2)])
+def test_update_writes_selected_particles_and_notifies(indices):
+    dataset, views = dataset_with_views()
+    positions = dataset.positions.copy()
+    selected = np.arange(10)[indices]
+
+    dataset.update(indices, positions=np.full((len(selected), 3), 9.0))
+
+    positions[selected] = 9.0
+    np.testing.assert_array_equal(dataset.positions, positions)
+    assert_consistent(dataset)
+    assert all(view.changes == ["geometry"] for view in views)
+
+
+def test_update_colors_only_is_a_color_change():
+    dataset, views = dataset_with_views()
+    dataset.update([0, 1], colors=np.zeros((2, 3)))
+    np.testing.assert_array_equal(dataset.colors[:2], 0.0)
+    assert all(view.changes == ["colors"] for view in views)
+
+
+def test_remove_keeps_positions_and_colors_aligned():
+    dataset, views = dataset_with_views()
+    positions, colors = dataset.positions.copy(), dataset.colors.copy()
+    removed = [0, 3, 9]
+
+    dataset.remove(removed)
+
+    kept = np.setdiff1d(np.arange(10), removed)
+    np.testing.assert_array_equal(dataset.positions, positions[kept])
+    np.testing.assert_array_equal(dataset.colors, colors[kept])
+    assert_consistent(dataset)
+    assert all(view.changes == ["remove"] for view in views)
+
+
+def test_radius_change_is_a_geometry_change():
+    dataset, views = dataset_with_views()
+    dataset.particle_radius = dataset.particle_radius
+    assert all(view.changes == [] for view in views)
+    dataset.particle_radius = 0.25
+    assert all(view.changes == ["geometry"] for view in views)
+
+
+def test_removed_view_is_no_longer_notified():
+    dataset, (first, second) = dataset_with_views()
+    dataset.remove_view(first)
+    dataset.set_all(positions=np.zeros((10, 3)))
+    dataset.request_draw()
+    assert first.changes == [] and first.draw_requests == 0
+    assert second.changes == ["geometry"] and second.draw_requests == 1
+
+
+def test_shared_changes_invalidate_every_widgets_draw_lists():
+    pytest.importorskip("ipycanvas")
+    from ipy_opengl_utils.particle_widget import ParticleWidget
+
+    dataset, _ = dataset_with_views(views=0)
+    widgets = [ParticleWidget(64, 48, dataset=dataset, lod=True) for _ in range(2)]
+    try:
+        def mark_current():
+            for widget in widgets:
+                widget.draw_list._key = "current"
+                widget.late_draw_list._key = "current"
+
+        for change in (lambda: setattr(dataset, "particle_radius", 0.1),
+                       lambda: dataset.update([0], positions=np.zeros((1, 3))),
+                       lambda: dataset.remove([0])):
+            mark_current()
+            change()
+            for widget in widgets:
+                assert widget.draw_list._key is None
+                assert widget.late_draw_list._key is None
+
+        widgets[1].selection_index = 2
+        dataset.remove([0])
+        assert widgets[1].selection_index == -1
+    finally:
+        for widget in widgets:
+            widget.close()
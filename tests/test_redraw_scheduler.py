@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+from ipy_opengl_utils.redraw_scheduler import RedrawScheduler
+
+
+class Recorder:
+    """render/on_idle callbacks recording what each frame saw."""
+
+    def __init__(self, duration=0.0):
+        self.duration = duration
+        self.state = 0
+        self.rendered = []
+        self.starts = []
+        self.idle = 0
+
+    def render(self):
+        self.starts.append(time.monotonic())
+        self.rendered.append(self.state)
+        if self.duration:
+            time.sleep(self.duration)
+
+    def on_idle(self):
+        self.idle += 1
+
+
+def test_burst_of_invalidations_renders_once_with_the_latest_state():
+    recorder = Recorder()
+    scheduler = RedrawScheduler(recorder.render, frame_budget=0.01)
+
+    async def main():
+        for state in range(10):
+            recorder.state = state
+            scheduler.invalidate()
+        assert scheduler.pending
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    assert recorder.rendered == [9]
+    assert scheduler.stats()["frames"] == 1
+    assert scheduler.stats()["coalesced"] == 9
+
+
+def test_frames_are_spaced_by_the_budget():
+    recorder = Recorder()
+    scheduler = RedrawScheduler(recorder.render, frame_budget=0.05)
+
+    async def main():
+        scheduler.invalidate()
+        await asyncio.sleep(0.01)
+        scheduler.invalidate()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert len(recorder.starts) == 2
+    assert recorder.starts[1] - recorder.starts[0] >= 0.05 - 0.005
+
+
+def test_budget_overruns_count_each_slow_frame_once():
+    # every frame takes several budgets, yet counts as one overrun
+    recorder = Recorder(duration=0.05)
+    scheduler = RedrawScheduler(recorder.render, frame_budget=0.005)
+
+    async def main():
+        for _ in range(3):
+            scheduler.invalidate()
+            await asyncio.sleep(0.07)
+
+    asyncio.run(main())
+    assert scheduler.stats()["frames"] == 3
+    assert scheduler.stats()["budget_overruns"] == 3
+
+
+def test_fast_frames_are_not_overruns():
+    recorder = Recorder()
+    scheduler = RedrawScheduler(recorder.render, frame_budget=0.5)
+    for _ in range(3):
+        scheduler.invalidate()
+    assert scheduler.stats()["budget_overruns"] == 0
+
+
+def test_idle_callback_runs_once_after_the_last_frame():
+    recorder = Recorder()
+    scheduler = RedrawScheduler(recorder.render, frame_budget=0.01, on_idle=recorder.on_idle, idle_delay=0.02)
+
+    async def main():
+        scheduler.invalidate()
+        await asyncio.sleep(0.015)
+        scheduler.invalidate()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert len(recorder.rendered) == 2
+    assert recorder.idle == 1
+
+
+def test_cancel_drops_the_pending_frame_and_idle_callback():
+    recorder = Recorder()
+    scheduler = RedrawScheduler(recorder.render, frame_budget=0.01, on_idle=recorder.on_idle, idle_delay=0.05)
+
+    async def main():
+        scheduler.invalidate()
+        await asyncio.sleep(0.02)  # first frame rendered, idle callback scheduled
+        scheduler.cancel()
+        await asyncio.sleep(0.1)
+        assert recorder.idle == 0
+
+        scheduler.invalidate()
+        assert scheduler.pending
+        scheduler.cancel()
+        assert not scheduler.pending
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert recorder.rendered == [0]
+    assert recorder.idle == 0
+
+
+def test_without_an_event_loop_every_invalidation_renders():
+    recorder = Recorder()
+    scheduler = RedrawScheduler(recorder.render)
+    for state in range(3):
+        recorder.state = state
+        scheduler.invalidate()
+    assert recorder.rendered == [0, 1, 2]
+    assert not scheduler.pending
@@ -0,0 +1,162 @@
+import numpy as np
+import pytest
+
+from ipy_opengl_utils.math_utils import nearest_ray_sphere
+from ipy_opengl_utils.spatial_index import UniformGrid
+
+
+def brute_force_pick(origin, direction, centers, radius):
+    # the grid normalizes the direction before intersecting; do the same so both
+    # run the exact same float32 intersection on every sphere
+    direction = np.asarray(direction, dtype=np.float64)
+    return nearest_ray_sphere(origin, direction / np.linalg.norm(direction), centers, radius)
+
+
+def assert_same_pick(grid_hit, centers, origin, direction, radius):
+    index, dist = grid_hit
+    expected_index, expected_dist = brute_force_pick(origin, direction, centers, radius)
+    if expected_index == -1:
+        assert index == -1 and dist == np.inf
+        return
+    assert dist == pytest.approx(expected_dist, rel=1e-6)
+    if index != expected_index:
+        # only acceptable for spheres the ray enters at the same distance
+        r = radius if np.isscalar(radius) else radius[[index]]
+        _, own_dist = brute_force_pick(origin, direction, centers[[index]], r)
+        assert own_dist == pytest.approx(expected_dist, rel=1e-6)
+
+
+def random_rays(rng, centers, count):
+    """Rays from outside the cloud, half aimed at particles and half in random directions."""
+    middle = centers.mean(axis=0)
+    span = np.ptp(centers, axis=0).max() + 1.0
+    for i in range(count):
+        direction = rng.normal(size=3)
+        origin = middle - direction / np.linalg.norm(direction) * 2.0 * span
+        if i % 2 == 0:
+            direction = centers[rng.integers(len(centers))] + rng.normal(scale=0.05, size=3) - origin
+        else:
+            direction = rng.normal(size=3)
+        yield origin, direction
+
+
+def uniform_cloud(rng, count):
+    return rng.uniform(-10, 10, size=(count, 3)).astype(np.float32)
+
+
+def clustered_cloud(rng, count):
+    blobs = rng.uniform(-20, 20, size=(5, 3))
+    return (blobs[rng.integers(5, size=count)] + rng.normal(scale=1.0, size=(count, 3))).astype(np.float32)
+
+
+@pytest.mark.parametrize("cloud", [uniform_cloud, clustered_cloud])
+@pytest.mark.parametrize("seed", range(4))
+def test_picks_match_brute_force(cloud, seed):
+    rng = np.random.default_rng(seed)
+    centers = cloud(rng, 3000)
+    radius = 0.2
+    grid = UniformGrid(radius=radius, min_pending=0)
+
+    for origin, direction in random_rays(rng, centers, 40):
+        assert_same_pick(grid.intersect_ray(centers, origin, direction), centers, origin, direction, radius)
+    assert grid.indexed == len(centers)
+
+
+def test_per_particle_radii_match_brute_force():
+    rng = np.random.default_rng(10)
+    centers = uniform_cloud(rng, 2000)
+    radii = rng.uniform(0.05, 0.5, size=len(centers)).astype(np.float32)
+    grid = UniformGrid(radius=float(radii.max()), min_pending=0)
+
+    for origin, direction in random_rays(rng, centers, 40):
+        assert_same_pick(grid.intersect_ray(centers, origin, direction, radii), centers, origin, direction, radii)
+
+
+def test_pending_tail_is_searched_before_merging():
+    rng = np.random.default_rng(20)
+    centers = uniform_cloud(rng, 4000)
+    grid = UniformGrid(radius=0.2, min_pending=1000)
+    grid.insert(centers[:3000])
+    assert grid.indexed == 3000
+
+    # below the threshold the new particles stay in the brute-forced tail
+    grid.insert(centers[:3500])
+    assert grid.indexed == 3000
+    for origin, direction in random_rays(rng, centers[3000:3500], 20):
+        assert_same_pick(grid.intersect_ray(centers[:3500], origin, direction, 0.2),
+                         centers[:3500], origin, direction, 0.2)
+    # 500 pending < min_pending: queries don't merge them either
+    assert grid.indexed == 3000
+
+    # past the threshold they are merged into the sorted index
+    grid.insert(centers)
+    assert grid.indexed == 4000
+    for origin, direction in random_rays(rng, centers, 20):
+        assert_same_pick(grid.intersect_ray(centers, origin, direction), centers, origin, direction, 0.2)
+
+
+def test_streaming_inserts_match_brute_force():
+    rng = np.random.default_rng(30)
+    centers = clustered_cloud(rng, 5000)
+    grid = UniformGrid(radius=0.2, min_pending=256)
+    for count in range(500, 5001, 500):
+        grid.insert(centers[:count])
+        origin, direction = next(random_rays(rng, centers[:count], 1))
+        assert_same_pick(grid.intersect_ray(centers[:count], origin, direction), centers[:count], origin,
+                         direction, 0.2)
+
+
+def test_invalidate_rebuilds_after_moving_particles():
+    rng = np.random.default_rng(40)
+    centers = uniform_cloud(rng, 2000)
+    grid = UniformGrid(radius=0.2, min_pending=0)
+    grid.insert(centers)
+
+    moved = centers.copy()
+    moved[::2] += np.float32(5.0)
+    grid.invalidate()
+    assert grid.indexed == 0 and grid.cell_size is None
+
+    for origin, direction in random_rays(rng, moved, 20):
+        assert_same_pick(grid.intersect_ray(moved, origin, direction), moved, origin, direction, 0.2)
+    assert grid.indexed == len(moved)
+
+
+def test_fewer_points_than_indexed_rebuilds():
+    rng = np.random.default_rng(50)
+    centers = uniform_cloud(rng, 2000)
+    grid = UniformGrid(radius=0.2, min_pending=0)
+    grid.insert(centers)
+
+    kept = centers[:1200]
+    grid.insert(kept)
+    assert grid.indexed == len(kept)
+    for origin, direction in random_rays(rng, kept, 20):
+        assert_same_pick(grid.intersect_ray(kept, origin, direction), kept, origin, direction, 0.2)
+
+
+def test_empty_grid_misses():
+    grid = UniformGrid(radius=0.2)
+    assert grid.intersect_ray(np.zeros((0, 3), dtype=np.float32), (0, 0, -5), (0, 0, 1)) == (-1, np.inf)
+
+
+def test_widget_picks_brute_force_below_the_particle_threshold(monkeypatch):
+    pytest.importorskip("ipycanvas")
+    from ipy_opengl_utils.particle_widget import ParticleWidget
+
+    widget = ParticleWidget(64, 48, spatial_index=True)
+    try:
+        widget.add_particles(np.zeros((1, 3)), np.ones((1, 3)), update_cam=True)
+        grid_picks = []
+        intersect_ray = widget.spatial_index.intersect_ray
+        monkeypatch.setattr(widget.spatial_index, "intersect_ray",
+                            lambda *args: grid_picks.append(args) or intersect_ray(*args))
+
+        assert widget._pick_particle_cpu(32, 24) == 0
+        assert grid_picks == [] and widget.spatial_index.indexed == 0
+
+        widget.SPATIAL_INDEX_MIN_PARTICLES = 1
+        assert widget._pick_particle_cpu(32, 24) == 0
+        assert len(grid_picks) == 1 and widget.spatial_index.indexed == 1
+    finally:
+        widget.close()
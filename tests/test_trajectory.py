@@ -0,0 +1,174 @@
+import time
+
+import numpy as np
+import pytest
+
+from ipy_opengl_utils.trajectory import FramePrefetcher, TrajectoryPlayer, open_trajectory
+
+
+class FakeDataset:
+    def __init__(self):
+        self.draw_requests = 0
+
+    def request_draw(self):
+        self.draw_requests += 1
+
+
+class FakeWidget:
+    """The parts of ParticleWidget a TrajectoryPlayer uses."""
+
+    def __init__(self):
+        self.positions = np.zeros((0, 3), dtype=np.float32)
+        self.dataset = FakeDataset()
+
+    def add_particles(self, positions, colors, update_cam=False):
+        self.positions = np.array(positions, dtype=np.float32)
+
+    def set_positions(self, positions, start=0):
+        self.positions[start:start + len(positions)] = positions
+
+
+def make_trajectory(frames=10, particles=5):
+    return np.arange(frames * particles * 3, dtype=np.float32).reshape(frames, particles, 3)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.001)
+
+
+def settle_after_requests(prefetcher):
+    """Makes `request` return only once the prefetch thread loaded everything wanted."""
+    request = prefetcher.request
+
+    def request_and_wait(frames):
+        request(frames)
+        wait_until(lambda: all(frame in prefetcher._slot_frames for frame in frames))
+
+    prefetcher.request = request_and_wait
+
+
+@pytest.fixture
+def player_factory():
+    players = []
+
+    def create(trajectory=None, **kwargs):
+        player = TrajectoryPlayer(FakeWidget(), make_trajectory() if trajectory is None else trajectory, **kwargs)
+        players.append(player)
+        return player
+
+    yield create
+    for player in players:
+        player.close()
+
+
+def test_upcoming_wraps_around_when_looping(player_factory):
+    player = player_factory(prefetch=4, loop=True)
+    assert player._upcoming(2) == [3, 4, 5]
+    assert player._upcoming(8) == [9, 0, 1]
+    assert player._upcoming(9) == [0, 1, 2]
+
+
+def test_upcoming_stops_at_the_end_without_looping(player_factory):
+    player = player_factory(prefetch=4, loop=False)
+    assert player._upcoming(8) == [9]
+    assert player._upcoming(9) == []
+
+
+@pytest.mark.parametrize("frame", [-1, 10, 100])
+def test_show_out_of_range_raises(player_factory, frame):
+    player = player_factory()
+    with pytest.raises(IndexError):
+        player.show(frame)
+
+
+def test_step_wraps_or_stops_at_the_end(player_factory):
+    looping = player_factory(loop=True)
+    looping.show(9)
+    assert looping.step() and looping.frame == 0
+
+    once = player_factory(loop=False)
+    once.show(9)
+    assert not once.step() and once.frame == 9
+
+
+def test_shown_positions_match_the_trajectory(player_factory):
+    trajectory = make_trajectory()
+    player = player_factory(trajectory, prefetch=4)
+    for frame in (3, 4, 5, 9, 0, 7):
+        player.show(frame)
+        np.testing.assert_array_equal(player.widget.positions, trajectory[frame])
+
+
+def test_prefetch_hits_and_misses_are_counted(player_factory):
+    player = player_factory(prefetch=4)
+    settle_after_requests(player.prefetcher)
+
+    player.show(0)  # nothing prefetched yet
+    for frame in (1, 2, 3, 4):
+        player.show(frame)
+    player.show(8)  # jump past the prefetched window
+
+    stats = player.stats()
+    assert stats["prefetch_misses"] == 2
+    assert stats["prefetch_hits"] == 4
+    assert stats["frames_shown"] == 6
+
+
+def test_shown_frame_is_not_reclaimed_by_the_next_request(player_factory):
+    # With every slot busy, the frame being shown is the only one the next request
+    # doesn't want. Requesting before getting it would hand its slot to the
+    # prefetcher and turn every sequential frame into a miss.
+    trajectory = make_trajectory(frames=30)
+    player = player_factory(trajectory, prefetch=4)
+    settle_after_requests(player.prefetcher)
+
+    player.show(0)
+    for frame in range(1, 20):
+        player.show(frame)
+        np.testing.assert_array_equal(player.widget.positions, trajectory[frame])
+
+    assert player.stats()["prefetch_misses"] == 1
+    assert player.stats()["prefetch_hits"] == 19
+
+
+def test_prefetcher_get_pins_the_returned_slot():
+    trajectory = make_trajectory()
+    prefetcher = FramePrefetcher(trajectory, slots=2)
+    try:
+        prefetcher.request([1])
+        wait_until(lambda: 1 in prefetcher._slot_frames)
+        frame = prefetcher.get(1)
+
+        # the unpinned slot is the only one left for new requests
+        for wanted in (2, 3, 4):
+            prefetcher.request([wanted])
+            wait_until(lambda: wanted in prefetcher._slot_frames)
+            np.testing.assert_array_equal(frame, trajectory[1])
+        assert (prefetcher.hits, prefetcher.misses) == (1, 0)
+    finally:
+        prefetcher.close()
+
+
+def test_particle_count_mismatch_raises():
+    widget = FakeWidget()
+    widget.add_particles(np.zeros((3, 3)), np.zeros((3, 3)))
+    with pytest.raises(ValueError):
+        TrajectoryPlayer(widget, make_trajectory(particles=5))
+
+
+def test_open_trajectory_memory_maps_npy(tmp_path):
+    trajectory = make_trajectory()
+    path = tmp_path / "trajectory.npy"
+    np.save(path, trajectory)
+    mapped = open_trajectory(str(path))
+    assert isinstance(mapped, np.memmap)
+    np.testing.assert_array_equal(mapped, trajectory)
+
+
+def test_open_trajectory_rejects_wrong_shapes():
+    with pytest.raises(ValueError):
+        open_trajectory(np.zeros((4, 5)))